@@ -0,0 +1 @@
+# To make relative imports work
@@ -0,0 +1,158 @@
+from argparse import ArgumentParser
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import Dict
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+
+from slixmpp_omemo.sharded_storage import ShardedStorage
+
+
+__all__ = [
+    "FileStorage",
+    "benchmark",
+    "main"
+]
+
+
+class FileStorage(Storage):
+    """
+    Storage that keeps all data in memory and rewrites a single JSON file on every write, like the storage of
+    the examples, but performs the file I/O in a thread and serializes writes using a lock.
+    """
+
+    def __init__(self, path: str, fsync: bool) -> None:
+        super().__init__()
+
+        self.__path = path
+        self.__fsync = fsync
+        self.__data: Dict[str, JSONType] = {}
+        self.__lock = asyncio.Lock()
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        return Just(self.__data[key]) if key in self.__data else Nothing()
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        async with self.__lock:
+            self.__data[key] = value
+            await asyncio.to_thread(self.__write, json.dumps(self.__data))
+
+    async def _delete(self, key: str) -> None:
+        async with self.__lock:
+            self.__data.pop(key, None)
+            await asyncio.to_thread(self.__write, json.dumps(self.__data))
+
+    def __write(self, serialized: str) -> None:
+        with open(self.__path, "w", encoding="utf-8") as f:
+            f.write(serialized)
+            if self.__fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+async def benchmark(num_shards: int, conversations: int, messages: int, contacts: int, fsync: bool) -> float:
+    """
+    Simulate concurrent conversations, each of which loads and stores the double ratchet of its session per
+    message, on a sharded storage.
+
+    Every shard holds the data of the same number of additional contacts, such that the size of the files,
+    and thus the cost of a single write, does not depend on the number of shards. Differences in throughput
+    are due to the writes to different shards running concurrently.
+
+    Args:
+        num_shards: The number of shards, one file each.
+        conversations: The number of concurrent conversations.
+        messages: The number of messages per conversation.
+        contacts: The number of additional contacts whose data is stored per shard, which determines the
+            size of the files.
+        fsync: Whether to force every write to disk.
+
+    Returns:
+        The throughput in messages per second.
+    """
+
+    ratchet = { "state": "x" * 1024 }
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = ShardedStorage([
+            FileStorage(os.path.join(directory, f"shard-{index}.json"), fsync)
+            for index
+            in range(num_shards)
+        ])
+
+        shard_contacts = [ 0 ] * num_shards
+        contact = 0
+        while min(shard_contacts) < contacts:
+            key = f"/urn:xmpp:omemo:2/contact{contact}@example.org/1/double_ratchet"
+            index = storage.shard_index(key)
+            if shard_contacts[index] < contacts:
+                await storage.store(key, ratchet)
+                shard_contacts[index] += 1
+            contact += 1
+
+        async def conversation(index: int) -> None:
+            key = f"/urn:xmpp:omemo:2/conversation{index}@example.org/1/double_ratchet"
+            for _ in range(messages):
+                await storage.load(key)
+                await storage.store(key, ratchet)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(conversation(index) for index in range(conversations)))
+        duration = time.perf_counter() - start
+
+    return conversations * messages / duration
+
+
+def main() -> None:
+    """
+    Run the benchmark with parameters from the command line.
+    """
+
+    parser = ArgumentParser(
+        description="Benchmark the throughput of sharded storage with concurrent conversations."
+    )
+
+    parser.add_argument(
+        "--shards",
+        dest="shards",
+        type=int,
+        nargs="+",
+        default=[ 1, 2, 4, 8 ],
+        help="numbers of shards"
+    )
+    parser.add_argument(
+        "--conversations",
+        dest="conversations",
+        type=int,
+        nargs="+",
+        default=[ 1, 8, 32 ],
+        help="numbers of concurrent conversations"
+    )
+    parser.add_argument("--messages", dest="messages", type=int, default=50, help="messages per conversation")
+    parser.add_argument(
+        "--contacts",
+        dest="contacts",
+        type=int,
+        default=500,
+        help="number of additional contacts whose data is stored per shard"
+    )
+    parser.add_argument("--fsync", dest="fsync", action="store_true", help="force every write to disk")
+
+    args = parser.parse_args()
+
+    print(f"{'conversations':>14}" + "".join(f"{f'{shards} shards':>14}" for shards in args.shards))
+    for conversations in args.conversations:
+        throughputs = [
+            asyncio.run(benchmark(shards, conversations, args.messages, args.contacts, args.fsync))
+            for shards
+            in args.shards
+        ]
+        print(f"{conversations:>14}" + "".join(f"{throughput:8.0f} msg/s" for throughput in throughputs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+from argparse import ArgumentParser
+from copy import copy
+import time
+import tracemalloc
+from typing import Callable, Tuple
+from xml.etree import ElementTree as ET
+
+from slixmpp.plugins.xep_0334 import Store
+from slixmpp.stanza import Message
+from slixmpp.xmlstream import register_stanza_plugin
+
+from slixmpp_omemo.xep_0384 import _make_encrypted_stanza
+
+
+__all__ = [
+    "benchmark",
+    "main"
+]
+
+
+FALLBACK_MESSAGE = "This message is OMEMO encrypted."
+
+
+def _copy_and_clear(stanza: Message, message_elt: ET.Element) -> Message:
+    """
+    The previous construction path: copy the whole source stanza, clear it and fill it again.
+    """
+
+    stanza_copy = copy(stanza)
+    stanza_copy.clear()
+    stanza_copy.append(message_elt)
+    stanza_copy["body"] = FALLBACK_MESSAGE
+    stanza_copy.enable("store")
+
+    return stanza_copy
+
+
+def _construct(stanza: Message, message_elt: ET.Element) -> Message:
+    """
+    The current construction path.
+    """
+
+    return _make_encrypted_stanza(stanza, message_elt, FALLBACK_MESSAGE)
+
+
+def _measure(
+    construct: Callable[[Message, ET.Element], Message],
+    stanza: Message,
+    message_elt: ET.Element,
+    iterations: int
+) -> Tuple[float, int]:
+    """
+    Measure the time and the allocations of a construction path.
+
+    Returns:
+        The average duration per construction in seconds and the average number of bytes allocated per
+        construction.
+    """
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        construct(stanza, message_elt)
+    duration = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in range(iterations):
+        construct(stanza, message_elt)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The constructed stanzas are not kept, thus the peak covers a single construction plus noise
+    return duration / iterations, peak
+
+
+def benchmark(body_size: int, num_extra_elements: int, iterations: int) -> None:
+    """
+    Compare the construction paths for the outgoing stanza of an encrypted message and print the results.
+
+    Args:
+        body_size: The length of the plaintext body of the source stanza.
+        num_extra_elements: The number of additional child elements of the source stanza.
+        iterations: The number of constructions to average over.
+    """
+
+    register_stanza_plugin(Message, Store)
+
+    stanza = Message()
+    stanza["to"] = "recipient@example.org"
+    stanza["from"] = "sender@example.org/resource"
+    stanza["type"] = "chat"
+    stanza["id"] = "message-id"
+    stanza["body"] = "x" * body_size
+    for i in range(num_extra_elements):
+        ET.SubElement(stanza.xml, f"{{urn:example:extra}}element{i}").text = "y" * 64
+
+    message_elt = ET.Element("{urn:xmpp:omemo:2}encrypted")
+    ET.SubElement(message_elt, "{urn:xmpp:omemo:2}header", { "sid": "1" })
+    ET.SubElement(message_elt, "{urn:xmpp:omemo:2}payload").text = "z" * body_size
+
+    for name, construct in [ ("copy and clear", _copy_and_clear), ("direct construction", _construct) ]:
+        duration, peak = _measure(construct, stanza, message_elt, iterations)
+        print(f"{name:>20}: {duration * 1_000_000:8.1f} us per stanza, {peak:8d} bytes peak allocation")
+
+
+def main() -> None:
+    """
+    Run the benchmark with parameters from the command line.
+    """
+
+    parser = ArgumentParser(description="Benchmark the construction of outgoing encrypted message stanzas.")
+
+    parser.add_argument("--body-size", dest="body_size", type=int, default=4096, help="length of the body")
+    parser.add_argument(
+        "--extra-elements",
+        dest="extra_elements",
+        type=int,
+        default=20,
+        help="number of additional child elements of the source stanza"
+    )
+    parser.add_argument(
+        "--iterations",
+        dest="iterations",
+        type=int,
+        default=10000,
+        help="number of constructions to average over"
+    )
+
+    args = parser.parse_args()
+
+    benchmark(args.body_size, args.extra_elements, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+from argparse import ArgumentParser
+import asyncio
+import os
+import time
+from typing import Dict, FrozenSet, NoReturn, Optional, Tuple
+
+import omemo
+from omemo.types import DeviceInformation
+
+from slixmpp_omemo import TrustLevel
+from slixmpp_omemo.base_session_manager import BaseSessionManager
+
+
+__all__ = [
+    "BenchmarkSessionManager",
+    "benchmark",
+    "main"
+]
+
+
+class BenchmarkSessionManager(BaseSessionManager):
+    """
+    Session manager that serves device information and trust writes from memory, with a configurable
+    artificial delay per storage round trip to model a storage backend with I/O latency. The modeled backend
+    either processes concurrent round trips in parallel, like a database behind a connection pool, or one at
+    a time, like a single file or connection.
+    """
+
+    def __init__(self, devices: FrozenSet[DeviceInformation], latency: float, serialized: bool) -> None:
+        super().__init__()
+
+        self.__devices = devices
+        self.__latency = latency
+        self.__lock = asyncio.Lock() if serialized else None
+        self.trust: Dict[Tuple[str, bytes], str] = {}
+
+    async def __round_trip(self) -> None:
+        """
+        Wait for a storage round trip, after the round trips in progress if the backend is serialized.
+        """
+
+        if self.__lock is None:
+            await asyncio.sleep(self.__latency)
+        else:
+            async with self.__lock:
+                await asyncio.sleep(self.__latency)
+
+    async def get_device_information(self, bare_jid: str) -> FrozenSet[DeviceInformation]:
+        await self.__round_trip()
+
+        return frozenset(device for device in self.__devices if device.bare_jid == bare_jid)
+
+    async def set_trust(self, bare_jid: str, identity_key: bytes, trust_level_name: str) -> None:
+        await self.__round_trip()
+
+        self.trust[(bare_jid, identity_key)] = trust_level_name
+
+    @property
+    def _btbv_enabled(self) -> bool:
+        return True
+
+    @staticmethod
+    async def _upload_bundle(bundle: omemo.Bundle) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _download_bundle(namespace: str, bare_jid: str, device_id: int) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _delete_bundle(namespace: str, device_id: int) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _upload_device_list(namespace: str, device_list: Dict[int, Optional[str]]) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _download_device_list(namespace: str, bare_jid: str) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _send_message(message: omemo.Message, bare_jid: str) -> NoReturn:
+        raise NotImplementedError()
+
+    async def _prompt_manual_trust(
+        self,
+        manually_trusted: FrozenSet[DeviceInformation],
+        identifier: Optional[str]
+    ) -> None:
+        raise AssertionError("All devices are expected to be trusted blindly.")
+
+
+async def benchmark(num_devices: int, num_bare_jids: int, latency: float, serialized: bool) -> float:
+    """
+    Time a single trust decision on a set of new devices which are all eligible for blind trust.
+
+    Args:
+        num_devices: The number of new devices.
+        num_bare_jids: The number of bare JIDs to distribute the devices over.
+        latency: The artificial delay per storage round trip, in seconds.
+        serialized: Whether the storage processes one round trip at a time.
+
+    Returns:
+        The duration of the trust decision, in seconds.
+    """
+
+    devices = frozenset(DeviceInformation(
+        namespaces=frozenset({ "urn:xmpp:omemo:2" }),
+        active=frozenset({ ("urn:xmpp:omemo:2", True) }),
+        bare_jid=f"user{i % num_bare_jids}@example.org",
+        device_id=i,
+        identity_key=os.urandom(32),
+        trust_level_name=TrustLevel.UNDECIDED.value,
+        label=None
+    ) for i in range(num_devices))
+
+    session_manager = BenchmarkSessionManager(devices, latency, serialized)
+
+    start = time.perf_counter()
+    await session_manager._make_trust_decision(devices, None)  # pylint: disable=protected-access
+    duration = time.perf_counter() - start
+
+    assert len(session_manager.trust) == num_devices
+
+    return duration
+
+
+def main() -> None:
+    """
+    Run the benchmark with parameters from the command line.
+    """
+
+    parser = ArgumentParser(description="Benchmark the trust decision phase of encryption for new devices.")
+
+    parser.add_argument("--devices", dest="devices", type=int, default=1000, help="number of new devices")
+    parser.add_argument("--jids", dest="jids", type=int, default=100, help="number of bare JIDs")
+    parser.add_argument(
+        "--latency",
+        dest="latency",
+        type=float,
+        default=0.001,
+        help="storage round trip latency in seconds"
+    )
+
+    args = parser.parse_args()
+
+    for serialized in [ False, True ]:
+        result = asyncio.run(benchmark(args.devices, args.jids, args.latency, serialized))
+
+        print(
+            f"Trust decision for {args.devices} new devices of {args.jids} bare JIDs with"
+            f" {args.latency * 1000:.1f} ms storage latency,"
+            f" {'one round trip at a time' if serialized else 'round trips in parallel'}:"
+            f" {result * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
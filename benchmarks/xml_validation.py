@@ -0,0 +1,164 @@
+from argparse import ArgumentParser
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List
+from xml.etree import ElementTree as ET
+
+import oldmemo
+import twomemo
+
+from slixmpp_omemo.xep_0384 import OLDMEMO_DEVICE_LIST_NODE, TWOMEMO_DEVICE_LIST_NODE
+from tests.loopback import LoopbackClient, LoopbackServer, create_session_manager, serialize_message
+
+
+__all__ = [
+    "benchmark",
+    "main"
+]
+
+
+async def _time(parse: Callable[[ET.Element], Awaitable[object]], elements: List[ET.Element]) -> float:
+    """
+    Returns:
+        The average duration of parsing one of the elements, in seconds.
+    """
+
+    start = time.perf_counter()
+    for element in elements:
+        await parse(element)
+    return (time.perf_counter() - start) / len(elements)
+
+
+async def benchmark(num_messages: int, sample_rate: float) -> Dict[str, Dict[str, float]]:
+    """
+    Measure the per-element parsing cost of each XML validation policy, for device lists, bundles and
+    messages of both OMEMO versions.
+
+    Args:
+        num_messages: The number of messages, and the number of repetitions for device lists and bundles.
+        sample_rate: The fraction of elements validated against the schemas with the ``"sampled"`` policy.
+
+    Returns:
+        The average duration per element in seconds, by policy and element type.
+    """
+
+    server = LoopbackServer()
+    sender = await create_session_manager(server, "alice@example.org")
+    recipient = await create_session_manager(server, "bob@example.org")
+
+    message_elts: List[ET.Element] = []
+    for namespace in [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]:
+        await sender.refresh_device_list(namespace, "bob@example.org")
+        for _ in range(num_messages):
+            messages, _ = await sender.encrypt(
+                frozenset({ "bob@example.org" }),
+                { namespace: b"Hello, Bob!" },
+                backend_priority_order=[ namespace ]
+            )
+            message_elts.extend(serialize_message(message) for message in messages)
+
+    # The recipient needs to know the sending device to parse oldmemo messages
+    for namespace in [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]:
+        await recipient.refresh_device_list(namespace, "alice@example.org")
+
+    sender_device_id = (await sender.get_own_device_information())[0].device_id
+
+    # The plugin is never connected, it is only used to call the parsers in its configuration
+    plugin = LoopbackClient("bob@example.org/benchmark", server).omemo
+    plugin.xml_validation_sample_rate = sample_rate
+
+    results: Dict[str, Dict[str, float]] = {}
+
+    for policy in [ "always", "sampled", "structural" ]:
+        plugin.xml_validation = policy
+        results[policy] = {}
+
+        for namespace, name, device_list_node, bundle_node, bundle_item_id in [
+            (
+                twomemo.twomemo.NAMESPACE,
+                "twomemo",
+                TWOMEMO_DEVICE_LIST_NODE,
+                "urn:xmpp:omemo:2:bundles",
+                str(sender_device_id)
+            ),
+            (
+                oldmemo.oldmemo.NAMESPACE,
+                "oldmemo",
+                OLDMEMO_DEVICE_LIST_NODE,
+                f"eu.siacs.conversations.axolotl.bundles:{sender_device_id}",
+                "current"
+            )
+        ]:
+            device_list_elt = server.get_item("alice@example.org", device_list_node, "current")
+            bundle_elt = server.get_item("alice@example.org", bundle_node, bundle_item_id)
+            assert device_list_elt is not None and bundle_elt is not None
+
+            async def parse_device_list(element: ET.Element, namespace: str = namespace) -> object:
+                return plugin._parse_device_list(namespace, element)  # pylint: disable=protected-access
+
+            async def parse_bundle(element: ET.Element, namespace: str = namespace) -> object:
+                return plugin._parse_bundle(  # pylint: disable=protected-access
+                    namespace,
+                    element,
+                    "alice@example.org",
+                    sender_device_id
+                )
+
+            async def parse_message(element: ET.Element, namespace: str = namespace) -> object:
+                return await plugin._parse_message(  # pylint: disable=protected-access
+                    namespace,
+                    element,
+                    "alice@example.org",
+                    recipient
+                )
+
+            results[policy][f"{name} device list"] = \
+                await _time(parse_device_list, [ device_list_elt ] * num_messages)
+            results[policy][f"{name} bundle"] = await _time(parse_bundle, [ bundle_elt ] * num_messages)
+            results[policy][f"{name} message"] = await _time(
+                parse_message,
+                [ elt for elt in message_elts if elt.tag == f"{{{namespace}}}encrypted" ]
+            )
+
+    return results
+
+
+def main() -> None:
+    """
+    Run the benchmark with parameters from the command line.
+    """
+
+    parser = ArgumentParser(description="Benchmark the per-element cost of the XML validation policies.")
+
+    parser.add_argument(
+        "--messages",
+        dest="messages",
+        type=int,
+        default=200,
+        help="number of messages and repetitions per element type"
+    )
+    parser.add_argument(
+        "--sample-rate",
+        dest="sample_rate",
+        type=float,
+        default=0.1,
+        help="fraction of elements validated against the schemas by the sampled policy"
+    )
+
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args.messages, args.sample_rate))
+
+    element_types = list(next(iter(results.values())).keys())
+
+    print(f"{'':>20}" + "".join(f"{policy:>12}" for policy in results))
+    for element_type in element_types:
+        print(f"{element_type:>20}" + "".join(
+            f"{results[policy][element_type] * 1_000_000:9.1f} us"
+            for policy
+            in results
+        ))
+
+
+if __name__ == "__main__":
+    main()
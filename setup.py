@@ -56,12 +56,15 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     license="GPLv3",
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "benchmarks"]),
     install_requires=[
         "slixmpp>=1.8.0,<2",
         "OMEMO>=1.1.0,<2",
         "Oldmemo[xml]>=1.0.4,<2",
         "Twomemo[xml]>=1.0.4,<2",
+        "X3DH>=1.0.0,<2",
+        "XEdDSA>=1.0.0,<2",
+        "cryptography>=3.3.2",
         "typing-extensions>=4.4.0"
     ],
     python_requires=">=3.9",
@@ -1,9 +1,11 @@
 from abc import abstractmethod
+import asyncio
+from collections import OrderedDict
 import enum
-from typing import FrozenSet, Optional, Set
+from typing import Dict, FrozenSet, Optional, Set, Tuple
 from typing_extensions import assert_never
 
-from omemo.session_manager import SessionManager, UnknownTrustLevel
+from omemo.session_manager import SessionManager, TrustDecisionFailed, UnknownTrustLevel
 from omemo.types import DeviceInformation, TrustLevel as CoreTrustLevel
 
 
@@ -13,6 +15,9 @@ __all__ = [
 ]
 
 
+TRUST_CACHE_MAX_ENTRIES = 4096
+
+
 @enum.unique
 class TrustLevel(enum.Enum):
     """
@@ -30,49 +35,160 @@ class BaseSessionManager(SessionManager):
     Partial :class:`omemo.SessionManager` implementation with BTBV and manual trust as its trust systems.
     """
 
-    async def _evaluate_custom_trust_level(self, device: DeviceInformation) -> CoreTrustLevel:
+    def __init__(self) -> None:
+        super().__init__()
+
+        # Evaluated trust levels, keyed by bare JID and identity key, in least recently used order. Each entry
+        # remembers the trust level name it was evaluated for, and all entries are only valid for the BTBV
+        # setting they were evaluated with.
+        self.__trust_cache: OrderedDict[Tuple[str, bytes], Tuple[str, TrustLevel, CoreTrustLevel]] = \
+            OrderedDict()
+        self.__trust_cache_btbv_enabled: Optional[bool] = None
+
+        # Trust decisions in progress, keyed by bare JID and identity key of the undecided devices
+        self.__pending_trust_decisions: Dict[Tuple[str, bytes], asyncio.Future[None]] = {}
+
+    def __evaluate_trust_level(self, device: DeviceInformation) -> Tuple[TrustLevel, CoreTrustLevel]:
+        """
+        Evaluate the trust level of a device. Results are cached until the trust level of the device is
+        changed via :meth:`set_trust` or the BTBV setting changes, for up to :data:`TRUST_CACHE_MAX_ENTRIES`
+        devices with least-recently-used eviction.
+
+        Args:
+            device: The device to evaluate the trust level of.
+
+        Returns:
+            The custom trust level of the device and the core trust level it maps to.
+
+        Raises:
+            UnknownTrustLevel: if the trust level name of the device is not a known custom trust level.
+        """
+
+        btbv_enabled = self._btbv_enabled
+        if btbv_enabled is not self.__trust_cache_btbv_enabled:
+            self.__trust_cache.clear()
+            self.__trust_cache_btbv_enabled = btbv_enabled
+
+        key = (device.bare_jid, device.identity_key)
+
+        cached = self.__trust_cache.get(key)
+        if cached is not None and cached[0] == device.trust_level_name:
+            self.__trust_cache.move_to_end(key)
+            return cached[1], cached[2]
+
         try:
             trust_level = TrustLevel(device.trust_level_name)
         except ValueError as e:
             raise UnknownTrustLevel(f"Unknown trust level name: {device.trust_level_name}") from e
 
+        core_trust_level: CoreTrustLevel
+
         # Those custom trust levels map directly to core trust levels
         if trust_level is TrustLevel.TRUSTED:
-            return CoreTrustLevel.TRUSTED
-        if trust_level is TrustLevel.UNDECIDED:
-            return CoreTrustLevel.UNDECIDED
-        if trust_level is TrustLevel.DISTRUSTED:
-            return CoreTrustLevel.DISTRUSTED
+            core_trust_level = CoreTrustLevel.TRUSTED
+        elif trust_level is TrustLevel.UNDECIDED:
+            core_trust_level = CoreTrustLevel.UNDECIDED
+        elif trust_level is TrustLevel.DISTRUSTED:
+            core_trust_level = CoreTrustLevel.DISTRUSTED
 
         # The blindly trusted state maps differently depending on whether BTBV is enabled
-        if trust_level is TrustLevel.BLINDLY_TRUSTED:
-            if self._btbv_enabled:
-                # The blindly trusted state is equivalent to the trusted state when BTBV is enabled.
-                return CoreTrustLevel.TRUSTED
+        elif trust_level is TrustLevel.BLINDLY_TRUSTED:
+            # The blindly trusted state is equivalent to the trusted state when BTBV is enabled, and
+            # equivalent to the undecided state when BTBV is disabled.
+            core_trust_level = CoreTrustLevel.TRUSTED if btbv_enabled else CoreTrustLevel.UNDECIDED
+
+        else:
+            assert_never(trust_level)
 
-            # The blindly trusted state is equivalent to the undecided state when BTBV is disabled.
-            return CoreTrustLevel.UNDECIDED
+        self.__trust_cache[key] = (device.trust_level_name, trust_level, core_trust_level)
+        self.__trust_cache.move_to_end(key)
+        while len(self.__trust_cache) > TRUST_CACHE_MAX_ENTRIES:
+            self.__trust_cache.popitem(last=False)
 
-        assert_never(trust_level)
+        return trust_level, core_trust_level
+
+    async def _evaluate_custom_trust_level(self, device: DeviceInformation) -> CoreTrustLevel:
+        return self.__evaluate_trust_level(device)[1]
 
     async def _make_trust_decision(
         self,
         undecided: FrozenSet[DeviceInformation],
         identifier: Optional[str]
     ) -> None:
+        # Concurrent encryptions for overlapping sets of recipients request decisions for the same undecided
+        # devices. Decide on devices without a pending decision only, and wait for the pending decisions on
+        # the other devices to complete instead of deciding on them a second time.
+        pending = { (device.bare_jid, device.identity_key) for device in undecided } \
+            & self.__pending_trust_decisions.keys()
+
+        pending_decisions = { self.__pending_trust_decisions[key] for key in pending }
+        new = frozenset(
+            device for device in undecided if (device.bare_jid, device.identity_key) not in pending
+        )
+
+        if len(new) > 0:
+            decision: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+            for device in new:
+                self.__pending_trust_decisions[(device.bare_jid, device.identity_key)] = decision
+
+            # Waiters shield the decision, the checks for completion guard against anything else resolving or
+            # cancelling it in the meantime
+            try:
+                await self.__decide_trust(new, identifier)
+            except asyncio.CancelledError:
+                if not decision.done():
+                    decision.set_exception(TrustDecisionFailed("The trust decision was cancelled."))
+                raise
+            except BaseException as e:
+                if not decision.done():
+                    decision.set_exception(e)
+                raise
+            else:
+                if not decision.done():
+                    decision.set_result(None)
+            finally:
+                # Mark a failed decision as retrieved, to avoid a warning in case nobody else waited for it
+                if decision.done() and not decision.cancelled():
+                    decision.exception()
+
+                for device in new:
+                    del self.__pending_trust_decisions[(device.bare_jid, device.identity_key)]
+
+        # Resume once the decisions made by others are done. Failures of those decisions are forwarded. The
+        # decisions are shared with other encryptions, thus cancelling this one must not cancel them.
+        for pending_decision in pending_decisions:
+            await asyncio.shield(pending_decision)
+
+    async def __decide_trust(
+        self,
+        undecided: FrozenSet[DeviceInformation],
+        identifier: Optional[str]
+    ) -> None:
+        """
+        Make a trust decision on a set of undecided devices, using blind trust for bare JIDs that qualify and
+        manual trust for the rest.
+
+        Args:
+            undecided: The set of undecided devices.
+            identifier: Forwarded from :meth:`_make_trust_decision`.
+        """
+
         # For BTBV, affected JIDs can be separated into two pools: one pool of JIDs for which blind trust is
         # active, i.e. no manual verification was performed before, and one pool of JIDs to use manual trust
         # with instead.
-        bare_jids = { device.bare_jid for device in undecided }
+        bare_jids = list({ device.bare_jid for device in undecided })
 
         blind_trust_bare_jids: Set[str] = set()
         manual_trust_bare_jids: Set[str] = set()
 
-        # For each bare JID, decide whether blind trust applies
-        for bare_jid in bare_jids:
-            # Get all known devices belonging to the bare JID
-            devices = await self.get_device_information(bare_jid)
+        # Get all known devices belonging to each bare JID. The loads are independent of each other, thus
+        # they are performed concurrently instead of paying for one storage round trip after the other.
+        device_information = await asyncio.gather(*(
+            self.get_device_information(bare_jid) for bare_jid in bare_jids
+        ))
 
+        # For each bare JID, decide whether blind trust applies
+        for bare_jid, devices in zip(bare_jids, device_information):
             # If BTBV is disabled, use manual trust
             if not self._btbv_enabled:
                 manual_trust_bare_jids.add(bare_jid)
@@ -81,7 +197,7 @@ class BaseSessionManager(SessionManager):
             # If the trust levels of all devices correspond to those used by blind trust, blind trust
             # applies.
             # Otherwise, fall back to manual trust.
-            if all(TrustLevel(device.trust_level_name) in {
+            if all(self.__evaluate_trust_level(device)[0] in {
                 TrustLevel.UNDECIDED,
                 TrustLevel.BLINDLY_TRUSTED
             } for device in devices):
@@ -95,12 +211,10 @@ class BaseSessionManager(SessionManager):
 
         # Blindly trust devices handled by blind trust
         if len(blindly_trusted_devices) > 0:
-            for device in blindly_trusted_devices:
-                await self.set_trust(
-                    device.bare_jid,
-                    device.identity_key,
-                    TrustLevel.BLINDLY_TRUSTED.name
-                )
+            await self.set_trust_bulk(
+                frozenset((device.bare_jid, device.identity_key) for device in blindly_trusted_devices),
+                TrustLevel.BLINDLY_TRUSTED.name
+            )
 
             await self._devices_blindly_trusted(frozenset(blindly_trusted_devices), identifier)
 
@@ -108,6 +222,37 @@ class BaseSessionManager(SessionManager):
         if len(manually_trusted_devices) > 0:
             await self._prompt_manual_trust(frozenset(manually_trusted_devices), identifier)
 
+    async def set_trust(self, bare_jid: str, identity_key: bytes, trust_level_name: str) -> None:
+        await super().set_trust(bare_jid, identity_key, trust_level_name)
+
+        self.__trust_cache.pop((bare_jid, identity_key), None)
+
+    async def set_trust_bulk(
+        self,
+        identity_keys: FrozenSet[Tuple[str, bytes]],
+        trust_level_name: str
+    ) -> None:
+        """
+        Set the same trust level for multiple identity keys at once.
+
+        The trust level of each identity key is stored under its own key and :class:`omemo.storage.Storage`
+        has no primitive to write multiple keys at once, thus this is not a single bulk write. Instead,
+        :meth:`set_trust` is called for all identity keys concurrently. This only saves time with storage
+        implementations that process concurrent writes in parallel, e.g. over a network connection; storage
+        implementations that process one write at a time take as long as for sequential calls.
+
+        Args:
+            identity_keys: The identity keys to set the trust level for, each paired with the bare JID of the
+                XMPP account it belongs to.
+            trust_level_name: The custom trust level to set for the identity keys.
+        """
+
+        await asyncio.gather(*(
+            self.set_trust(bare_jid, identity_key, trust_level_name)
+            for bare_jid, identity_key
+            in identity_keys
+        ))
+
     @property
     @abstractmethod
     def _btbv_enabled(self) -> bool:
@@ -157,4 +302,9 @@ class BaseSessionManager(SessionManager):
             replaced by calling :meth:`set_trust` with a different trust level. If they are not replaced or
             still evaluate to the undecided trust level after the call, the encryption will fail with an
             exception. See :meth:`encrypt` for details.
+
+        Note:
+            Trust decisions requested concurrently for the same devices are merged: this method is called
+            only once per device, with the identifier of the encryption that requested the decision first. All
+            other encryptions wait for that decision to complete.
         """
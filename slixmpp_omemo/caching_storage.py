@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "CachingStorage"
+]
+
+
+class CachingStorage(Storage):
+    """
+    Storage wrapper that caches the values of the most recently used keys of another storage in memory, up to
+    a maximum number of keys. Loads of cached keys, including keys known to be absent, don't reach the wrapped
+    storage.
+
+    The unbounded cache built into :class:`~omemo.storage.Storage` is disabled for the wrapper. Create the
+    wrapped storage with ``disable_cache=True`` as well, such that its values are not kept in memory twice.
+
+    Stores and deletes are performed on the wrapped storage right away, as required by
+    :class:`~omemo.storage.Storage`, and the cache is updated afterwards.
+    """
+
+    def __init__(self, storage: Storage, max_entries: int) -> None:
+        """
+        Args:
+            storage: The storage to wrap.
+            max_entries: The maximum number of keys to cache.
+        """
+
+        super().__init__(True)
+
+        self.__storage = storage
+        self.__max_entries = max_entries
+
+        self.__entries: OrderedDict[str, Maybe[JSONType]] = OrderedDict()
+
+    @property
+    def size(self) -> int:
+        """
+        Returns:
+            The number of cached keys.
+        """
+
+        return len(self.__entries)
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        value = self.__entries.get(key, None)
+        if value is not None:
+            self.__entries.move_to_end(key)
+            return value
+
+        value = await self.__storage.load(key)
+
+        # Don't replace a value that was stored or deleted while loading
+        if key in self.__entries:
+            return self.__entries[key]
+
+        self.__put(key, value)
+
+        return value
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        await self.__storage.store(key, value)
+        self.__put(key, Just(value))
+
+    async def _delete(self, key: str) -> None:
+        await self.__storage.delete(key)
+        self.__put(key, Nothing())
+
+    def __put(self, key: str, value: Maybe[JSONType]) -> None:
+        """
+        Cache a value as the most recently used one and evict the least recently used values that exceed the
+        maximum number of keys.
+
+        Args:
+            key: The key.
+            value: The value.
+        """
+
+        self.__entries[key] = value
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
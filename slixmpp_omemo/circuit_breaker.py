@@ -0,0 +1,190 @@
+import enum
+import time
+from typing import Dict, FrozenSet, NamedTuple, Optional
+
+
+__all__ = [
+    "CircuitBreaker",
+    "CircuitOpen",
+    "CircuitState"
+]
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of performing a request to a remote service whose circuit is open.
+    """
+
+
+@enum.unique
+class CircuitState(enum.Enum):
+    """
+    The states of a circuit.
+    """
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+
+class Circuit(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The health of a single remote service.
+    """
+
+    failures: int
+    opened_at: Optional[float]
+    reset_timeout: float
+    probing: bool
+
+
+class CircuitBreaker:
+    """
+    Health tracking for a set of remote services, identified by arbitrary keys, e.g. domains.
+
+    The circuit of a service opens after a number of consecutive failures, after which requests to the service
+    are refused instead of waiting for them to fail. Once the reset timeout has passed, the circuit is
+    half-open and a single probe request is allowed. A successful probe closes the circuit, a failed probe
+    opens it again with the reset timeout doubled, up to a maximum. Services without recorded failures take up
+    no memory.
+
+    The plugin tracks the health of remote pubsub services per domain. After ``pubsub_failure_threshold``
+    consecutive timeouts or remote server failures, device list and bundle downloads from the domain fail
+    right away for ``pubsub_reset_timeout`` seconds, such that encryption continues with the cached device
+    lists and sessions instead of waiting for the timeout of every request. The wait between probes is doubled
+    up to ``pubsub_max_reset_timeout`` seconds. Set ``pubsub_failure_threshold`` to zero to disable the health
+    tracking.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, max_reset_timeout: float) -> None:
+        """
+        Args:
+            failure_threshold: The number of consecutive failures that open a circuit. Zero or less disables
+                the breaker, i.e. all requests are allowed.
+            reset_timeout: The time in seconds after which an open circuit allows the first probe.
+            max_reset_timeout: The maximum time in seconds between probes of a circuit that stays open.
+        """
+
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+        self.__max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.__circuits: Dict[str, Circuit] = {}
+
+    @property
+    def open_keys(self) -> FrozenSet[str]:
+        """
+        Returns:
+            The keys of all services whose circuit is open or half-open.
+        """
+
+        return frozenset(key for key, circuit in self.__circuits.items() if circuit.opened_at is not None)
+
+    def state(self, key: str) -> CircuitState:
+        """
+        Args:
+            key: The key of the service.
+
+        Returns:
+            The state of the circuit of the service.
+        """
+
+        circuit = self.__circuits.get(key, None)
+        if circuit is None or circuit.opened_at is None:
+            return CircuitState.CLOSED
+
+        if circuit.probing or time.monotonic() - circuit.opened_at >= circuit.reset_timeout:
+            return CircuitState.HALF_OPEN
+
+        return CircuitState.OPEN
+
+    def allow(self, key: str) -> bool:
+        """
+        Check whether a request to a service may be performed. The outcome of every allowed request has to be
+        reported via :meth:`record_success`, :meth:`record_failure` or :meth:`release`.
+
+        Args:
+            key: The key of the service.
+
+        Returns:
+            Whether the request may be performed. For a half-open circuit, this is only the case for a single
+            probe at a time.
+        """
+
+        circuit = self.__circuits.get(key, None)
+        if circuit is None or circuit.opened_at is None:
+            return True
+
+        if circuit.probing or time.monotonic() - circuit.opened_at < circuit.reset_timeout:
+            return False
+
+        self.__circuits[key] = circuit._replace(probing=True)
+
+        return True
+
+    def record_success(self, key: str) -> None:
+        """
+        Report a successful request, which closes the circuit of the service.
+
+        Args:
+            key: The key of the service.
+        """
+
+        self.__circuits.pop(key, None)
+
+    def record_failure(self, key: str) -> bool:
+        """
+        Report a failed request.
+
+        Args:
+            key: The key of the service.
+
+        Returns:
+            Whether the failure opened the circuit of the service, or opened it again after a failed probe.
+        """
+
+        if self.__failure_threshold <= 0:
+            return False
+
+        circuit = self.__circuits.get(key, Circuit(0, None, self.__reset_timeout, False))
+
+        if circuit.opened_at is not None:
+            # Failures of requests that were started before the circuit opened don't count
+            if not circuit.probing:
+                return False
+
+            self.__circuits[key] = Circuit(
+                circuit.failures + 1,
+                time.monotonic(),
+                min(circuit.reset_timeout * 2, self.__max_reset_timeout),
+                False
+            )
+
+            return True
+
+        if circuit.failures + 1 >= self.__failure_threshold:
+            self.__circuits[key] = Circuit(
+                circuit.failures + 1,
+                time.monotonic(),
+                self.__reset_timeout,
+                False
+            )
+
+            return True
+
+        self.__circuits[key] = circuit._replace(failures=circuit.failures + 1)
+
+        return False
+
+    def release(self, key: str) -> None:
+        """
+        Report a request that neither succeeded nor failed, e.g. because it was cancelled. If the request was
+        the probe of a half-open circuit, another probe is allowed.
+
+        Args:
+            key: The key of the service.
+        """
+
+        circuit = self.__circuits.get(key, None)
+        if circuit is not None and circuit.probing:
+            self.__circuits[key] = circuit._replace(probing=False)
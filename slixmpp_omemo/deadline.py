@@ -0,0 +1,97 @@
+import asyncio
+import inspect
+from typing import Awaitable, Dict, Set, Tuple, TypeVar
+
+from omemo.bundle import Bundle
+
+
+__all__ = [
+    "Deadline",
+    "DeadlineExceeded"
+]
+
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of waiting for an operation that did not complete before the deadline.
+    """
+
+
+class Deadline:
+    """
+    A point in time, relative to the clock of the running event loop, after which waiting for network
+    operations is abandoned.
+    """
+
+    def __init__(self, timeout: float) -> None:
+        """
+        Args:
+            timeout: The time in seconds from now until the deadline expires.
+        """
+
+        self.__expires_at = asyncio.get_running_loop().time() + timeout
+
+        # Bundles downloaded before the deadline, keyed by namespace, bare JID and device id, such that they
+        # are downloaded only once within the deadline
+        self.bundles: Dict[Tuple[str, str, int], Bundle] = {}
+
+        # The namespace, bare JID and device id of bundles whose download was abandoned due to the deadline
+        self.skipped_bundles: Set[Tuple[str, str, int]] = set()
+
+    @property
+    def remaining(self) -> float:
+        """
+        Returns:
+            The time in seconds until the deadline expires, negative if expired.
+        """
+
+        return self.__expires_at - asyncio.get_running_loop().time()
+
+    def check(self) -> None:
+        """
+        Check the deadline before starting an operation. Requests like IQs are sent as soon as the awaitable
+        representing them is created, thus the check has to happen before that.
+
+        Raises:
+            DeadlineExceeded: if the deadline expired already.
+        """
+
+        if self.remaining <= 0:
+            raise DeadlineExceeded("The deadline expired already.")
+
+    async def wait_for(self, awaitable: Awaitable[T]) -> T:
+        """
+        Wait for a coroutine or future to complete, but no longer than the deadline. The coroutine or future
+        is cancelled when the deadline expires, or right away if the deadline expired already.
+
+        Args:
+            awaitable: The coroutine or future to wait for.
+
+        Returns:
+            The result of the awaitable.
+
+        Raises:
+            DeadlineExceeded: if the deadline expired before the awaitable completed.
+            Exception: all exceptions raised by the awaitable are forwarded as-is.
+        """
+
+        remaining = self.remaining
+        if remaining <= 0:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+            if isinstance(awaitable, asyncio.Future):
+                awaitable.cancel()
+
+            raise DeadlineExceeded("The deadline expired already.")
+
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError as e:
+            # Timeouts raised by the awaitable itself before the deadline are forwarded as-is
+            if self.remaining > 0:
+                raise
+
+            raise DeadlineExceeded("The deadline expired before the operation completed.") from e
@@ -0,0 +1,363 @@
+import asyncio
+import base64
+from collections import OrderedDict
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Type, cast
+import zlib
+
+from omemo import MessageNotForUs
+from omemo.storage import Storage
+from omemo.types import DeviceInformation, JSONType
+
+from .sealing import Sealer
+
+
+__all__ = [
+    "CACHEABLE_FAILURES",
+    "DecryptionCache",
+    "DecryptionOutcome"
+]
+
+
+CACHEABLE_FAILURES: Dict[str, Type[Exception]] = {
+    "MessageNotForUs": MessageNotForUs
+}
+"""
+Failures that are permanent, i.e. decrypting the same message again would fail the same way regardless of
+the state of the sessions, the storage or the configuration. Failures are cached as the first matching type
+of this mapping. Other failures, e.g. a missing session that may be built by a later key exchange, are not
+cached.
+"""
+
+
+INDEX_KEY = "/slixmpp/decryption_cache/list"
+INDEX_BUCKETS = 64
+
+
+def _bucket(key: str) -> int:
+    """
+    Args:
+        key: The cache key.
+
+    Returns:
+        The index bucket of the cache key.
+    """
+
+    return zlib.crc32(key.encode("utf-8")) % INDEX_BUCKETS
+
+
+class DecryptionOutcome(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The outcome of decrypting a message, either the plaintext and sending device or the failure.
+    """
+
+    namespace: str
+    plaintext: Optional[bytes]
+    device_information: Optional[DeviceInformation]
+    failure: Optional[Tuple[str, str]]
+    timestamp: float
+
+    @staticmethod
+    def from_failure(namespace: str, exception: Exception) -> Optional["DecryptionOutcome"]:
+        """
+        Args:
+            namespace: The OMEMO version namespace of the message.
+            exception: The exception raised while decrypting the message.
+
+        Returns:
+            The outcome recording the failure, or ``None`` if the failure is not cacheable.
+        """
+
+        for name, failure_type in CACHEABLE_FAILURES.items():
+            if isinstance(exception, failure_type):
+                return DecryptionOutcome(namespace, None, None, (name, str(exception)), time.time())
+
+        return None
+
+    def raise_failure(self) -> None:
+        """
+        Raise a new exception matching the cached failure, if any.
+
+        Raises:
+            Exception: one of the types in :data:`CACHEABLE_FAILURES`, if the outcome is a failure.
+        """
+
+        if self.failure is not None:
+            name, message = self.failure
+            raise CACHEABLE_FAILURES[name](message)
+
+    def serialize(self) -> JSONType:
+        """
+        Returns:
+            The outcome in a JSON-serializable form.
+        """
+
+        device = self.device_information
+
+        return {
+            "namespace": self.namespace,
+            "plaintext": None if self.plaintext is None else base64.b64encode(self.plaintext).decode("ASCII"),
+            "device": None if device is None else {
+                "namespaces": [ *sorted(device.namespaces) ],
+                "active": [ [ namespace, active ] for namespace, active in sorted(device.active) ],
+                "bare_jid": device.bare_jid,
+                "device_id": device.device_id,
+                "identity_key": base64.b64encode(device.identity_key).decode("ASCII"),
+                "trust_level_name": device.trust_level_name,
+                "label": device.label
+            },
+            "failure": None if self.failure is None else list(self.failure),
+            "timestamp": self.timestamp
+        }
+
+    @staticmethod
+    def parse(serialized: JSONType) -> "DecryptionOutcome":
+        """
+        Args:
+            serialized: An outcome in the form produced by :meth:`serialize`.
+
+        Returns:
+            The outcome.
+
+        Raises:
+            ValueError: if the serialized outcome is malformed.
+        """
+
+        try:
+            # Trust the structure, any deviation surfaces as one of the exceptions below
+            data = cast(Dict[str, JSONType], serialized)
+            plaintext = cast(Optional[str], data["plaintext"])
+            device = cast(Optional[Dict[str, JSONType]], data["device"])
+            failure = cast(Optional[Tuple[str, str]], data["failure"])
+
+            if failure is not None and failure[0] not in CACHEABLE_FAILURES:
+                raise ValueError(f"Unknown failure type: {failure[0]}")
+
+            return DecryptionOutcome(
+                namespace=cast(str, data["namespace"]),
+                plaintext=None if plaintext is None else base64.b64decode(plaintext),
+                device_information=None if device is None else DeviceInformation(
+                    namespaces=frozenset(cast(List[str], device["namespaces"])),
+                    active=frozenset(
+                        (namespace, active)
+                        for namespace, active
+                        in cast(List[Tuple[str, bool]], device["active"])
+                    ),
+                    bare_jid=cast(str, device["bare_jid"]),
+                    device_id=cast(int, device["device_id"]),
+                    identity_key=base64.b64decode(cast(str, device["identity_key"])),
+                    trust_level_name=cast(str, device["trust_level_name"]),
+                    label=cast(Optional[str], device["label"])
+                ),
+                failure=None if failure is None else (failure[0], failure[1]),
+                timestamp=cast(float, data["timestamp"])
+            )
+        except (KeyError, TypeError, IndexError) as e:
+            raise ValueError("Malformed decryption outcome") from e
+
+
+class DecryptionCache:
+    """
+    Bounded cache of decryption outcomes with least-recently-used eviction and a maximum age. Optionally, the
+    outcomes are persisted in a :class:`~omemo.storage.Storage`, encrypted using AES-GCM if a key is given.
+
+    The cache keys are opaque strings, which are used as part of storage keys when persisting. The index of
+    persisted outcomes is split into :data:`INDEX_BUCKETS` buckets by a stable hash of the cache key, thus
+    caching an outcome only rewrites the buckets of the cached and the evicted keys instead of the whole
+    index.
+
+    A ratchet message can only be decrypted once, thus decrypting a message again, e.g. due to overlapping MAM
+    pages, carbons or refetches after reconnection, fails. The plugin caches decryption outcomes once its
+    ``decryption_cache_size`` config option is set to a positive number, keyed by the XEP-0359 origin-id or
+    stanza-id and the sending device, such that :meth:`~slixmpp_omemo.XEP_0384.decrypt_message` returns the
+    original result, or raises permanent failures like :class:`~omemo.MessageNotForUs` again, for such
+    messages. Outcomes expire after ``decryption_cache_max_age`` seconds. With ``decryption_cache_persistent``
+    enabled, the outcomes are kept in the plugin's storage, which includes plaintexts; set
+    ``decryption_cache_key`` to a 128, 192 or 256 bit AES key to encrypt them at rest. The device information
+    returned for cached outcomes reflects the time of the original decryption.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_age: float,
+        storage: Optional[Storage] = None,
+        encryption_key: Optional[bytes] = None
+    ) -> None:
+        """
+        Args:
+            max_entries: The maximum number of outcomes to keep.
+            max_age: The maximum age of outcomes in seconds, older outcomes are treated as absent.
+            storage: The storage to persist the outcomes in, or ``None`` to keep them in memory only.
+            encryption_key: A 128, 192 or 256 bit AES key to encrypt persisted outcomes with. Outcomes are
+                persisted unencrypted if no key is given, which includes plaintexts of decrypted messages.
+
+        Raises:
+            ValueError: if the encryption key has an invalid length.
+        """
+
+        self.__max_entries = max_entries
+        self.__max_age = max_age
+        self.__storage = storage
+        self.__sealer = Sealer(encryption_key)
+
+        # Maps cache keys to their timestamp and outcome. Persisted outcomes are loaded lazily, the outcome is
+        # None until then.
+        self.__entries: OrderedDict[str, Tuple[float, Optional[DecryptionOutcome]]] = OrderedDict()
+        self.__buckets: List[Dict[str, float]] = [ {} for _ in range(INDEX_BUCKETS) ]
+        self.__loaded = storage is None
+        self.__lock = asyncio.Lock()
+
+    async def get(self, key: str) -> Optional[DecryptionOutcome]:
+        """
+        Args:
+            key: The cache key.
+
+        Returns:
+            The cached outcome, or ``None`` if the key is not cached or the outcome expired.
+        """
+
+        await self.__load_index()
+
+        entry = self.__entries.get(key, None)
+        if entry is None:
+            return None
+
+        timestamp, outcome = entry
+        if time.time() - timestamp > self.__max_age:
+            await self.__remove(key)
+            return None
+
+        if outcome is None:
+            outcome = await self.__load_outcome(key)
+            if outcome is None:
+                self.__entries.pop(key, None)
+                self.__buckets[_bucket(key)].pop(key, None)
+                return None
+
+            self.__entries[key] = (timestamp, outcome)
+
+        self.__entries.move_to_end(key)
+
+        return outcome
+
+    async def put(self, key: str, outcome: DecryptionOutcome) -> None:
+        """
+        Cache an outcome, evicting the least recently used outcomes if the cache is full.
+
+        Args:
+            key: The cache key.
+            outcome: The outcome to cache.
+        """
+
+        if self.__max_entries <= 0:
+            return
+
+        await self.__load_index()
+
+        self.__entries[key] = (outcome.timestamp, outcome)
+        self.__entries.move_to_end(key)
+        self.__buckets[_bucket(key)][key] = outcome.timestamp
+
+        evicted = []
+        while len(self.__entries) > self.__max_entries:
+            evicted_key = self.__entries.popitem(last=False)[0]
+            self.__buckets[_bucket(evicted_key)].pop(evicted_key, None)
+            evicted.append(evicted_key)
+
+        if self.__storage is not None:
+            await self.__storage.store(
+                f"/slixmpp/decryption_cache/{key}",
+                self.__sealer.seal(outcome.serialize(), key)
+            )
+            for evicted_key in evicted:
+                await self.__storage.delete(f"/slixmpp/decryption_cache/{evicted_key}")
+            await self.__store_buckets({ _bucket(changed_key) for changed_key in [ key, *evicted ] })
+
+    async def __remove(self, key: str) -> None:
+        """
+        Args:
+            key: The cache key to remove the outcome of.
+        """
+
+        self.__entries.pop(key, None)
+        self.__buckets[_bucket(key)].pop(key, None)
+
+        if self.__storage is not None:
+            await self.__storage.delete(f"/slixmpp/decryption_cache/{key}")
+            await self.__store_buckets({ _bucket(key) })
+
+    async def __load_index(self) -> None:
+        """
+        Load the keys and timestamps of the persisted outcomes, once.
+        """
+
+        if self.__loaded:
+            return
+
+        async with self.__lock:
+            if self.__loaded:
+                return
+
+            storage = self.__storage
+            index: List[Tuple[str, float]] = []
+            if storage is not None:
+                for bucket in range(INDEX_BUCKETS):
+                    index.extend(cast(
+                        List[Tuple[str, float]],
+                        (await storage.load(f"{INDEX_KEY}/{bucket}")).maybe([])
+                    ))
+
+            # The least recently used order is not persisted, the oldest outcomes are evicted first instead
+            now = time.time()
+            for key, timestamp in sorted(index, key=lambda entry: entry[1]):
+                if now - timestamp <= self.__max_age:
+                    self.__entries[key] = (timestamp, None)
+                    self.__buckets[_bucket(key)][key] = timestamp
+
+            self.__loaded = True
+
+    async def __store_buckets(self, buckets: Set[int]) -> None:
+        """
+        Persist the keys and timestamps of the cached outcomes in some of the index buckets.
+
+        Args:
+            buckets: The buckets to persist.
+        """
+
+        storage = self.__storage
+        if storage is not None:
+            for bucket in sorted(buckets):
+                entries = self.__buckets[bucket]
+                if len(entries) == 0:
+                    await storage.delete(f"{INDEX_KEY}/{bucket}")
+                else:
+                    await storage.store(f"{INDEX_KEY}/{bucket}", [
+                        [ key, timestamp ]
+                        for key, timestamp
+                        in entries.items()
+                    ])
+
+    async def __load_outcome(self, key: str) -> Optional[DecryptionOutcome]:
+        """
+        Args:
+            key: The cache key.
+
+        Returns:
+            The persisted outcome, or ``None`` if it is missing or can't be decrypted or parsed.
+        """
+
+        sealed: Optional[JSONType] = None
+
+        storage = self.__storage
+        if storage is not None:
+            sealed = (await storage.load(f"/slixmpp/decryption_cache/{key}")).maybe(None)
+        if sealed is None:
+            return None
+
+        try:
+            return DecryptionOutcome.parse(self.__sealer.unseal(sealed, key))
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Treat outcomes that were e.g. persisted using a different key as absent
+            return None
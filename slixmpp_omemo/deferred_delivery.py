@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set, Tuple, cast
+
+from omemo.storage import Storage
+from omemo.types import JSONType
+
+from .sealing import Sealer
+
+
+__all__ = [
+    "DeferredDeliveryQueue",
+    "DeferredMessage",
+    "Recipient"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+INDEX_KEY = "/slixmpp/deferred_delivery/list"
+
+
+Recipient = Tuple[str, Optional[int]]
+"""
+A recipient of a deferred message: a bare JID and a device id, or ``None`` in place of the device id to
+address all devices of the bare JID, once any are known.
+"""
+
+
+class DeferredMessage(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    A message stanza whose delivery to some recipients is deferred until their key material is available.
+    """
+
+    message_id: str
+    stanza: str
+    identifier: Optional[str]
+    recipients: FrozenSet[Recipient]
+    timestamp: float
+
+    def serialize(self) -> JSONType:
+        """
+        Returns:
+            The deferred message in a JSON-serializable form.
+        """
+
+        return {
+            "stanza": self.stanza,
+            "identifier": self.identifier,
+            "recipients": [ [ bare_jid, device_id ] for bare_jid, device_id in sorted(
+                self.recipients,
+                key=lambda recipient: (recipient[0], -1 if recipient[1] is None else recipient[1])
+            ) ],
+            "timestamp": self.timestamp
+        }
+
+    @staticmethod
+    def parse(message_id: str, serialized: JSONType) -> "DeferredMessage":
+        """
+        Args:
+            message_id: The id of the deferred message.
+            serialized: A deferred message in the form produced by :meth:`serialize`.
+
+        Returns:
+            The deferred message.
+
+        Raises:
+            ValueError: if the serialized deferred message is malformed.
+        """
+
+        try:
+            data = cast(Dict[str, JSONType], serialized)
+
+            return DeferredMessage(
+                message_id=message_id,
+                stanza=cast(str, data["stanza"]),
+                identifier=cast(Optional[str], data["identifier"]),
+                recipients=frozenset(
+                    (bare_jid, device_id)
+                    for bare_jid, device_id
+                    in cast(List[Tuple[str, Optional[int]]], data["recipients"])
+                ),
+                timestamp=cast(float, data["timestamp"])
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("Malformed deferred message") from e
+
+
+class DeferredDeliveryQueue:
+    """
+    Persistent queue of message stanzas whose delivery to some recipients is deferred. The queue only keeps
+    track of the messages and their pending recipients, encrypting and sending is up to the user of the queue.
+
+    The queue is loaded from the storage once, on first access, and kept in memory afterwards. Each message is
+    persisted under its own key, alongside an index of all message ids. The messages include the plaintext
+    source stanzas, thus they are encrypted using AES-GCM if a key is given. Messages that can't be decrypted
+    or parsed, e.g. because they were persisted using a different key, are skipped but kept in the storage.
+    """
+
+    def __init__(self, storage: Storage, encryption_key: Optional[bytes] = None) -> None:
+        """
+        Args:
+            storage: The storage to persist the queue in.
+            encryption_key: A 128, 192 or 256 bit AES key to encrypt persisted messages with. Messages are
+                persisted unencrypted if no key is given.
+
+        Raises:
+            ValueError: if the encryption key has an invalid length.
+        """
+
+        self.__storage = storage
+        self.__sealer = Sealer(encryption_key)
+        self.__messages: Dict[str, DeferredMessage] = {}
+        self.__unreadable: Set[str] = set()
+        self.__loaded = False
+        self.__lock = asyncio.Lock()
+
+    @property
+    def size(self) -> int:
+        """
+        Returns:
+            The number of pending (message, recipient) pairs. Zero until the queue was loaded.
+        """
+
+        return sum(len(message.recipients) for message in self.__messages.values())
+
+    @property
+    def oldest_timestamp(self) -> Optional[float]:
+        """
+        Returns:
+            The time at which the oldest message still in the queue was deferred, or ``None`` if the queue is
+            empty or not loaded yet.
+        """
+
+        return min((message.timestamp for message in self.__messages.values()), default=None)
+
+    def is_pending(self, bare_jid: str) -> bool:
+        """
+        Args:
+            bare_jid: The bare JID to check.
+
+        Returns:
+            Whether any deferred message is pending delivery to the bare JID. ``False`` until the queue was
+            loaded.
+        """
+
+        return any(
+            recipient_bare_jid == bare_jid
+            for message in self.__messages.values()
+            for recipient_bare_jid, _ in message.recipients
+        )
+
+    async def messages(self) -> List[DeferredMessage]:
+        """
+        Returns:
+            All deferred messages, oldest first.
+        """
+
+        await self.__load()
+
+        return sorted(self.__messages.values(), key=lambda message: message.timestamp)
+
+    async def put(
+        self,
+        stanza: str,
+        identifier: Optional[str],
+        recipients: FrozenSet[Recipient]
+    ) -> DeferredMessage:
+        """
+        Add a message to the queue.
+
+        Args:
+            stanza: The serialized source stanza of the message.
+            identifier: The identifier passed to :meth:`~slixmpp_omemo.XEP_0384.encrypt_message` for the
+                message.
+            recipients: The recipients to deliver the message to later.
+
+        Returns:
+            The deferred message.
+        """
+
+        await self.__load()
+
+        message = DeferredMessage(os.urandom(8).hex(), stanza, identifier, recipients, time.time())
+
+        self.__messages[message.message_id] = message
+        await self.__persist(message)
+        await self.__store_index()
+
+        return message
+
+    async def update(self, message_id: str, recipients: FrozenSet[Recipient]) -> None:
+        """
+        Replace the pending recipients of a message. The message is removed from the queue if no recipients
+        remain.
+
+        Args:
+            message_id: The id of the deferred message.
+            recipients: The recipients that are still pending.
+        """
+
+        await self.__load()
+
+        message = self.__messages.get(message_id, None)
+        if message is None or message.recipients == recipients:
+            return
+
+        if len(recipients) == 0:
+            await self.remove(message_id)
+            return
+
+        message = message._replace(recipients=recipients)
+
+        self.__messages[message_id] = message
+        await self.__persist(message)
+
+    async def remove(self, message_id: str) -> None:
+        """
+        Remove a message from the queue.
+
+        Args:
+            message_id: The id of the deferred message.
+        """
+
+        await self.__load()
+
+        if self.__messages.pop(message_id, None) is not None:
+            await self.__storage.delete(f"/slixmpp/deferred_delivery/{message_id}")
+            await self.__store_index()
+
+    async def __load(self) -> None:
+        """
+        Load the deferred messages from the storage, once. Messages that are malformed or can't be decrypted
+        using the key are skipped and logged, but kept in the storage and in the index.
+        """
+
+        if self.__loaded:
+            return
+
+        async with self.__lock:
+            if self.__loaded:
+                return
+
+            message_ids = (await self.__storage.load_list(INDEX_KEY, str)).maybe([])
+
+            for message_id in message_ids:
+                key = f"/slixmpp/deferred_delivery/{message_id}"
+                serialized = (await self.__storage.load(key)).maybe(None)
+                if serialized is None:
+                    continue
+
+                try:
+                    self.__messages[message_id] = DeferredMessage.parse(
+                        message_id,
+                        self.__sealer.unseal(serialized, message_id)
+                    )
+                except Exception:  # pylint: disable=broad-exception-caught
+                    log.warning(
+                        f"Skipping deferred message {message_id}, which is malformed or can't be decrypted"
+                        " using the configured key.",
+                        exc_info=True
+                    )
+                    self.__unreadable.add(message_id)
+
+            self.__loaded = True
+
+            if len(self.__messages) + len(self.__unreadable) != len(message_ids):
+                await self.__store_index()
+
+    async def __persist(self, message: DeferredMessage) -> None:
+        """
+        Persist a deferred message, encrypted if an encryption key is configured. The message id is
+        authenticated along with the message.
+
+        Args:
+            message: The deferred message.
+        """
+
+        await self.__storage.store(
+            f"/slixmpp/deferred_delivery/{message.message_id}",
+            self.__sealer.seal(message.serialize(), message.message_id)
+        )
+
+    async def __store_index(self) -> None:
+        """
+        Persist the ids of the deferred messages, including those that could not be read.
+        """
+
+        await self.__storage.store(INDEX_KEY, [ *self.__messages, *sorted(self.__unreadable) ])
@@ -0,0 +1,129 @@
+import time
+from typing import AbstractSet, Dict, FrozenSet
+
+from omemo.storage import Storage
+
+
+__all__ = [
+    "DeviceActivity"
+]
+
+
+class DeviceActivity:
+    """
+    Tracks the last activity of the active devices of bare JIDs. Activity is recorded by the user of the
+    tracker, i.e. when a message from a device is decrypted, which includes key exchanges initiated by the
+    device. Devices are also active when they first appear in their owner's device lists, such that new
+    devices and devices that return to the device lists get a fresh grace period.
+
+    The activity is kept in the storage under ``/slixmpp/device_activity/<bare JID>`` and in memory. It is
+    recorded with a resolution of ``resolution`` seconds, such that a device that keeps sending messages
+    causes at most one write per resolution.
+
+    The plugin tracks activity once its ``inactive_device_max_age`` config option is set to a number of
+    seconds, and leaves devices that were not active for longer than that out of
+    :meth:`~slixmpp_omemo.XEP_0384.encrypt_message`. The other devices of the own account are never left out,
+    and neither are the devices of a bare JID whose devices are all inactive, or whose active devices are
+    unavailable. Inactive devices can't decrypt the messages sent while they were left out.
+    """
+
+    def __init__(self, storage: Storage, resolution: float = 60 * 60) -> None:
+        """
+        Args:
+            storage: The storage to keep the activity in.
+            resolution: The resolution of the recorded activity, in seconds.
+        """
+
+        self.__storage = storage
+        self.__resolution = resolution
+        self.__activity: Dict[str, Dict[int, float]] = {}
+
+    async def record(self, bare_jid: str, device_id: int) -> None:
+        """
+        Record that a device was active just now.
+
+        Args:
+            bare_jid: The bare JID of the device.
+            device_id: The id of the device.
+        """
+
+        activity = await self.__load(bare_jid)
+
+        now = time.time()
+        if now - activity.get(device_id, float("-inf")) >= self.__resolution:
+            activity[device_id] = now
+            await self.__store(bare_jid, activity)
+
+    async def last_activity(self, bare_jid: str) -> Dict[int, float]:
+        """
+        Args:
+            bare_jid: The bare JID.
+
+        Returns:
+            The time of the last recorded activity of each tracked device of the bare JID.
+        """
+
+        return dict(await self.__load(bare_jid))
+
+    async def inactive_devices(
+        self,
+        bare_jid: str,
+        active_device_ids: AbstractSet[int],
+        max_age: float
+    ) -> FrozenSet[int]:
+        """
+        Find the devices of a bare JID that were not active for more than ``max_age`` seconds. Devices that
+        are not tracked yet are recorded as active just now, devices that are no longer active are forgotten.
+
+        Args:
+            bare_jid: The bare JID.
+            active_device_ids: The ids of the devices of the bare JID that are active on any namespace.
+            max_age: The number of seconds without activity after which a device is inactive.
+
+        Returns:
+            The ids of the inactive devices. Empty if all devices are inactive, such that the bare JID always
+            retains devices to encrypt for.
+        """
+
+        activity = await self.__load(bare_jid)
+
+        now = time.time()
+        updated = { device_id: activity.get(device_id, now) for device_id in active_device_ids }
+        if updated != activity:
+            await self.__store(bare_jid, updated)
+
+        inactive = frozenset(device_id for device_id, last in updated.items() if now - last > max_age)
+
+        return frozenset() if inactive == frozenset(updated) else inactive
+
+    async def __load(self, bare_jid: str) -> Dict[int, float]:
+        """
+        Args:
+            bare_jid: The bare JID.
+
+        Returns:
+            The activity of the devices of the bare JID, loaded from the storage on first access.
+        """
+
+        activity = self.__activity.get(bare_jid)
+        if activity is None:
+            stored = await self.__storage.load_dict(f"/slixmpp/device_activity/{bare_jid}", float)
+            activity = { int(device_id): last for device_id, last in stored.maybe({}).items() }
+            self.__activity[bare_jid] = activity
+
+        return activity
+
+    async def __store(self, bare_jid: str, activity: Dict[int, float]) -> None:
+        """
+        Args:
+            bare_jid: The bare JID.
+            activity: The activity of the devices of the bare JID.
+        """
+
+        self.__activity[bare_jid] = activity
+
+        key = f"/slixmpp/device_activity/{bare_jid}"
+        if len(activity) > 0:
+            await self.__storage.store(key, { str(device_id): last for device_id, last in activity.items() })
+        else:
+            await self.__storage.delete(key)
@@ -0,0 +1,501 @@
+import base64
+import re
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+from xml.etree import ElementTree as ET
+
+from omemo import DeviceListDownloadFailed, EncryptedKeyMaterial, KeyExchange, Message, SenderNotFound
+from omemo.session_manager import SessionManager
+import oldmemo.oldmemo
+import twomemo.twomemo
+import x3dh
+import xeddsa
+
+
+__all__ = [
+    "parse_oldmemo_bundle",
+    "parse_oldmemo_device_list",
+    "parse_oldmemo_message",
+    "parse_twomemo_bundle",
+    "parse_twomemo_device_list",
+    "parse_twomemo_message"
+]
+
+
+TWOMEMO_NS = f"{{{twomemo.twomemo.NAMESPACE}}}"
+OLDMEMO_NS = f"{{{oldmemo.oldmemo.NAMESPACE}}}"
+
+UNSIGNED_INT_PATTERN = re.compile(r"\+?[0-9]+")
+UNSIGNED_INT_MAX = 0xFFFFFFFF
+
+
+def _expect_tag(element: ET.Element, tag: str) -> None:
+    """
+    Args:
+        element: The element to check.
+        tag: The expected tag, including the namespace.
+
+    Raises:
+        ValueError: if the tag of the element doesn't match.
+    """
+
+    if element.tag != tag:
+        raise ValueError(f"Unexpected element {element.tag}, expected {tag}")
+
+
+def _parse_all(
+    element: ET.Element,
+    required: FrozenSet[str],
+    optional: FrozenSet[str]
+) -> Dict[str, ET.Element]:
+    """
+    Check the children of an element against an ``xs:all`` group, in which each child may occur at most once.
+
+    Args:
+        element: The element whose children to check.
+        required: The tags of the children that have to occur exactly once.
+        optional: The tags of the children that may occur at most once.
+
+    Returns:
+        The children by tag.
+
+    Raises:
+        ValueError: if a child is unexpected, duplicated or missing.
+    """
+
+    children: Dict[str, ET.Element] = {}
+
+    for child in element:
+        if child.tag not in required and child.tag not in optional:
+            raise ValueError(f"Unexpected element {child.tag} in {element.tag}")
+        if child.tag in children:
+            raise ValueError(f"Duplicate element {child.tag} in {element.tag}")
+
+        children[child.tag] = child
+
+    missing = required - children.keys()
+    if missing:
+        raise ValueError(f"Missing elements in {element.tag}: {', '.join(sorted(missing))}")
+
+    return children
+
+
+def _parse_unsigned_int(element: ET.Element, attribute: str) -> int:
+    """
+    Args:
+        element: The element holding the attribute.
+        attribute: The name of the attribute to parse as an ``xs:unsignedInt``.
+
+    Returns:
+        The value of the attribute.
+
+    Raises:
+        ValueError: if the attribute is missing or not an ``xs:unsignedInt``.
+    """
+
+    value = element.get(attribute)
+    if value is None:
+        raise ValueError(f"Missing attribute {attribute} on {element.tag}")
+
+    value = value.strip()
+    if UNSIGNED_INT_PATTERN.fullmatch(value) is None or int(value) > UNSIGNED_INT_MAX:
+        raise ValueError(f"Attribute {attribute} on {element.tag} is not an unsigned 32-bit integer: {value}")
+
+    return int(value)
+
+
+def _parse_boolean(element: ET.Element, attribute: str) -> bool:
+    """
+    Args:
+        element: The element holding the attribute.
+        attribute: The name of the optional attribute to parse as an ``xs:boolean``.
+
+    Returns:
+        The value of the attribute, ``False`` if it is missing.
+
+    Raises:
+        ValueError: if the attribute is not an ``xs:boolean``.
+    """
+
+    value = element.get(attribute, "false").strip()
+    if value not in { "true", "false", "1", "0" }:
+        raise ValueError(f"Attribute {attribute} on {element.tag} is not a boolean: {value}")
+
+    return value in { "true", "1" }
+
+
+def _parse_base64(element: ET.Element) -> bytes:
+    """
+    Args:
+        element: The element whose text to parse as ``xs:base64Binary``.
+
+    Returns:
+        The decoded text.
+
+    Raises:
+        ValueError: if the element has children, or if its text is missing or not valid base64.
+    """
+
+    if len(element) > 0:
+        raise ValueError(f"Unexpected children in {element.tag}")
+    if not element.text:
+        raise ValueError(f"Missing content in {element.tag}")
+
+    # binascii.Error is a subclass of ValueError
+    return base64.b64decode("".join(element.text.split()), validate=True)
+
+
+def parse_twomemo_device_list(element: ET.Element) -> Dict[int, Optional[str]]:
+    """
+    Structural counterpart of :func:`twomemo.etree.parse_device_list`.
+
+    Args:
+        element: The XML element to parse the device list from.
+
+    Returns:
+        The extracted device list. The key is the device id, the value is the optional label.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification.
+    """
+
+    _expect_tag(element, f"{TWOMEMO_NS}devices")
+
+    device_list: Dict[int, Optional[str]] = {}
+    for device_elt in element:
+        _expect_tag(device_elt, f"{TWOMEMO_NS}device")
+        device_list[_parse_unsigned_int(device_elt, "id")] = device_elt.get("label", None)
+
+    return device_list
+
+
+def parse_twomemo_bundle(element: ET.Element, bare_jid: str, device_id: int) -> twomemo.twomemo.BundleImpl:
+    """
+    Structural counterpart of :func:`twomemo.etree.parse_bundle`.
+
+    Args:
+        element: The XML element to parse the bundle from.
+        bare_jid: The bare JID this bundle belongs to.
+        device_id: The device id of the specific device this bundle belongs to.
+
+    Returns:
+        The extracted bundle.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification.
+    """
+
+    _expect_tag(element, f"{TWOMEMO_NS}bundle")
+
+    children = _parse_all(
+        element,
+        frozenset({ f"{TWOMEMO_NS}spk", f"{TWOMEMO_NS}spks", f"{TWOMEMO_NS}ik", f"{TWOMEMO_NS}prekeys" }),
+        frozenset()
+    )
+
+    spk_elt = children[f"{TWOMEMO_NS}spk"]
+    prekeys_elt = children[f"{TWOMEMO_NS}prekeys"]
+
+    if len(prekeys_elt) == 0:
+        raise ValueError(f"Missing elements in {prekeys_elt.tag}: {TWOMEMO_NS}pk")
+
+    pre_key_ids: Dict[bytes, int] = {}
+    for pk_elt in prekeys_elt:
+        _expect_tag(pk_elt, f"{TWOMEMO_NS}pk")
+        pre_key_ids[_parse_base64(pk_elt)] = _parse_unsigned_int(pk_elt, "id")
+
+    return twomemo.twomemo.BundleImpl(
+        bare_jid,
+        device_id,
+        x3dh.Bundle(
+            _parse_base64(children[f"{TWOMEMO_NS}ik"]),
+            _parse_base64(spk_elt),
+            _parse_base64(children[f"{TWOMEMO_NS}spks"]),
+            frozenset(pre_key_ids.keys())
+        ),
+        _parse_unsigned_int(spk_elt, "id"),
+        pre_key_ids
+    )
+
+
+def parse_twomemo_message(element: ET.Element, bare_jid: str) -> Message:
+    """
+    Structural counterpart of :func:`twomemo.etree.parse_message`.
+
+    Args:
+        element: The XML element to parse the message from.
+        bare_jid: The bare JID of the sender.
+
+    Returns:
+        The extracted message.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification, or in case
+            of malformed key material.
+    """
+
+    _expect_tag(element, f"{TWOMEMO_NS}encrypted")
+
+    children = _parse_all(
+        element,
+        frozenset({ f"{TWOMEMO_NS}header" }),
+        frozenset({ f"{TWOMEMO_NS}payload" })
+    )
+
+    header_elt = children[f"{TWOMEMO_NS}header"]
+    payload_elt = children.get(f"{TWOMEMO_NS}payload", None)
+
+    if len(header_elt) == 0:
+        raise ValueError(f"Missing elements in {header_elt.tag}: {TWOMEMO_NS}keys")
+
+    keys: Set[Tuple[EncryptedKeyMaterial, Optional[KeyExchange]]] = set()
+    for keys_elt in header_elt:
+        _expect_tag(keys_elt, f"{TWOMEMO_NS}keys")
+
+        recipient_bare_jid = keys_elt.get("jid")
+        if recipient_bare_jid is None:
+            raise ValueError(f"Missing attribute jid on {keys_elt.tag}")
+
+        if len(keys_elt) == 0:
+            raise ValueError(f"Missing elements in {keys_elt.tag}: {TWOMEMO_NS}key")
+
+        for key_elt in keys_elt:
+            _expect_tag(key_elt, f"{TWOMEMO_NS}key")
+
+            recipient_device_id = _parse_unsigned_int(key_elt, "rid")
+            content = _parse_base64(key_elt)
+
+            key_exchange: Optional[twomemo.twomemo.KeyExchangeImpl] = None
+            authenticated_message: bytes
+            if _parse_boolean(key_elt, "kex"):
+                key_exchange, authenticated_message = twomemo.twomemo.KeyExchangeImpl.parse(content)
+            else:
+                authenticated_message = content
+
+            keys.add((twomemo.twomemo.EncryptedKeyMaterialImpl.parse(
+                authenticated_message,
+                recipient_bare_jid,
+                recipient_device_id
+            ), key_exchange))
+
+    return Message(
+        twomemo.twomemo.NAMESPACE,
+        bare_jid,
+        _parse_unsigned_int(header_elt, "sid"),
+        (
+            twomemo.twomemo.ContentImpl.make_empty()
+            if payload_elt is None
+            else twomemo.twomemo.ContentImpl(_parse_base64(payload_elt))
+        ),
+        frozenset(keys)
+    )
+
+
+def parse_oldmemo_device_list(element: ET.Element) -> Dict[int, Optional[str]]:
+    """
+    Structural counterpart of :func:`oldmemo.etree.parse_device_list`.
+
+    Args:
+        element: The XML element to parse the device list from.
+
+    Returns:
+        The extracted device list. The key is the device id, the value is the label, which is always ``None``
+        since labels are not supported by this version of the specification.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification.
+    """
+
+    _expect_tag(element, f"{OLDMEMO_NS}list")
+
+    device_list: Dict[int, Optional[str]] = {}
+    for device_elt in element:
+        _expect_tag(device_elt, f"{OLDMEMO_NS}device")
+        device_list[_parse_unsigned_int(device_elt, "id")] = None
+
+    return device_list
+
+
+def parse_oldmemo_bundle(element: ET.Element, bare_jid: str, device_id: int) -> oldmemo.oldmemo.BundleImpl:
+    """
+    Structural counterpart of :func:`oldmemo.etree.parse_bundle`.
+
+    Args:
+        element: The XML element to parse the bundle from.
+        bare_jid: The bare JID this bundle belongs to.
+        device_id: The device id of the specific device this bundle belongs to.
+
+    Returns:
+        The extracted bundle.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification, or in case
+            of malformed key material.
+    """
+
+    _expect_tag(element, f"{OLDMEMO_NS}bundle")
+
+    children = _parse_all(element, frozenset({
+        f"{OLDMEMO_NS}signedPreKeyPublic",
+        f"{OLDMEMO_NS}signedPreKeySignature",
+        f"{OLDMEMO_NS}identityKey",
+        f"{OLDMEMO_NS}prekeys"
+    }), frozenset())
+
+    spkp_elt = children[f"{OLDMEMO_NS}signedPreKeyPublic"]
+    prekeys_elt = children[f"{OLDMEMO_NS}prekeys"]
+
+    signed_pre_key_signature = _parse_base64(children[f"{OLDMEMO_NS}signedPreKeySignature"])
+    if len(signed_pre_key_signature) != 64:
+        raise ValueError("Signed pre key signature has an unexpected length.")
+
+    # The sign bit of the identity key is stored in the most significant bit of the signature
+    identity_key = xeddsa.curve25519_pub_to_ed25519_pub(
+        oldmemo.oldmemo.StateImpl.parse_public_key(_parse_base64(children[f"{OLDMEMO_NS}identityKey"])),
+        bool((signed_pre_key_signature[63] >> 7) & 1)
+    )
+
+    signed_pre_key_signature_mut = bytearray(signed_pre_key_signature)
+    signed_pre_key_signature_mut[63] &= 0x7f
+    signed_pre_key_signature = bytes(signed_pre_key_signature_mut)
+
+    if len(prekeys_elt) == 0:
+        raise ValueError(f"Missing elements in {prekeys_elt.tag}: {OLDMEMO_NS}preKeyPublic")
+
+    pre_key_ids: Dict[bytes, int] = {}
+    for pkp_elt in prekeys_elt:
+        _expect_tag(pkp_elt, f"{OLDMEMO_NS}preKeyPublic")
+        pre_key_ids[oldmemo.oldmemo.StateImpl.parse_public_key(_parse_base64(pkp_elt))] = \
+            _parse_unsigned_int(pkp_elt, "preKeyId")
+
+    return oldmemo.oldmemo.BundleImpl(
+        bare_jid,
+        device_id,
+        x3dh.Bundle(
+            identity_key,
+            oldmemo.oldmemo.StateImpl.parse_public_key(_parse_base64(spkp_elt)),
+            signed_pre_key_signature,
+            frozenset(pre_key_ids.keys())
+        ),
+        _parse_unsigned_int(spkp_elt, "signedPreKeyId"),
+        pre_key_ids
+    )
+
+
+async def parse_oldmemo_message(
+    element: ET.Element,
+    sender_bare_jid: str,
+    own_bare_jid: str,
+    session_manager: SessionManager
+) -> Message:
+    """
+    Structural counterpart of :func:`oldmemo.etree.parse_message`. The structure is checked before the
+    information about the sending device is looked up, such that malformed messages never trigger a device
+    list refresh.
+
+    Args:
+        element: The XML element to parse the message from.
+        sender_bare_jid: The bare JID of the sender.
+        own_bare_jid: The bare JID of the XMPP account decrypting this message, i.e. us.
+        session_manager: The session manager instance is required to find one piece of information that the
+            oldmemo message serialization format lacks with regards to the identity key.
+
+    Returns:
+        The extracted message.
+
+    Raises:
+        ValueError: in case the element does not match the structure given in the specification, or in case
+            of malformed key material.
+        SenderNotFound: in case the public information about the sending device could not be found or is
+            incomplete.
+    """
+
+    _expect_tag(element, f"{OLDMEMO_NS}encrypted")
+
+    children = _parse_all(
+        element,
+        frozenset({ f"{OLDMEMO_NS}header" }),
+        frozenset({ f"{OLDMEMO_NS}payload" })
+    )
+
+    header_elt = children[f"{OLDMEMO_NS}header"]
+    payload_elt = children.get(f"{OLDMEMO_NS}payload", None)
+
+    sender_device_id = _parse_unsigned_int(header_elt, "sid")
+
+    # Key elements may occur any number of times, the iv exactly once
+    key_elts = []
+    iv_elt: Optional[ET.Element] = None
+    for child in header_elt:
+        if child.tag == f"{OLDMEMO_NS}key":
+            key_elts.append((_parse_unsigned_int(child, "rid"), _parse_boolean(child, "prekey"), child))
+        elif child.tag == f"{OLDMEMO_NS}iv" and iv_elt is None:
+            iv_elt = child
+        else:
+            raise ValueError(f"Unexpected element {child.tag} in {header_elt.tag}")
+
+    if iv_elt is None:
+        raise ValueError(f"Missing elements in {header_elt.tag}: {OLDMEMO_NS}iv")
+
+    initialization_vector = _parse_base64(iv_elt)
+    ciphertext = None if payload_elt is None else _parse_base64(payload_elt)
+    key_contents = [ (rid, prekey, _parse_base64(key_elt)) for rid, prekey, key_elt in key_elts ]
+
+    sender_device = next((
+        device
+        for device
+        in await session_manager.get_device_information(sender_bare_jid)
+        if device.device_id == sender_device_id
+    ), None)
+
+    if sender_device is None:
+        try:
+            # If the device wasn't found, refresh the device list
+            await session_manager.refresh_device_list(oldmemo.oldmemo.NAMESPACE, sender_bare_jid)
+        except DeviceListDownloadFailed as e:
+            raise SenderNotFound(
+                "Couldn't find public information about the device which sent this message and an attempt to"
+                " refresh the sender's device list failed."
+            ) from e
+
+        sender_device = next((
+            device
+            for device
+            in await session_manager.get_device_information(sender_bare_jid)
+            if device.device_id == sender_device_id
+        ), None)
+
+    if sender_device is None:
+        raise SenderNotFound(
+            "Couldn't find public information about the device which sent this message. I.e. the device"
+            " either does not appear in the device list of the sending XMPP account, or the bundle of the"
+            " sending device could not be downloaded."
+        )
+
+    set_sign_bit = bool((sender_device.identity_key[31] >> 7) & 1)
+
+    keys: Set[Tuple[EncryptedKeyMaterial, Optional[KeyExchange]]] = set()
+    for recipient_device_id, prekey, content in key_contents:
+        key_exchange: Optional[oldmemo.oldmemo.KeyExchangeImpl] = None
+        authenticated_message: bytes
+        if prekey:
+            key_exchange, authenticated_message = oldmemo.oldmemo.KeyExchangeImpl.parse(content, set_sign_bit)
+        else:
+            authenticated_message = content
+
+        keys.add((oldmemo.oldmemo.EncryptedKeyMaterialImpl.parse(
+            authenticated_message,
+            own_bare_jid,
+            recipient_device_id
+        ), key_exchange))
+
+    return Message(
+        oldmemo.oldmemo.NAMESPACE,
+        sender_bare_jid,
+        sender_device_id,
+        (
+            oldmemo.oldmemo.ContentImpl.make_empty()
+            if ciphertext is None
+            else oldmemo.oldmemo.ContentImpl(ciphertext, initialization_vector)
+        ),
+        frozenset(keys)
+    )
@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AbstractSet, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from omemo.storage import Storage
+
+from .device_activity import DeviceActivity
+
+
+__all__ = [
+    "GarbageCollectionResult",
+    "GarbageCollector"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+SESSION_KEYS = (
+    "initiation",
+    "key_exchange/identity_key",
+    "key_exchange/ephemeral_key",
+    "key_exchange/signed_pre_key",
+    "key_exchange/signed_pre_key_id",
+    "key_exchange/pre_key",
+    "key_exchange/pre_key_id",
+    "associated_data",
+    "double_ratchet",
+    "confirmed"
+)
+"""
+The keys of a session below ``/<namespace>/<bare JID>/<device id>/``, identical for oldmemo and twomemo.
+"""
+
+DEVICE_KEYS = (
+    "namespaces",
+    "active",
+    "label",
+    "identity_key"
+)
+"""
+The keys of the device information below ``/devices/<bare JID>/<device id>/``.
+"""
+
+
+class GarbageCollectionResult(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The outcome of a garbage collection run.
+    """
+
+    devices: int
+    keys: int
+    size: int
+    sessions: int = 0
+
+
+class GarbageCollector:
+    """
+    Purges the sessions and device information of devices that were removed from the device lists of their
+    owners a while ago, or whose sessions are no longer backed by device information at all. Given a
+    :class:`~slixmpp_omemo.device_activity.DeviceActivity`, it also purges the sessions of devices that are
+    still listed but were not active for a while.
+
+    The library keeps all data of a device forever, even after the device disappeared from its owner's device
+    lists, such that storage grows with every device ever seen. It does not record when devices were last
+    active, thus the collector records when it first observed a device to be inactive on all namespaces, i.e.
+    removed from all of its owner's device lists, and purges the device once it was removed for longer than
+    the configured age. Devices that are active again in the meantime are forgotten by the collector.
+
+    Devices that stay in their owner's device lists are never considered removed, no matter how long they
+    were silent. Without a device activity tracker, their data is kept forever. With a tracker, the sessions
+    of listed devices whose last recorded activity is older than the configured age are purged, while their
+    device information is kept. Listed devices without recorded activity, including the devices of the own
+    account, are left alone. A new session is built with the device on the next encryption for it, messages
+    it still sends using the purged session can't be decrypted.
+
+    Trust decisions are kept, such that a purged device that reappears with the same identity key retains its
+    trust level. The device's identity key is fetched again from its bundle in that case.
+
+    The plugin runs :meth:`~slixmpp_omemo.XEP_0384.collect_garbage` every ``garbage_collection_interval``
+    seconds once its ``garbage_collection`` config option is set to ``True``, purging devices that have been
+    inactive for more than ``garbage_collection_max_inactive_age`` seconds, ``garbage_collection_batch_size``
+    devices at a time.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        namespaces: Iterable[str],
+        own_bare_jid: str,
+        own_device_id: int,
+        device_activity: Optional[DeviceActivity] = None
+    ) -> None:
+        """
+        Args:
+            storage: The storage used by the session manager.
+            namespaces: The namespaces of the loaded backends, whose sessions to purge.
+            own_bare_jid: The bare JID of this account.
+            own_device_id: The device id of this device, which is never purged.
+            device_activity: The activity tracker of the devices, to purge the sessions of listed devices that
+                were not active for longer than the max inactive age. Omit to purge removed devices only.
+        """
+
+        self.__storage = storage
+        self.__namespaces = frozenset(namespaces)
+        self.__own_bare_jid = own_bare_jid
+        self.__own_device_id = own_device_id
+        self.__device_activity = device_activity
+
+    async def collect(
+        self,
+        bare_jids: Iterable[str] = (),
+        max_inactive_age: float = 90 * 24 * 60 * 60,
+        batch_size: int = 100
+    ) -> GarbageCollectionResult:
+        """
+        Find devices to purge and purge them in batches. The event loop is yielded to between batches.
+
+        Args:
+            bare_jids: Bare JIDs to check in addition to those with sessions and this account's bare JID, e.g.
+                those whose device lists are subscribed to.
+            max_inactive_age: The number of seconds a device has to be removed from all device lists for its
+                data to be purged. Zero purges devices on the first run after their removal. With a device
+                activity tracker, also the number of seconds since the last activity of a listed device for
+                its sessions to be purged.
+            batch_size: The maximum number of devices to purge per batch.
+
+        Returns:
+            The number of purged devices, the number and JSON-serialized size of the deleted values, and the
+            number of listed devices whose sessions were purged.
+
+        Warning:
+            Device list updates for a bare JID that are processed while its devices are purged may be lost.
+            Run the collector while the client is idle, e.g. during off-peak hours.
+        """
+
+        now = time.time()
+
+        candidates: List[Tuple[str, int]] = []
+        session_candidates: List[Tuple[str, int]] = []
+        for bare_jid in sorted(await self.__bare_jids(bare_jids)):
+            purge, purge_sessions = await self.__find(bare_jid, now, max_inactive_age)
+            candidates.extend((bare_jid, device_id) for device_id in sorted(purge))
+            session_candidates.extend((bare_jid, device_id) for device_id in sorted(purge_sessions))
+
+        keys = 0
+        size = 0
+        for targets, sessions_only in ((candidates, False), (session_candidates, True)):
+            for start in range(0, len(targets), batch_size):
+                batch_keys, batch_bytes = await self.__purge(targets[start:start + batch_size], sessions_only)
+                keys += batch_keys
+                size += batch_bytes
+
+                await asyncio.sleep(0)
+
+        devices = len(candidates)
+        sessions = len(session_candidates)
+
+        log.info(
+            f"Garbage collection purged {devices} devices and the sessions of {sessions} inactive devices,"
+            f" reclaiming {keys} keys and {size} bytes."
+        )
+
+        return GarbageCollectionResult(devices, keys, size, sessions)
+
+    async def __bare_jids(self, bare_jids: Iterable[str]) -> Set[str]:
+        """
+        Args:
+            bare_jids: Additional bare JIDs to check.
+
+        Returns:
+            The bare JIDs to check for devices to purge.
+        """
+
+        result = set(bare_jids) | { self.__own_bare_jid }
+        for namespace in self.__namespaces:
+            result.update((await self.__storage.load_list(f"/{namespace}/bare_jids", str)).maybe([]))
+
+        return result
+
+    async def __find(
+        self,
+        bare_jid: str,
+        now: float,
+        max_inactive_age: float
+    ) -> Tuple[FrozenSet[int], FrozenSet[int]]:
+        """
+        Update the times devices of a bare JID were first observed to be inactive and find the devices to
+        purge.
+
+        Args:
+            bare_jid: The bare JID.
+            now: The current time.
+            max_inactive_age: The number of seconds a device has to be inactive for its data to be purged.
+
+        Returns:
+            The ids of the devices to purge, and the ids of the listed devices to purge the sessions of.
+        """
+
+        storage = self.__storage
+
+        device_list = frozenset((await storage.load_list(f"/devices/{bare_jid}/list", int)).maybe([]))
+
+        inactive_since_key = f"/slixmpp/gc/{bare_jid}"
+        stored_inactive_since = (await storage.load_dict(inactive_since_key, float)).maybe({})
+        inactive_since: Dict[str, float] = {}
+
+        # The own account's devices are not tracked, see XEP_0384._record_device_activity
+        last_activity: Dict[int, float] = {}
+        if self.__device_activity is not None:
+            last_activity = await self.__device_activity.last_activity(bare_jid)
+
+        purge: Set[int] = set()
+        purge_sessions: Set[int] = set()
+        for device_id in device_list:
+            if bare_jid == self.__own_bare_jid and device_id == self.__own_device_id:
+                continue
+
+            active = (await storage.load_dict(f"/devices/{bare_jid}/{device_id}/active", bool)).maybe({})
+            if any(active.values()):
+                if now - last_activity.get(device_id, now) > max_inactive_age:
+                    purge_sessions.add(device_id)
+                continue
+
+            since = stored_inactive_since.get(str(device_id), now)
+            if now - since >= max_inactive_age:
+                purge.add(device_id)
+            else:
+                inactive_since[str(device_id)] = since
+
+        # Sessions without device information, e.g. left behind by purging a bare JID while a backend was
+        # not loaded
+        for namespace in self.__namespaces:
+            purge.update(
+                device_id
+                for device_id
+                in (await storage.load_list(f"/{namespace}/{bare_jid}/device_ids", int)).maybe([])
+                if device_id not in device_list
+                and not (bare_jid == self.__own_bare_jid and device_id == self.__own_device_id)
+            )
+
+        if inactive_since != stored_inactive_since:
+            if len(inactive_since) > 0:
+                await storage.store(inactive_since_key, inactive_since)
+            else:
+                await storage.delete(inactive_since_key)
+
+        return frozenset(purge), frozenset(purge_sessions)
+
+    async def __purge(self, devices: List[Tuple[str, int]], sessions_only: bool) -> Tuple[int, int]:
+        """
+        Purge the sessions and device information of a batch of devices. The devices are removed from the
+        lists referencing them first, such that an interrupted purge leaves unreferenced values behind at
+        worst. The values of the batch are deleted concurrently afterwards.
+
+        Args:
+            devices: The bare JIDs and ids of the devices to purge.
+            sessions_only: Whether to purge the sessions only, keeping the devices listed with their
+                information.
+
+        Returns:
+            The number and JSON-serialized size of the deleted values.
+        """
+
+        by_bare_jid: Dict[str, Set[int]] = {}
+        for bare_jid, device_id in devices:
+            by_bare_jid.setdefault(bare_jid, set()).add(device_id)
+
+        for bare_jid, device_ids in by_bare_jid.items():
+            # A device that reappears later on is treated like a new device
+            if not sessions_only:
+                await self.__remove_from_list(f"/devices/{bare_jid}/list", device_ids)
+
+            # The bare JID is kept in the backend's list of bare JIDs with sessions even if no sessions
+            # remain, since the backends expect it there when purging the bare JID
+            for namespace in self.__namespaces:
+                await self.__remove_from_list(f"/{namespace}/{bare_jid}/device_ids", device_ids)
+
+        keys: List[str] = [] if sessions_only else [
+            f"/devices/{bare_jid}/{device_id}/{key}"
+            for bare_jid, device_id in devices
+            for key in DEVICE_KEYS
+        ]
+        keys.extend(
+            f"/{namespace}/{bare_jid}/{device_id}/{key}"
+            for namespace in sorted(self.__namespaces)
+            for bare_jid, device_id in devices
+            for key in SESSION_KEYS
+        )
+
+        sizes = [
+            size
+            for size
+            in await asyncio.gather(*(self.__delete(key) for key in keys))
+            if size is not None
+        ]
+
+        return len(sizes), sum(sizes)
+
+    async def __delete(self, key: str) -> Optional[int]:
+        """
+        Args:
+            key: The key to delete.
+
+        Returns:
+            The JSON-serialized size of the deleted value, or ``None`` if the key did not exist.
+        """
+
+        value = await self.__storage.load(key)
+        if value.is_nothing:
+            return None
+
+        await self.__storage.delete(key)
+
+        return len(json.dumps(value.from_just()))
+
+    async def __remove_from_list(self, key: str, items: AbstractSet[object]) -> None:
+        """
+        Remove items from a list stored under a key. The key is deleted if the list becomes empty.
+
+        Args:
+            key: The key.
+            items: The items to remove.
+        """
+
+        stored = (await self.__storage.load(key)).maybe(None)
+        if not isinstance(stored, list):
+            return
+
+        remaining = [ item for item in stored if item not in items ]
+        if len(remaining) == 0:
+            await self.__storage.delete(key)
+        elif len(remaining) != len(stored):
+            await self.__storage.store(key, remaining)
@@ -0,0 +1,504 @@
+import asyncio
+import enum
+import json
+import logging
+import os
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "FsyncPolicy",
+    "LogStorage"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+@enum.unique
+class FsyncPolicy(enum.Enum):
+    """
+    When to force writes of a :class:`LogStorage` to disk.
+    """
+
+    ALWAYS = "ALWAYS"
+    BATCH = "BATCH"
+    INTERVAL = "INTERVAL"
+
+
+class Entry(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The location of the latest record of a key in the log.
+    """
+
+    offset: int
+    length: int
+    value_length: int
+
+
+class LogStorage(Storage):
+    """
+    File-based storage that appends a record to a log for every store and delete, instead of rewriting all
+    data on every write. The location of the latest record of each key is kept in memory, values are read from
+    the log on demand.
+
+    Each record is a line of ASCII text: ``S <key> <value>`` for stores and ``D <key>`` for deletes, with key
+    and value serialized as JSON. On opening, the log is replayed to rebuild the index, which only parses the
+    keys. A record at the end of the log that was only written partially, e.g. because of a crash, is cut off.
+    Since every record ends with a newline and serialized JSON doesn't contain any, a record that was only
+    written partially is missing its newline. Complete records that are malformed indicate corruption of the
+    log and are rejected.
+
+    Once the records superseded by later stores and deletes make up more than a configurable share of the log,
+    the log is compacted in the background: the latest records are copied to a new log, yielding to the event
+    loop in between, and the new log replaces the old one atomically. Writes performed during the compaction
+    are carried over.
+
+    Writes are handed to the operating system right away. When they are forced to disk is configured using an
+    :class:`FsyncPolicy`: after every write, after every ``fsync_batch_size`` writes, or at the latest
+    ``fsync_interval`` seconds after a write. Writes that were not forced to disk yet can be lost if the
+    operating system crashes. The fsyncs run in the default executor, such that they don't block the event
+    loop, and concurrent writes waiting for an fsync share it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fsync_policy: FsyncPolicy = FsyncPolicy.ALWAYS,
+        fsync_batch_size: int = 100,
+        fsync_interval: float = 1.0,
+        compaction_ratio: float = 1.0,
+        compaction_min_size: int = 1024 * 1024,
+        disable_cache: bool = False
+    ) -> None:
+        """
+        Open the log, creating it if it doesn't exist, and replay it.
+
+        Args:
+            path: The path of the log file.
+            fsync_policy: When to force writes to disk.
+            fsync_batch_size: The number of writes per fsync with :attr:`FsyncPolicy.BATCH`.
+            fsync_interval: The maximum time in seconds between a write and the fsync with
+                :attr:`FsyncPolicy.INTERVAL`.
+            compaction_ratio: Compact once the size of superseded records exceeds the size of the latest
+                records multiplied by this ratio...
+            compaction_min_size: ...and the log is larger than this size in bytes.
+            disable_cache: Whether to disable the cache of :class:`~omemo.storage.Storage`. Disable it if the
+                storage is wrapped in another cache, e.g.
+                :class:`~slixmpp_omemo.caching_storage.CachingStorage`.
+
+        Raises:
+            ValueError: if the log contains a malformed complete record.
+        """
+
+        super().__init__(disable_cache)
+
+        self.__path = path
+        self.__fsync_policy = fsync_policy
+        self.__fsync_batch_size = fsync_batch_size
+        self.__fsync_interval = fsync_interval
+        self.__compaction_ratio = compaction_ratio
+        self.__compaction_min_size = compaction_min_size
+
+        self.__index: Dict[str, Entry] = {}
+        self.__size = 0
+        self.__live_size = 0
+        self.__unsynced_writes = 0
+        self.__fsync_handle: Optional[asyncio.TimerHandle] = None
+        self.__fsync_task: Optional[asyncio.Task[None]] = None
+        self.__fsync_lock = asyncio.Lock()
+        self.__compaction_task: Optional[asyncio.Task[None]] = None
+        self.__compacting = False
+
+        self.__file = self.__open()
+        try:
+            self.__replay()
+        except ValueError:
+            self.__file.close()
+            raise
+
+    @property
+    def size(self) -> int:
+        """
+        Returns:
+            The size of the log in bytes.
+        """
+
+        return self.__size
+
+    @property
+    def live_size(self) -> int:
+        """
+        Returns:
+            The size of the latest records of all stored keys in bytes.
+        """
+
+        return self.__live_size
+
+    def keys(self) -> Iterator[str]:
+        """
+        Returns:
+            The stored keys. The storage must not be written to while iterating.
+        """
+
+        return iter(self.__index)
+
+    def sync(self) -> None:
+        """
+        Force all writes to disk. Blocks until done, unlike the fsyncs performed according to the
+        :class:`FsyncPolicy`.
+        """
+
+        if self.__fsync_handle is not None:
+            self.__fsync_handle.cancel()  # pylint: disable=no-member
+            self.__fsync_handle = None
+
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__unsynced_writes = 0
+
+    def close(self) -> None:
+        """
+        Force all writes to disk and close the log. A compaction in progress is abandoned.
+        """
+
+        if self.__compaction_task is not None:
+            self.__compaction_task.cancel()  # pylint: disable=no-member
+            self.__compaction_task = None
+
+        if self.__fsync_task is not None:
+            self.__fsync_task.cancel()  # pylint: disable=no-member
+            self.__fsync_task = None
+
+        self.sync()
+        self.__file.close()
+
+    async def compact(self) -> None:
+        """
+        Copy the latest records to a new log, which then replaces the current log. Does nothing if a
+        compaction is in progress already.
+        """
+
+        if self.__compacting:
+            return
+
+        self.__compacting = True
+        try:
+            await self.__compact()
+        finally:
+            self.__compacting = False
+
+    async def __compact(self) -> None:
+        """
+        Implementation of :meth:`compact`.
+        """
+
+        compacted_path = f"{self.__path}.compact"
+        snapshot = dict(self.__index)
+        snapshot_size = self.__size
+
+        index: Dict[str, Entry] = {}
+        size = 0
+
+        with open(compacted_path, "wb") as compacted:
+            for i, (key, entry) in enumerate(snapshot.items()):
+                record = self.__read(entry.offset, entry.length)
+                compacted.write(record)
+                index[key] = Entry(size, entry.length, entry.value_length)
+                size += entry.length
+
+                # Give writes a chance in between
+                if i % 100 == 99:
+                    await asyncio.sleep(0)
+
+            # Wait for fsyncs of the current log in progress, none are started until it is replaced. From here
+            # on, nothing yields to the event loop. Carry over the records written since the snapshot.
+            async with self.__fsync_lock:
+                self.__file.flush()
+                tail = self.__read(snapshot_size, self.__size - snapshot_size)
+                for offset, record in _records(tail):
+                    tail_key, tail_entry = _parse(record, size + offset)
+                    if tail_entry is None:
+                        index.pop(tail_key, None)
+                    else:
+                        index[tail_key] = tail_entry
+                compacted.write(tail)
+                size += len(tail)
+
+                compacted.flush()
+                os.fsync(compacted.fileno())
+
+                self.__file.close()
+                os.replace(compacted_path, self.__path)
+                _fsync_directory(self.__path)
+
+                self.__file = self.__open()
+                self.__index = index
+                self.__size = size
+                self.__live_size = sum(entry.length for entry in index.values())
+                self.__unsynced_writes = 0
+
+        log.debug(f"Compacted {self.__path} from {snapshot_size + len(tail)} to {size} bytes.")
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        entry = self.__index.get(key, None)
+        if entry is None:
+            return Nothing()
+
+        record = self.__read(entry.offset, entry.length)
+
+        return Just(json.loads(record[entry.length - 1 - entry.value_length:-1]))
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        key_json = json.dumps(key)
+        value_json = json.dumps(value)
+
+        await self.__append(key, f"S {key_json} {value_json}\n".encode("ASCII"), len(value_json))
+
+    async def _delete(self, key: str) -> None:
+        if key in self.__index:
+            await self.__append(key, f"D {json.dumps(key)}\n".encode("ASCII"), None)
+
+    def __open(self) -> BinaryIO:
+        """
+        Returns:
+            The log file, opened for appending and reading.
+        """
+
+        return open(self.__path, "a+b")
+
+    def __read(self, offset: int, length: int) -> bytes:
+        """
+        Args:
+            offset: The offset in the log.
+            length: The number of bytes to read.
+
+        Returns:
+            The bytes read.
+        """
+
+        self.__file.seek(offset)
+
+        return self.__file.read(length)
+
+    def __replay(self) -> None:
+        """
+        Rebuild the index from the log. A partially written record at the end of the log is cut off.
+
+        Raises:
+            ValueError: if the log contains a malformed complete record.
+        """
+
+        self.__file.seek(0)
+        data = self.__file.read()
+
+        for offset, record in _records(data):
+            try:
+                key, entry = _parse(record, offset)
+            except ValueError as e:
+                raise ValueError(
+                    f"Malformed record at offset {offset} of {self.__path}, the log is corrupt."
+                ) from e
+
+            previous = self.__index.pop(key, None)
+            if previous is not None:
+                self.__live_size -= previous.length
+
+            if entry is not None:
+                self.__index[key] = entry
+                self.__live_size += entry.length
+
+            self.__size = offset + len(record)
+
+        if self.__size < len(data):
+            log.warning(
+                f"Cutting off {len(data) - self.__size} bytes at the end of {self.__path}, which don't form a"
+                f" complete record."
+            )
+
+            self.__file.truncate(self.__size)
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+
+    async def __append(self, key: str, record: bytes, value_length: Optional[int]) -> None:
+        """
+        Append a record to the log and update the index. Waits for the fsync if one is due according to the
+        :class:`FsyncPolicy`.
+
+        Args:
+            key: The key the record belongs to.
+            record: The record.
+            value_length: The length of the serialized value for store records, ``None`` for delete records.
+        """
+
+        self.__file.write(record)
+        self.__file.flush()
+
+        previous = self.__index.pop(key, None)
+        if previous is not None:
+            self.__live_size -= previous.length
+
+        if value_length is not None:
+            self.__index[key] = Entry(self.__size, len(record), value_length)
+            self.__live_size += len(record)
+
+        self.__size += len(record)
+        self.__unsynced_writes += 1
+
+        garbage_size = self.__size - self.__live_size
+        if (
+            not self.__compacting
+            and self.__compaction_task is None
+            and self.__size > self.__compaction_min_size
+            and garbage_size > self.__live_size * self.__compaction_ratio
+        ):
+            self.__compaction_task = asyncio.create_task(self.__run_compaction())
+
+        if self.__fsync_policy is FsyncPolicy.ALWAYS:
+            await self.__fsync()
+
+        if self.__fsync_policy is FsyncPolicy.BATCH and self.__unsynced_writes >= self.__fsync_batch_size:
+            await self.__fsync()
+
+        if self.__fsync_policy is FsyncPolicy.INTERVAL and self.__fsync_handle is None:
+            self.__fsync_handle = asyncio.get_running_loop().call_later(
+                self.__fsync_interval,
+                self.__start_interval_fsync
+            )
+
+    async def __fsync(self) -> None:
+        """
+        Force the writes to disk in the default executor. Writes that were covered by an fsync that completed
+        while waiting for the previous one are not forced to disk again.
+        """
+
+        async with self.__fsync_lock:
+            if self.__unsynced_writes == 0:
+                return
+
+            unsynced_writes = self.__unsynced_writes
+            self.__unsynced_writes = 0
+            if self.__fsync_handle is not None:
+                self.__fsync_handle.cancel()  # pylint: disable=no-member
+                self.__fsync_handle = None
+
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.__file.fileno())
+            except BaseException:
+                self.__unsynced_writes += unsynced_writes
+                raise
+
+    def __start_interval_fsync(self) -> None:
+        """
+        Start the fsync that is due with :attr:`FsyncPolicy.INTERVAL`, in the background.
+        """
+
+        self.__fsync_handle = None
+        self.__fsync_task = asyncio.create_task(self.__run_interval_fsync())
+
+    async def __run_interval_fsync(self) -> None:
+        """
+        Force the writes to disk in the background.
+        """
+
+        try:
+            await self.__fsync()
+        except OSError:
+            log.exception(f"Fsync of {self.__path} failed.")
+        finally:
+            self.__fsync_task = None
+
+    async def __run_compaction(self) -> None:
+        """
+        Compact the log in the background.
+        """
+
+        try:
+            await self.compact()
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception(f"Compaction of {self.__path} failed.")
+        finally:
+            self.__compaction_task = None
+
+
+def _records(data: bytes) -> List[Tuple[int, bytes]]:
+    """
+    Args:
+        data: A sequence of records.
+
+    Returns:
+        The offsets and contents of the complete records, i.e. those terminated by a newline.
+    """
+
+    records: List[Tuple[int, bytes]] = []
+    offset = 0
+    while True:
+        end = data.find(b"\n", offset)
+        if end == -1:
+            return records
+
+        records.append((offset, data[offset:end + 1]))
+        offset = end + 1
+
+
+_DECODER = json.JSONDecoder()
+
+
+def _parse(record: bytes, offset: int) -> Tuple[str, Optional[Entry]]:
+    """
+    Args:
+        record: A record, including the terminating newline.
+        offset: The offset of the record in the log.
+
+    Returns:
+        The key of the record and its index entry, or ``None`` in place of the entry for delete records.
+
+    Raises:
+        ValueError: if the record is malformed.
+    """
+
+    try:
+        text = record.decode("ASCII")
+    except UnicodeDecodeError as e:
+        raise ValueError("Malformed record") from e
+
+    operation = text[:2]
+    if operation not in ("S ", "D "):
+        raise ValueError("Malformed record")
+
+    key, end = _DECODER.raw_decode(text, 2)
+    if not isinstance(key, str):
+        raise ValueError("Malformed record")
+
+    if operation == "D ":
+        if end != len(text) - 1:
+            raise ValueError("Malformed record")
+
+        return key, None
+
+    if text[end] != " " or end + 1 >= len(text) - 1:
+        raise ValueError("Malformed record")
+
+    return key, Entry(offset, len(record), len(text) - 1 - (end + 1))
+
+
+def _fsync_directory(path: str) -> None:
+    """
+    Force the directory entry of a file to disk, where supported, such that a rename survives a crash.
+
+    Args:
+        path: The path of the file.
+    """
+
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,540 @@
+from argparse import ArgumentParser
+import asyncio
+import hashlib
+import json
+import sys
+import time
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+    cast
+)
+
+from omemo.storage import Storage
+from omemo.types import JSONType
+
+from .log_storage import FsyncPolicy, LogStorage
+from .mmap_storage import MmapStorage
+
+
+__all__ = [
+    "Entry",
+    "MigrationFailed",
+    "MigrationProgress",
+    "MigrationResult",
+    "dump",
+    "iterate_dump",
+    "iterate_json_file",
+    "iterate_storage",
+    "main",
+    "migrate"
+]
+
+
+Entry = Tuple[str, JSONType]
+"""
+A storage key and its value.
+"""
+
+
+class MigrationFailed(Exception):
+    """
+    Raised if the data written during a migration does not match the source, or if a dump is damaged.
+    """
+
+
+class MigrationProgress(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The progress of a migration, reported after every batch.
+    """
+
+    keys: int
+    elapsed: float
+
+
+class MigrationResult(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The outcome of a migration.
+    """
+
+    keys: int
+    checksum: str
+
+
+class _Checksum:
+    """
+    Running SHA-256 checksum over a sequence of entries, independent of the formatting of the values.
+    """
+
+    def __init__(self) -> None:
+        self.__hash = hashlib.sha256()
+
+    def update(self, key: str, value: JSONType) -> None:
+        """
+        Args:
+            key: The key of the next entry.
+            value: The value of the next entry.
+        """
+
+        self.__hash.update(_canonical(key, value) + b"\n")
+
+    def hexdigest(self) -> str:
+        """
+        Returns:
+            The checksum over all entries so far.
+        """
+
+        return self.__hash.hexdigest()
+
+
+def _canonical(key: str, value: JSONType) -> bytes:
+    """
+    Args:
+        key: A key.
+        value: Its value.
+
+    Returns:
+        The canonical serialization of the entry.
+    """
+
+    return json.dumps([ key, value ], sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+async def iterate_storage(
+    storage: Storage,
+    keys: Union[Iterable[str], AsyncIterable[str]]
+) -> AsyncIterator[Entry]:
+    """
+    Read entries from a storage. Storages don't offer a way to list their keys, thus the keys have to be
+    provided, e.g. via :meth:`~slixmpp_omemo.log_storage.LogStorage.keys` or
+    :meth:`~slixmpp_omemo.mmap_storage.MmapStorage.keys`.
+
+    Args:
+        storage: The storage.
+        keys: The keys to read. Keys without a value are skipped.
+
+    Yields:
+        The entries.
+    """
+
+    async def iterate_keys() -> AsyncIterator[str]:
+        if isinstance(keys, AsyncIterable):
+            async for key in keys:
+                yield key
+        else:
+            for key in keys:
+                yield key
+
+    async for key in iterate_keys():
+        value = await storage.load(key)
+        if value.is_just:
+            yield key, value.from_just()
+
+
+class _JSONObjectReader:
+    """
+    Incremental reader for a JSON object from a text file, which keeps only a chunk of the file and the value
+    currently being read in memory.
+    """
+
+    def __init__(self, file: TextIO, chunk_size: int) -> None:
+        self.__file = file
+        self.__chunk_size = chunk_size
+        self.__decoder = json.JSONDecoder()
+        self.__buffer = ""
+        self.__position = 0
+        self.__eof = False
+
+    def peek(self) -> str:
+        """
+        Skip whitespace.
+
+        Returns:
+            The next character, without consuming it, or an empty string at the end of the file.
+        """
+
+        while True:
+            while self.__position < len(self.__buffer) and self.__buffer[self.__position] in " \t\n\r":
+                self.__position += 1
+
+            if self.__position < len(self.__buffer):
+                return self.__buffer[self.__position]
+
+            if not self.__fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        """
+        Skip whitespace and consume a character.
+
+        Args:
+            char: The character.
+
+        Raises:
+            ValueError: if the next character is a different one.
+        """
+
+        if self.peek() != char:
+            raise ValueError(f"Malformed JSON object: expected {char!r}")
+
+        self.__position += 1
+
+    def decode(self) -> JSONType:
+        """
+        Skip whitespace and read a JSON value.
+
+        Returns:
+            The value.
+
+        Raises:
+            ValueError: if the value is malformed.
+        """
+
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__position)
+            except json.JSONDecodeError as e:
+                # The value may continue in the next chunk
+                if not self.__fill():
+                    raise ValueError("Malformed JSON object") from e
+                continue
+
+            # A number at the end of the buffer may continue in the next chunk, too
+            if end == len(self.__buffer) and self.__fill():
+                continue
+
+            self.__position = end
+
+            return cast(JSONType, value)
+
+    def __fill(self) -> bool:
+        """
+        Read the next chunk, dropping the consumed part of the buffer.
+
+        Returns:
+            Whether anything was read.
+        """
+
+        if self.__eof:
+            return False
+
+        chunk = self.__file.read(self.__chunk_size)
+        if chunk == "":
+            self.__eof = True
+            return False
+
+        self.__buffer = self.__buffer[self.__position:] + chunk
+        self.__position = 0
+
+        return True
+
+
+async def iterate_json_file(path: str, chunk_size: int = 64 * 1024) -> AsyncIterator[Entry]:
+    """
+    Read entries from a JSON file containing a single object that maps keys to values, the format of the
+    storage implementations in the examples. The file is read incrementally.
+
+    Args:
+        path: The path of the file.
+        chunk_size: The number of characters to read at once.
+
+    Yields:
+        The entries.
+
+    Raises:
+        ValueError: if the file is malformed.
+    """
+
+    with open(path, encoding="utf-8") as f:
+        reader = _JSONObjectReader(f, chunk_size)
+
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+
+        while True:
+            key = reader.decode()
+            if not isinstance(key, str):
+                raise ValueError("Malformed JSON object: expected a key")
+
+            reader.expect(":")
+            yield key, reader.decode()
+
+            if reader.peek() == "}":
+                return
+
+            reader.expect(",")
+
+
+async def iterate_dump(path: str) -> AsyncIterator[Entry]:
+    """
+    Read entries from a dump written by :func:`dump`. The checksum of the dump is verified after the last
+    entry was yielded.
+
+    Args:
+        path: The path of the dump.
+
+    Yields:
+        The entries.
+
+    Raises:
+        MigrationFailed: if the dump is damaged or incomplete.
+    """
+
+    checksum = _Checksum()
+    keys = 0
+    trailer: Optional[JSONType] = None
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if trailer is not None:
+                raise MigrationFailed("Damaged dump: entries after the checksum.")
+
+            try:
+                record = json.loads(line)
+                if "checksum" in record:
+                    trailer = record
+                    continue
+
+                key, value = record["key"], record["value"]
+            except (ValueError, TypeError, KeyError) as e:
+                raise MigrationFailed(f"Damaged dump: malformed line {keys + 1}.") from e
+
+            checksum.update(key, value)
+            keys += 1
+
+            yield key, value
+
+    if trailer is None:
+        raise MigrationFailed("Incomplete dump: the checksum is missing.")
+
+    if trailer != { "checksum": checksum.hexdigest(), "keys": keys }:
+        raise MigrationFailed("Damaged dump: checksum mismatch.")
+
+
+async def migrate(
+    source: AsyncIterable[Entry],
+    target: Storage,
+    batch_size: int = 100,
+    progress: Optional[Callable[[MigrationProgress], None]] = None,
+    verify: bool = True
+) -> MigrationResult:
+    """
+    Copy entries to a storage, in batches whose writes are performed concurrently. Only the current batch is
+    kept in memory. Existing values of the copied keys are overwritten.
+
+    Args:
+        source: The entries to copy, e.g. from :func:`iterate_storage`, :func:`iterate_json_file` or
+            :func:`iterate_dump`.
+        target: The storage to copy to.
+        batch_size: The number of entries per batch.
+        progress: Called after every batch.
+        verify: Whether to load every copied value back from the target and compare it to the source. Disable
+            the cache of the target, such that the values are loaded from the backend.
+
+    Returns:
+        The number of copied keys and the checksum over all entries, which matches the checksum of a dump of
+        the same entries.
+
+    Raises:
+        MigrationFailed: if a value loaded back from the target doesn't match the source.
+        Exception: all exceptions raised by the source and the target are forwarded as-is.
+    """
+
+    checksum = _Checksum()
+    keys = 0
+    start = time.monotonic()
+
+    async def copy(batch: List[Entry]) -> None:
+        nonlocal keys
+
+        await asyncio.gather(*(target.store(key, value) for key, value in batch))
+
+        if verify:
+            loaded = await asyncio.gather(*(target.load(key) for key, _ in batch))
+            for (key, value), loaded_value in zip(batch, loaded):
+                if loaded_value.is_nothing \
+                        or _canonical(key, loaded_value.from_just()) != _canonical(key, value):
+                    raise MigrationFailed(f"Verification failed for {key}.")
+
+        for key, value in batch:
+            checksum.update(key, value)
+        keys += len(batch)
+
+        if progress is not None:
+            progress(MigrationProgress(keys, time.monotonic() - start))
+
+    batch: List[Entry] = []
+    async for entry in source:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            await copy(batch)
+            batch = []
+
+    if len(batch) > 0:
+        await copy(batch)
+
+    return MigrationResult(keys, checksum.hexdigest())
+
+
+async def dump(
+    source: AsyncIterable[Entry],
+    path: str,
+    progress: Optional[Callable[[MigrationProgress], None]] = None,
+    progress_interval: int = 1000
+) -> MigrationResult:
+    """
+    Write entries to a dump: a file with one JSON object per entry and line, followed by a line with the
+    checksum over all entries. The dump can be restored into any storage by passing :func:`iterate_dump` to
+    :func:`migrate`.
+
+    Args:
+        source: The entries to write.
+        path: The path of the dump, which is overwritten.
+        progress: Called after every ``progress_interval`` entries and at the end.
+        progress_interval: The number of entries between progress reports.
+
+    Returns:
+        The number of written keys and the checksum.
+    """
+
+    checksum = _Checksum()
+    keys = 0
+    start = time.monotonic()
+
+    with open(path, "w", encoding="utf-8") as f:
+        async for key, value in source:
+            f.write(json.dumps({ "key": key, "value": value }) + "\n")
+            checksum.update(key, value)
+            keys += 1
+
+            if progress is not None and keys % progress_interval == 0:
+                progress(MigrationProgress(keys, time.monotonic() - start))
+
+        f.write(json.dumps({ "checksum": checksum.hexdigest(), "keys": keys }) + "\n")
+
+    if progress is not None:
+        progress(MigrationProgress(keys, time.monotonic() - start))
+
+    return MigrationResult(keys, checksum.hexdigest())
+
+
+def _print_progress(progress: MigrationProgress) -> None:
+    """
+    Print the progress of a migration to stderr.
+
+    Args:
+        progress: The progress.
+    """
+
+    rate = progress.keys / progress.elapsed if progress.elapsed > 0 else 0.0
+    print(f"{progress.keys} keys copied, {rate:.0f} keys/s", file=sys.stderr)
+
+
+async def _run(source_spec: str, target_spec: str, batch_size: int, verify: bool) -> MigrationResult:
+    """
+    Copy entries between the storages or files described by the specs given on the command line.
+
+    Args:
+        source_spec: ``json:PATH``, ``log:PATH``, ``mmap:PATH`` or ``dump:PATH``.
+        target_spec: ``log:PATH``, ``mmap:PATH`` or ``dump:PATH``.
+        batch_size: The number of entries per batch.
+        verify: Whether to verify the copied values.
+
+    Returns:
+        The outcome of the migration.
+
+    Raises:
+        ValueError: if a spec is invalid.
+    """
+
+    source_kind, _, source_path = source_spec.partition(":")
+    target_kind, _, target_path = target_spec.partition(":")
+
+    if target_kind not in ("log", "mmap", "dump"):
+        raise ValueError(f"Invalid target: {target_spec}")
+
+    source_storage: Optional[Union[LogStorage, MmapStorage]] = None
+    source: AsyncIterable[Entry]
+    if source_kind == "json":
+        source = iterate_json_file(source_path)
+    elif source_kind == "dump":
+        source = iterate_dump(source_path)
+    elif source_kind == "log":
+        source_storage = LogStorage(source_path, disable_cache=True)
+        source = iterate_storage(source_storage, source_storage.keys())
+    elif source_kind == "mmap":
+        source_storage = MmapStorage(source_path)
+        source = iterate_storage(source_storage, source_storage.keys())
+    else:
+        raise ValueError(f"Invalid source: {source_spec}")
+
+    try:
+        if target_kind == "dump":
+            return await dump(source, target_path, _print_progress)
+
+        target: Union[LogStorage, MmapStorage]
+        if target_kind == "log":
+            target = LogStorage(target_path, fsync_policy=FsyncPolicy.BATCH, disable_cache=True)
+        else:
+            target = MmapStorage(target_path)
+
+        try:
+            return await migrate(source, target, batch_size, _print_progress, verify)
+        finally:
+            target.close()
+    finally:
+        if source_storage is not None:
+            source_storage.close()
+
+
+def main() -> None:
+    """
+    Copy OMEMO storage data between backends, dump it or restore it, with parameters from the command line.
+    """
+
+    parser = ArgumentParser(
+        prog="python -m slixmpp_omemo.migrations",
+        description=(
+            "Copy OMEMO storage data between backends, dump it or restore it. Data is streamed, such that"
+            " memory usage does not depend on the amount of data."
+        )
+    )
+
+    parser.add_argument(
+        "source",
+        help="json:PATH (a JSON object as written by the example storages), log:PATH, mmap:PATH or dump:PATH"
+    )
+    parser.add_argument("target", help="log:PATH, mmap:PATH or dump:PATH")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=500, help="entries per batch")
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="don't load copied values back from the target to compare them"
+    )
+
+    args = vars(parser.parse_args())
+
+    try:
+        result = asyncio.run(_run(args["source"], args["target"], args["batch_size"], args["verify"]))
+    except (MigrationFailed, ValueError, OSError) as e:
+        parser.exit(1, f"Migration failed: {e}\n")
+
+    print(f"Copied {result.keys} keys, checksum {result.checksum}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "MmapStorage",
+    "TieredStorage",
+    "is_public_key"
+]
+
+
+MAGIC = b"SOMM"
+VERSION = 1
+
+# Magic, version, number of buckets, used buckets (including tombstones), live keys, bytes of live records and
+# end of the data region
+HEADER = struct.Struct("<4sIQQQQQ")
+
+# Key hash and record offset. A zero hash marks an empty bucket, a zero offset a deleted key (tombstone).
+BUCKET = struct.Struct("<QQ")
+
+# Key length and value length, followed by the UTF-8 encoded key and the JSON-serialized value
+RECORD = struct.Struct("<II")
+
+
+def is_public_key(key: str) -> bool:
+    """
+    Args:
+        key: A storage key.
+
+    Returns:
+        Whether the key holds public data, i.e. the device lists and device information of contacts and the
+        own account, which is downloaded from pubsub and rarely rewritten.
+    """
+
+    return key.startswith("/devices/")
+
+
+def _hash(key: bytes) -> int:
+    """
+    Args:
+        key: The encoded key.
+
+    Returns:
+        A non-zero 64 bit hash of the key.
+    """
+
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+
+class MmapStorage(Storage):
+    """
+    File-based storage for read-mostly data, which keeps nothing but the file header in memory. The file is
+    memory-mapped and contains a hash index using open addressing followed by the records, such that a load
+    looks up a few index buckets and deserializes a single value, served from the page cache for hot keys.
+    Nothing is deserialized when opening.
+
+    Stores append a new record and point the bucket of the key to it, deletes mark the bucket as deleted. The
+    file is rebuilt, dropping superseded records, when the index is half full or when superseded records
+    outweigh the live ones. Writes are flushed to disk before returning, the record before the index, such
+    that an interrupted write leaves the previous value in place.
+
+    The file must not be opened by more than one instance at a time.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        initial_buckets: int = 1024,
+        compaction_min_size: int = 1024 * 1024
+    ) -> None:
+        """
+        Open the file, creating it if it doesn't exist.
+
+        Args:
+            path: The path of the file.
+            initial_buckets: The number of index buckets of a new file, rounded up to a power of two.
+            compaction_min_size: The minimum size of superseded records in bytes before the file is rebuilt to
+                drop them.
+
+        Raises:
+            ValueError: if the file exists but is not a storage file of a supported version.
+        """
+
+        super().__init__(True)
+
+        self.__path = path
+        self.__compaction_min_size = compaction_min_size
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.__build(1 << max(initial_buckets - 1, 1).bit_length(), iter(()))
+
+        self.__file: BinaryIO
+        self.__mmap: mmap.mmap
+        self.__bucket_count = 0
+        self.__used_buckets = 0
+        self.__live_keys = 0
+        self.__live_bytes = 0
+        self.__data_end = 0
+
+        self.__open()
+
+    @property
+    def live_keys(self) -> int:
+        """
+        Returns:
+            The number of stored keys.
+        """
+
+        return self.__live_keys
+
+    @property
+    def file_size(self) -> int:
+        """
+        Returns:
+            The size of the file in bytes, including the unused space reserved for future records.
+        """
+
+        return len(self.__mmap)
+
+    def keys(self) -> Iterator[str]:
+        """
+        Returns:
+            The stored keys. The storage must not be written to while iterating.
+        """
+
+        for key, _ in self.__records():
+            yield key.decode("utf-8")
+
+    def close(self) -> None:
+        """
+        Close the file.
+        """
+
+        self.__mmap.flush()
+        self.__mmap.close()
+        self.__file.close()
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        index, _ = self.__find(key.encode("utf-8"))
+        if index is None:
+            return Nothing()
+
+        _, offset = BUCKET.unpack_from(self.__mmap, self.__bucket_offset(index))
+        key_length, value_length = RECORD.unpack_from(self.__mmap, offset)
+        value_offset = offset + RECORD.size + key_length
+
+        return Just(json.loads(self.__mmap[value_offset:value_offset + value_length]))
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        key_bytes = key.encode("utf-8")
+        value_bytes = json.dumps(value).encode("utf-8")
+        record = RECORD.pack(len(key_bytes), len(value_bytes)) + key_bytes + value_bytes
+
+        index, free_index = self.__find(key_bytes)
+
+        # Write the record first, such that the index never points to an incomplete record
+        offset = self.__data_end
+        if offset + len(record) > len(self.__mmap):
+            self.__grow(offset + len(record))
+        self.__mmap[offset:offset + len(record)] = record
+        self.__data_end += len(record)
+        self.__mmap.flush()
+
+        if index is None:
+            # Tombstones are reused, only empty buckets add to the used ones
+            free_hash, _ = BUCKET.unpack_from(self.__mmap, self.__bucket_offset(free_index))
+            if free_hash == 0:
+                self.__used_buckets += 1
+            index = free_index
+            self.__live_keys += 1
+        else:
+            self.__live_bytes -= self.__record_size(index)
+
+        BUCKET.pack_into(self.__mmap, self.__bucket_offset(index), _hash(key_bytes), offset)
+        self.__live_bytes += len(record)
+        self.__write_header()
+        self.__mmap.flush()
+
+        self.__maybe_rebuild()
+
+    async def _delete(self, key: str) -> None:
+        key_bytes = key.encode("utf-8")
+
+        index, _ = self.__find(key_bytes)
+        if index is None:
+            return
+
+        self.__live_bytes -= self.__record_size(index)
+        self.__live_keys -= 1
+        BUCKET.pack_into(self.__mmap, self.__bucket_offset(index), _hash(key_bytes), 0)
+        self.__write_header()
+        self.__mmap.flush()
+
+        self.__maybe_rebuild()
+
+    def __bucket_offset(self, index: int) -> int:
+        """
+        Args:
+            index: The index of a bucket.
+
+        Returns:
+            The offset of the bucket in the file.
+        """
+
+        return HEADER.size + index * BUCKET.size
+
+    def __data_start(self) -> int:
+        """
+        Returns:
+            The offset of the data region in the file.
+        """
+
+        return self.__bucket_offset(self.__bucket_count)
+
+    def __record_size(self, index: int) -> int:
+        """
+        Args:
+            index: The index of a bucket pointing to a record.
+
+        Returns:
+            The size of the record in bytes.
+        """
+
+        _, offset = BUCKET.unpack_from(self.__mmap, self.__bucket_offset(index))
+        key_length: int
+        value_length: int
+        key_length, value_length = RECORD.unpack_from(self.__mmap, offset)
+
+        return RECORD.size + key_length + value_length
+
+    def __find(self, key: bytes) -> Tuple[Optional[int], int]:
+        """
+        Args:
+            key: The encoded key.
+
+        Returns:
+            The index of the bucket of the key, or ``None`` if the key is not stored, and the index of the
+            bucket to use when inserting the key.
+        """
+
+        key_hash = _hash(key)
+        mask = self.__bucket_count - 1
+        index = key_hash & mask
+        free_index: Optional[int] = None
+
+        while True:
+            bucket_hash, offset = BUCKET.unpack_from(self.__mmap, self.__bucket_offset(index))
+
+            if bucket_hash == 0:
+                return None, index if free_index is None else free_index
+
+            if offset == 0:
+                if free_index is None:
+                    free_index = index
+            elif bucket_hash == key_hash:
+                key_length, _ = RECORD.unpack_from(self.__mmap, offset)
+                if self.__mmap[offset + RECORD.size:offset + RECORD.size + key_length] == key:
+                    return index, index
+
+            index = (index + 1) & mask
+
+    def __records(self) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Returns:
+            The keys and values of all live records, encoded.
+        """
+
+        for index in range(self.__bucket_count):
+            bucket_hash, offset = BUCKET.unpack_from(self.__mmap, self.__bucket_offset(index))
+            if bucket_hash == 0 or offset == 0:
+                continue
+
+            key_length, value_length = RECORD.unpack_from(self.__mmap, offset)
+            key_offset = offset + RECORD.size
+            value_offset = key_offset + key_length
+
+            yield (
+                self.__mmap[key_offset:value_offset],
+                self.__mmap[value_offset:value_offset + value_length]
+            )
+
+    def __maybe_rebuild(self) -> None:
+        """
+        Rebuild the file if the index is half full or superseded records outweigh the live ones.
+        """
+
+        garbage_size = self.__data_end - self.__data_start() - self.__live_bytes
+
+        if self.__used_buckets * 2 > self.__bucket_count:
+            # Double the index unless it is mostly filled with tombstones
+            bucket_count = self.__bucket_count * (2 if self.__live_keys * 4 > self.__bucket_count else 1)
+        elif garbage_size > self.__compaction_min_size and garbage_size > self.__live_bytes:
+            bucket_count = self.__bucket_count
+        else:
+            return
+
+        records = self.__records()
+        self.__build(bucket_count, records)
+        self.close()
+        self.__open()
+
+    def __build(self, bucket_count: int, records: Iterator[Tuple[bytes, bytes]]) -> None:
+        """
+        Write a new file and atomically replace the current file with it.
+
+        Args:
+            bucket_count: The number of index buckets, a power of two.
+            records: The keys and values to write, encoded.
+        """
+
+        building_path = f"{self.__path}.build"
+        buckets = bytearray(bucket_count * BUCKET.size)
+        data_start = HEADER.size + len(buckets)
+        data_end = data_start
+        used_buckets = 0
+        live_bytes = 0
+
+        with open(building_path, "wb") as building:
+            building.seek(data_start)
+
+            for key, value in records:
+                key_hash = _hash(key)
+                index = key_hash & (bucket_count - 1)
+                while BUCKET.unpack_from(buckets, index * BUCKET.size)[0] != 0:
+                    index = (index + 1) & (bucket_count - 1)
+                BUCKET.pack_into(buckets, index * BUCKET.size, key_hash, data_end)
+
+                record = RECORD.pack(len(key), len(value)) + key + value
+                building.write(record)
+                data_end += len(record)
+                live_bytes += len(record)
+                used_buckets += 1
+
+            building.seek(0)
+            building.write(HEADER.pack(
+                MAGIC,
+                VERSION,
+                bucket_count,
+                used_buckets,
+                used_buckets,
+                live_bytes,
+                data_end
+            ))
+            building.write(buckets)
+            building.flush()
+            os.fsync(building.fileno())
+
+        os.replace(building_path, self.__path)
+
+    def __open(self) -> None:
+        """
+        Map the file and read its header.
+
+        Raises:
+            ValueError: if the file is not a storage file of a supported version.
+        """
+
+        self.__file = open(self.__path, "r+b")  # pylint: disable=consider-using-with
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0)
+
+        magic, version, bucket_count, used_buckets, live_keys, live_bytes, data_end = \
+            HEADER.unpack_from(self.__mmap, 0)
+
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Not a storage file of version {VERSION}: {self.__path}")
+
+        self.__bucket_count = bucket_count
+        self.__used_buckets = used_buckets
+        self.__live_keys = live_keys
+        self.__live_bytes = live_bytes
+        self.__data_end = data_end
+
+    def __write_header(self) -> None:
+        """
+        Write the header to the mapped file.
+        """
+
+        HEADER.pack_into(
+            self.__mmap,
+            0,
+            MAGIC,
+            VERSION,
+            self.__bucket_count,
+            self.__used_buckets,
+            self.__live_keys,
+            self.__live_bytes,
+            self.__data_end
+        )
+
+    def __grow(self, size: int) -> None:
+        """
+        Extend the file to fit at least the given size, doubling the data region, and map it again.
+
+        Args:
+            size: The minimum size of the file in bytes.
+        """
+
+        data_start = self.__data_start()
+        size = max(size, data_start + 2 * (len(self.__mmap) - data_start), data_start + 64 * 1024)
+
+        self.__mmap.flush()
+        self.__mmap.close()
+        self.__file.truncate(size)
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0)
+
+
+class TieredStorage(Storage):
+    """
+    Storage that keeps public data, e.g. the device lists and device information of contacts, in a separate
+    storage, e.g. :class:`MmapStorage`, and everything else in the primary storage.
+
+    Public data found in the primary storage, e.g. because it was stored before the public storage was added,
+    is moved to the public storage on first load. Thus, loads of public keys that are stored nowhere reach
+    both storages.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        public_storage: Storage,
+        is_public: Callable[[str], bool] = is_public_key
+    ) -> None:
+        """
+        Args:
+            storage: The primary storage.
+            public_storage: The storage for public data.
+            is_public: The function that selects the keys to keep in the public storage, :func:`is_public_key`
+                by default.
+        """
+
+        # Both storages cache on their own, if at all
+        super().__init__(True)
+
+        self.__storage = storage
+        self.__public_storage = public_storage
+        self.__is_public = is_public
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        if not self.__is_public(key):
+            return await self.__storage.load(key)
+
+        value = await self.__public_storage.load(key)
+        if value.is_nothing:
+            value = await self.__storage.load(key)
+            if value.is_just:
+                await self.__public_storage.store(key, value.from_just())
+                await self.__storage.delete(key)
+
+        return value
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        await (self.__public_storage if self.__is_public(key) else self.__storage).store(key, value)
+
+    async def _delete(self, key: str) -> None:
+        # Delete public data from the primary storage too, in case it wasn't moved yet
+        if self.__is_public(key):
+            await self.__public_storage.delete(key)
+
+        await self.__storage.delete(key)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Counter, Dict, FrozenSet, Iterable, Optional, Set
+
+import omemo
+from omemo.backend import Backend
+
+
+__all__ = [
+    "PreKeyRefill"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class PreKeyRefill:
+    """
+    Refills the pre keys of backends and publishes their bundles in the background, such that decryptions that
+    consume pre keys don't wait for pre key generation and bundle uploads.
+
+    Refills are requested per namespace and performed ``delay`` seconds after the first request, such that the
+    pre keys consumed by a burst of new sessions are replaced by a single refill and bundle upload.
+
+    The plugin refills in the background once its ``background_pre_key_refill`` config option is set to
+    ``True``, ``background_pre_key_refill_delay`` seconds after the consumption of a pre key by
+    :meth:`~slixmpp_omemo.XEP_0384.decrypt_message`. The library only refills inline as a last resort, once
+    fewer than 26 pre keys remain.
+    """
+
+    def __init__(
+        self,
+        backends: Iterable[Backend],
+        bare_jid: str,
+        device_id: int,
+        upload_bundle: Callable[[omemo.Bundle], Awaitable[None]],
+        delay: float = 1.0,
+        num_pre_keys: int = 100
+    ) -> None:
+        """
+        Args:
+            backends: The backends whose pre keys to refill.
+            bare_jid: The bare JID of this account.
+            device_id: The device id of this device.
+            upload_bundle: Publishes a bundle.
+            delay: The time to wait between the first request and the refill, in seconds.
+            num_pre_keys: The number of pre keys to refill to.
+        """
+
+        self.__backends = { backend.namespace: backend for backend in backends }
+        self.__bare_jid = bare_jid
+        self.__device_id = device_id
+        self.__upload_bundle = upload_bundle
+        self.__delay = delay
+        self.__num_pre_keys = num_pre_keys
+        self.__pending: Set[str] = set()
+        self.__task: Optional[asyncio.Task[None]] = None
+        self.__stats: Counter[str] = Counter()
+
+    @property
+    def pending(self) -> FrozenSet[str]:
+        """
+        Returns:
+            The namespaces with a refill requested but not performed yet.
+        """
+
+        return frozenset(self.__pending)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            The counters of the refill, see :attr:`~slixmpp_omemo.XEP_0384.stats`.
+        """
+
+        return dict(self.__stats)
+
+    def request(self, namespace: str) -> None:
+        """
+        Request a refill of the pre keys of a backend, followed by the upload of its bundle.
+
+        Args:
+            namespace: The namespace of the backend.
+        """
+
+        self.__stats["bundle_uploads_deferred"] += 1
+        self.__pending.add(namespace)
+
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def run_pending(self) -> None:
+        """
+        Perform the requested refills right away. Failures are logged, the bundle is published again on the
+        next request or by the next data consistency check.
+        """
+
+        while len(self.__pending) > 0:
+            namespace = self.__pending.pop()
+            backend = self.__backends.get(namespace)
+            if backend is None:
+                continue
+
+            try:
+                num_visible_pre_keys = await backend.get_num_visible_pre_keys()
+                if num_visible_pre_keys < self.__num_pre_keys:
+                    await backend.generate_pre_keys(self.__num_pre_keys - num_visible_pre_keys)
+                    self.__stats["pre_keys_generated"] += self.__num_pre_keys - num_visible_pre_keys
+
+                await self.__upload_bundle(await backend.get_bundle(self.__bare_jid, self.__device_id))
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.warning(f"Background pre key refill failed for namespace {namespace}.", exc_info=True)
+                self.__stats["pre_key_refill_failures"] += 1
+            else:
+                self.__stats["pre_key_refills"] += 1
+
+    def close(self) -> None:
+        """
+        Cancel the pending refills.
+        """
+
+        if self.__task is not None:
+            self.__task.cancel()  # pylint: disable=no-member
+            self.__task = None
+
+        self.__pending.clear()
+
+    async def __run(self) -> None:
+        """
+        Perform the requested refills after the delay.
+        """
+
+        try:
+            await asyncio.sleep(self.__delay)
+            await self.run_pending()
+        finally:
+            if self.__task is asyncio.current_task():
+                self.__task = None
@@ -0,0 +1,190 @@
+import json
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from omemo.storage import Maybe, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "OperationStats",
+    "ProfilingStorage",
+    "key_prefix"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+def key_prefix(key: str) -> str:
+    """
+    Group a storage key with other keys of the same kind, by replacing the parts that identify a specific
+    account, device, identity key or cache entry with ``*``. For example, the double ratchet of any session
+    under a namespace is grouped under ``/<namespace>/*/*/double_ratchet``.
+
+    Args:
+        key: The storage key.
+
+    Returns:
+        The key with the identifying parts replaced.
+    """
+
+    segments = key.split("/")
+
+    # /trust/<bare jid>/<identity key>
+    if segments[1:2] == [ "trust" ]:
+        return "/".join(segments[:2] + [ "*" ] * (len(segments) - 2))
+
+    # /slixmpp/decryption_cache/<cache key> and /slixmpp/deferred_delivery/<message id>, besides their index
+    if segments[1:3] in ([ "slixmpp", "decryption_cache" ], [ "slixmpp", "deferred_delivery" ]):
+        return "/".join(segments[:3] + [ "*" if segment != "list" else segment for segment in segments[3:] ])
+
+    # Bare JIDs and device ids in all other keys
+    return "/".join("*" if "@" in segment or segment.isdigit() else segment for segment in segments)
+
+
+class OperationStats(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    Statistics of one kind of storage operation on the keys of one prefix.
+    """
+
+    calls: int
+    total_time: float
+    max_time: float
+    total_size: int
+
+
+class ProfilingStorage(Storage):
+    """
+    Storage wrapper that records the number, latency and value size of the operations performed on another
+    storage, grouped by operation and key prefix, to find out which keys are hot and how expensive the storage
+    is. Wrap the storage returned by :attr:`~slixmpp_omemo.XEP_0384.storage` to profile the plugin.
+
+    The wrapper does not cache, such that every operation reaches the wrapped storage and is recorded. The
+    wrapped storage keeps its own cache, if enabled, thus the latency of loads includes cache hits. Value
+    sizes are measured as the length of the JSON serialization of stored and loaded values.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        report_interval: Optional[float] = None,
+        report_top: int = 10,
+        prefix: Callable[[str], str] = key_prefix
+    ) -> None:
+        """
+        Args:
+            storage: The storage to wrap.
+            report_interval: If set, a report of the most expensive prefixes is logged at most every
+                ``report_interval`` seconds, on the first operation after the interval passed.
+            report_top: The number of entries included in the logged reports.
+            prefix: The function that groups keys, :func:`key_prefix` by default.
+        """
+
+        super().__init__(True)
+
+        self.__storage = storage
+        self.__report_interval = report_interval
+        self.__report_top = report_top
+        self.__prefix = prefix
+        self.__stats: Dict[Tuple[str, str], OperationStats] = {}
+        self.__last_report = time.monotonic()
+
+    @property
+    def stats(self) -> Dict[Tuple[str, str], OperationStats]:
+        """
+        Returns:
+            The statistics recorded since creation or the last :meth:`reset`, keyed by operation (``"load"``,
+            ``"store"`` or ``"delete"``) and key prefix.
+        """
+
+        return dict(self.__stats)
+
+    def reset(self) -> None:
+        """
+        Discard all statistics recorded so far.
+        """
+
+        self.__stats.clear()
+
+    def report(self, top: int = 10) -> str:
+        """
+        Args:
+            top: The maximum number of entries to include.
+
+        Returns:
+            A human-readable report of the (operation, prefix) pairs with the highest total latency, one per
+            line.
+        """
+
+        entries: List[Tuple[Tuple[str, str], OperationStats]] = sorted(
+            self.__stats.items(),
+            key=lambda entry: entry[1].total_time,
+            reverse=True
+        )[:top]
+
+        return "\n".join(
+            f"{operation} {prefix}: {stats.calls} ops, {stats.total_time * 1000:.1f} ms total,"
+            f" {stats.total_time * 1000 / stats.calls:.3f} ms mean, {stats.max_time * 1000:.3f} ms max,"
+            f" {stats.total_size} bytes"
+            for (operation, prefix), stats
+            in entries
+        )
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        start = time.perf_counter()
+        value = await self.__storage.load(key)
+        self.__record("load", key, start, value.fmap(_size).maybe(0))
+
+        return value
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        start = time.perf_counter()
+        await self.__storage.store(key, value)
+        self.__record("store", key, start, _size(value))
+
+    async def _delete(self, key: str) -> None:
+        start = time.perf_counter()
+        await self.__storage.delete(key)
+        self.__record("delete", key, start, 0)
+
+    def __record(self, operation: str, key: str, start: float, size: int) -> None:
+        """
+        Record a completed operation and log a report if due.
+
+        Args:
+            operation: The operation.
+            key: The key the operation was performed on.
+            start: The value of :func:`time.perf_counter` at the start of the operation.
+            size: The size of the stored or loaded value.
+        """
+
+        duration = time.perf_counter() - start
+
+        stats_key = (operation, self.__prefix(key))
+        stats = self.__stats.get(stats_key, OperationStats(0, 0.0, 0.0, 0))
+        self.__stats[stats_key] = OperationStats(
+            stats.calls + 1,
+            stats.total_time + duration,
+            max(stats.max_time, duration),
+            stats.total_size + size
+        )
+
+        now = time.monotonic()
+        if self.__report_interval is not None and now - self.__last_report >= self.__report_interval:
+            self.__last_report = now
+            log.info(f"Storage operations by total latency:\n{self.report(self.__report_top)}")
+
+
+def _size(value: JSONType) -> int:
+    """
+    Args:
+        value: A JSON-serializable value.
+
+    Returns:
+        The length of the JSON serialization of the value.
+    """
+
+    return len(json.dumps(value))
@@ -0,0 +1,395 @@
+from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    TextIO,
+    Union
+)
+from xml.etree import ElementTree as ET
+
+import omemo
+from omemo.session_manager import BundleNotFound, SessionManager, UnknownNamespace
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import DeviceInformation, JSONType
+
+import oldmemo
+import oldmemo.etree
+import twomemo
+import twomemo.etree
+
+from .base_session_manager import TrustLevel
+from .log_storage import FsyncPolicy, LogStorage
+from .migrations import Entry
+from .mmap_storage import MmapStorage
+from .session_manager_pool import SessionManagerPool
+from .xep_0384 import OLDMEMO_DEVICE_LIST_NODE, TWOMEMO_DEVICE_LIST_NODE
+
+
+__all__ = [
+    "ProvisionedIdentity",
+    "PublishItem",
+    "generate_identity",
+    "main",
+    "provision"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class PublishItem(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    A pubsub item to publish to the PEP service of an account.
+    """
+
+    node: str
+    item_id: str
+    item: str
+
+
+class ProvisionedIdentity(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    The OMEMO identity generated for an account: its device id, the storage entries as written by the first
+    run of the session manager, and the bundles and device lists to publish.
+    """
+
+    bare_jid: str
+    device_id: int
+    entries: List[Entry]
+    items: List[PublishItem]
+
+
+class _CapturingStorage(Storage):
+    """
+    Storage implementation that keeps all data in a dictionary, in the order it was first written.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(True)
+
+        self.data: Dict[str, JSONType] = {}
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        return Just(self.data[key]) if key in self.data else Nothing()
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        self.data[key] = value
+
+    async def _delete(self, key: str) -> None:
+        self.data.pop(key, None)
+
+
+async def generate_identity(bare_jid: str) -> ProvisionedIdentity:
+    """
+    Generate the OMEMO identity of an account offline, i.e. without downloading the account's device lists.
+
+    Args:
+        bare_jid: The bare JID of the account.
+
+    Returns:
+        The identity, as generated by the first run of a session manager with the twomemo and oldmemo backends
+        configured like those of :class:`~slixmpp_omemo.XEP_0384`.
+
+    Note:
+        The device id is chosen without knowledge of the account's existing devices. Identities are meant to
+        be provisioned for new accounts, a clash with an existing device is unlikely but possible otherwise.
+    """
+
+    items: List[PublishItem] = []
+
+    class OfflineSessionManager(SessionManager):
+        @staticmethod
+        async def _upload_bundle(bundle: omemo.Bundle) -> None:
+            if isinstance(bundle, twomemo.twomemo.BundleImpl):
+                items.append(PublishItem(
+                    "urn:xmpp:omemo:2:bundles",
+                    str(bundle.device_id),
+                    ET.tostring(twomemo.etree.serialize_bundle(bundle), encoding="unicode")
+                ))
+                return
+
+            if isinstance(bundle, oldmemo.oldmemo.BundleImpl):
+                items.append(PublishItem(
+                    f"eu.siacs.conversations.axolotl.bundles:{bundle.device_id}",
+                    "current",
+                    ET.tostring(oldmemo.etree.serialize_bundle(bundle), encoding="unicode")
+                ))
+                return
+
+            raise UnknownNamespace(f"Unknown namespace: {bundle.namespace}")
+
+        @staticmethod
+        async def _download_bundle(namespace: str, bare_jid: str, device_id: int) -> omemo.Bundle:
+            raise BundleNotFound(f"Bundles are not available offline: {bare_jid}: {device_id} ({namespace})")
+
+        @staticmethod
+        async def _delete_bundle(namespace: str, device_id: int) -> None:
+            pass
+
+        @staticmethod
+        async def _upload_device_list(namespace: str, device_list: Dict[int, Optional[str]]) -> None:
+            if namespace == twomemo.twomemo.NAMESPACE:
+                items.append(PublishItem(
+                    TWOMEMO_DEVICE_LIST_NODE,
+                    "current",
+                    ET.tostring(twomemo.etree.serialize_device_list(device_list), encoding="unicode")
+                ))
+                return
+
+            if namespace == oldmemo.oldmemo.NAMESPACE:
+                items.append(PublishItem(
+                    OLDMEMO_DEVICE_LIST_NODE,
+                    "current",
+                    ET.tostring(oldmemo.etree.serialize_device_list(device_list), encoding="unicode")
+                ))
+                return
+
+            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+
+        @staticmethod
+        async def _download_device_list(namespace: str, bare_jid: str) -> Dict[int, Optional[str]]:
+            return {}
+
+        async def _evaluate_custom_trust_level(self, device: DeviceInformation) -> omemo.TrustLevel:
+            return omemo.TrustLevel.UNDECIDED
+
+        async def _make_trust_decision(
+            self,
+            undecided: FrozenSet[DeviceInformation],
+            identifier: Optional[str]
+        ) -> None:
+            pass
+
+        @staticmethod
+        async def _send_message(message: omemo.Message, bare_jid: str) -> None:
+            pass
+
+    storage = _CapturingStorage()
+
+    session_manager = await OfflineSessionManager.create(
+        [ twomemo.Twomemo(storage), oldmemo.Oldmemo(storage) ],
+        storage,
+        bare_jid,
+        initial_own_label=None,
+        undecided_trust_level_name=TrustLevel.UNDECIDED.value
+    )
+
+    device, _ = await session_manager.get_own_device_information()
+
+    return ProvisionedIdentity(bare_jid, device.device_id, list(storage.data.items()), items)
+
+
+def _generate_identity(bare_jid: str) -> ProvisionedIdentity:
+    """
+    Entry point of the worker processes.
+
+    Args:
+        bare_jid: The bare JID of the account.
+
+    Returns:
+        The identity, see :func:`generate_identity`.
+    """
+
+    return asyncio.run(generate_identity(bare_jid))
+
+
+async def _write(storage: Storage, identity: ProvisionedIdentity) -> None:
+    """
+    Write the storage entries of an identity. The device id is written last, such that an interrupted write
+    leaves the account unprovisioned rather than half-provisioned.
+
+    Args:
+        storage: The storage of the account.
+        identity: The identity.
+    """
+
+    await asyncio.gather(*(
+        storage.store(key, value)
+        for key, value
+        in identity.entries
+        if key != "/own_device_id"
+    ))
+
+    await storage.store("/own_device_id", identity.device_id)
+
+
+async def provision(
+    bare_jids: Iterable[str],
+    storage_for: Callable[[str], Storage],
+    processes: Optional[int] = None
+) -> AsyncIterator[ProvisionedIdentity]:
+    """
+    Generate the OMEMO identities of many accounts in a process pool and write them to their storages, such
+    that the first login of each account only publishes its bundles and device lists instead of generating
+    keys. Accounts whose storage holds an identity already are skipped.
+
+    Args:
+        bare_jids: The bare JIDs of the accounts.
+        storage_for: Returns the storage of an account, e.g.
+            :meth:`~slixmpp_omemo.session_manager_pool.SessionManagerPool.storage_for`.
+        processes: The number of worker processes. Defaults to the number of CPUs.
+
+    Yields:
+        The identities, once written to their storages, in the order their generation finishes. The identities
+        are generated by at most two times ``processes`` accounts ahead of the consumer.
+
+    Note:
+        The publish items of the identities are published by the session managers on first login. They are
+        provided for deployments that publish them out of band, e.g. directly on the server.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    window = 2 * processes
+
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending: Set["asyncio.Future[ProvisionedIdentity]"] = set()
+
+        async def drain(block: bool) -> AsyncIterator[ProvisionedIdentity]:
+            nonlocal pending
+
+            while len(pending) >= (window if block else 1):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    identity = future.result()
+                    await _write(storage_for(identity.bare_jid), identity)
+                    yield identity
+
+        try:
+            for bare_jid in bare_jids:
+                if (await storage_for(bare_jid).load("/own_device_id")).is_just:
+                    log.info(f"Skipping {bare_jid}, which has an OMEMO identity already.")
+                    continue
+
+                future = loop.run_in_executor(executor, _generate_identity, bare_jid)
+                pending.add(asyncio.ensure_future(future))
+
+                async for identity in drain(True):
+                    yield identity
+
+            async for identity in drain(False):
+                yield identity
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+async def _run(
+    target_spec: str,
+    jids_path: str,
+    processes: Optional[int],
+    payloads_path: Optional[str]
+) -> int:
+    """
+    Provision the accounts listed in a file into the storage described by the spec given on the command line.
+
+    Args:
+        target_spec: ``log:PATH`` or ``mmap:PATH``.
+        jids_path: The path of a file with one bare JID per line, ``-`` for stdin.
+        processes: The number of worker processes.
+        payloads_path: The path of a file to write the publish items to, as JSON lines, if any.
+
+    Returns:
+        The number of provisioned accounts.
+
+    Raises:
+        ValueError: if the spec is invalid.
+    """
+
+    target_kind, _, target_path = target_spec.partition(":")
+
+    target: Union[LogStorage, MmapStorage]
+    if target_kind == "log":
+        target = LogStorage(target_path, fsync_policy=FsyncPolicy.BATCH, disable_cache=True)
+    elif target_kind == "mmap":
+        target = MmapStorage(target_path)
+    else:
+        raise ValueError(f"Invalid target: {target_spec}")
+
+    if jids_path == "-":
+        bare_jids = [ line.strip() for line in sys.stdin ]
+    else:
+        with open(jids_path, encoding="utf-8") as f:
+            bare_jids = [ line.strip() for line in f ]
+
+    pool = SessionManagerPool(target)
+    payloads: Optional[TextIO] = None
+
+    provisioned = 0
+    try:
+        if payloads_path is not None:
+            payloads = open(payloads_path, "w", encoding="utf-8")  # pylint: disable=consider-using-with
+
+        bare_jids = [ bare_jid for bare_jid in bare_jids if bare_jid ]
+        async for identity in provision(bare_jids, pool.storage_for, processes):
+            provisioned += 1
+            if payloads is not None:
+                payloads.write(json.dumps({
+                    "bare_jid": identity.bare_jid,
+                    "device_id": identity.device_id,
+                    "items": [ item._asdict() for item in identity.items ]
+                }) + "\n")
+            if provisioned % 100 == 0:
+                print(f"{provisioned} accounts provisioned", file=sys.stderr)
+    finally:
+        if payloads is not None:
+            payloads.close()
+        target.close()
+
+    return provisioned
+
+
+def main() -> None:
+    """
+    Provision OMEMO identities for many accounts, with parameters from the command line.
+    """
+
+    parser = ArgumentParser(
+        prog="python -m slixmpp_omemo.provisioning",
+        description=(
+            "Generate OMEMO identities for many accounts in parallel and write them to a storage shared by"
+            " the accounts, with the keys of each account prefixed by /<bare JID> as done by"
+            " SessionManagerPool."
+        )
+    )
+
+    parser.add_argument("target", help="log:PATH or mmap:PATH")
+    parser.add_argument("jids", help="file with one bare JID per line, - for stdin")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, defaults to the CPUs")
+    parser.add_argument(
+        "--payloads",
+        default=None,
+        help="file to write the bundles and device lists to publish to, as JSON lines"
+    )
+
+    args = vars(parser.parse_args())
+
+    try:
+        provisioned = asyncio.run(_run(args["target"], args["jids"], args["processes"], args["payloads"]))
+    except (ValueError, OSError) as e:
+        parser.exit(1, f"Provisioning failed: {e}\n")
+
+    print(f"Provisioned {provisioned} accounts")
+
+
+if __name__ == "__main__":
+    main()
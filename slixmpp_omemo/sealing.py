@@ -0,0 +1,72 @@
+import base64
+import json
+import os
+from typing import Optional, cast
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from omemo.types import JSONType
+
+
+__all__ = [
+    "Sealer"
+]
+
+
+class Sealer:
+    """
+    Prepares JSON-serializable values for persisting, encrypting them using AES-GCM if a key is given. Each
+    sealed value is bound to the storage key or id it is persisted under, which is authenticated along with
+    the value, such that values can't be swapped in the storage unnoticed.
+    """
+
+    def __init__(self, encryption_key: Optional[bytes] = None) -> None:
+        """
+        Args:
+            encryption_key: A 128, 192 or 256 bit AES key to encrypt values with. Values are sealed as-is if
+                no key is given.
+
+        Raises:
+            ValueError: if the encryption key has an invalid length.
+        """
+
+        self.__aesgcm: Optional[AESGCM] = None if encryption_key is None else AESGCM(encryption_key)
+
+    def seal(self, value: JSONType, associated_data: str) -> JSONType:
+        """
+        Args:
+            value: The value to persist.
+            associated_data: The storage key or id the value is persisted under.
+
+        Returns:
+            The value in the form to persist, encrypted if an encryption key is configured.
+        """
+
+        aesgcm = self.__aesgcm
+        if aesgcm is not None:
+            nonce = os.urandom(12)
+            plaintext = json.dumps(value).encode("utf-8")
+            ciphertext = aesgcm.encrypt(nonce, plaintext, associated_data.encode("utf-8"))
+            return base64.b64encode(nonce + ciphertext).decode("ASCII")
+
+        return value
+
+    def unseal(self, sealed: JSONType, associated_data: str) -> JSONType:
+        """
+        Args:
+            sealed: The persisted value.
+            associated_data: The storage key or id the value was persisted under.
+
+        Returns:
+            The value.
+
+        Raises:
+            Exception: if the value can't be decrypted, e.g. because it was sealed using a different key.
+        """
+
+        aesgcm = self.__aesgcm
+        if aesgcm is not None:
+            sealed_bytes = base64.b64decode(cast(str, sealed))
+            plaintext = aesgcm.decrypt(sealed_bytes[:12], sealed_bytes[12:], associated_data.encode("utf-8"))
+            return cast(JSONType, json.loads(plaintext.decode("utf-8")))
+
+        return sealed
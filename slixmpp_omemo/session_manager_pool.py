@@ -0,0 +1,255 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Counter, Dict, Optional, Protocol, TypeVar
+from weakref import WeakSet
+
+from omemo.storage import Maybe, Storage
+from omemo.types import JSONType
+
+from .circuit_breaker import CircuitBreaker
+
+
+__all__ = [
+    "PoolMember",
+    "PrefixedStorage",
+    "SessionManagerPool"
+]
+
+
+T = TypeVar("T")
+
+
+class PoolMember(Protocol):
+    """
+    An account whose session manager is managed by a :class:`SessionManagerPool`, usually an instance of
+    :class:`~slixmpp_omemo.XEP_0384`.
+    """
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            The counters of the work performed by the account.
+        """
+
+
+class PrefixedStorage(Storage):
+    """
+    View of a storage that prefixes all keys, such that multiple accounts can keep their data in a single
+    storage without conflicts.
+    """
+
+    def __init__(self, storage: Storage, prefix: str) -> None:
+        """
+        Args:
+            storage: The shared storage.
+            prefix: The prefix to put in front of every key. Keys start with a slash, thus the prefix should
+                start with a slash and not end with one.
+        """
+
+        # The shared storage caches on its own, if at all
+        super().__init__(True)
+
+        self.__storage = storage
+        self.__prefix = prefix
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        return await self.__storage.load(self.__prefix + key)
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        await self.__storage.store(self.__prefix + key, value)
+
+    async def _delete(self, key: str) -> None:
+        await self.__storage.delete(self.__prefix + key)
+
+
+class SessionManagerPool:
+    """
+    Process-level pool for hosting many accounts, each with its own :class:`~slixmpp_omemo.XEP_0384` instance
+    and session manager. Assign the pool to the ``session_manager_pool`` config option of each plugin
+    instance.
+
+    The pool staggers the initialization of the session managers, which includes key generation for new
+    accounts, bundle uploads and a data consistency check, such that at most
+    ``max_concurrent_initializations`` run at the same time and consecutive initializations start at least
+    ``initialization_interval`` seconds apart. In addition, the pool shares resources among the accounts:
+
+    - a single storage, e.g. a :class:`~slixmpp_omemo.sharded_storage.ShardedStorage` over a database
+      connection pool, handed out per account via :meth:`storage_for`,
+    - the health tracking of remote pubsub services, such that a failing domain is detected once for all
+      accounts rather than once per account.
+
+    The :attr:`~slixmpp_omemo.XEP_0384.stats` of the plugin instances are aggregated in :attr:`stats`.
+    """
+
+    def __init__(
+        self,
+        storage: Optional[Storage] = None,
+        max_concurrent_initializations: int = 4,
+        initialization_interval: float = 0.0,
+        circuit_breaker: Optional[CircuitBreaker] = None
+    ) -> None:
+        """
+        Args:
+            storage: The storage to share among the accounts, if any.
+            max_concurrent_initializations: The maximum number of session managers to initialize at the
+                same time.
+            initialization_interval: The minimum time between the starts of two initializations, in seconds.
+            circuit_breaker: The health tracking of remote pubsub services to share among the accounts. If
+                omitted, each account tracks the health on its own, configured by its ``pubsub_*`` config
+                options.
+
+        Raises:
+            ValueError: if ``max_concurrent_initializations`` is not positive.
+        """
+
+        if max_concurrent_initializations < 1:
+            raise ValueError("At least one initialization must be allowed at a time.")
+
+        self.__storage = storage
+        self.__storages: Dict[str, PrefixedStorage] = {}
+        self.__circuit_breaker = circuit_breaker
+        self.__semaphore = asyncio.Semaphore(max_concurrent_initializations)
+        self.__start_lock = asyncio.Lock()
+        self.__initialization_interval = initialization_interval
+        self.__next_start = 0.0
+        self.__members: WeakSet[PoolMember] = WeakSet()
+        self.__stats: Counter[str] = Counter()
+        self.__waiting = 0
+        self.__initializing = 0
+
+    @property
+    def circuit_breaker(self) -> Optional[CircuitBreaker]:
+        """
+        Returns:
+            The shared health tracking of remote pubsub services, if any.
+        """
+
+        return self.__circuit_breaker
+
+    @property
+    def accounts(self) -> int:
+        """
+        Returns:
+            The number of registered accounts.
+        """
+
+        return len(self.__members)
+
+    def storage_for(self, bare_jid: str) -> Storage:
+        """
+        Args:
+            bare_jid: The bare JID of an account.
+
+        Returns:
+            The view of the shared storage for the account, with all keys prefixed by ``/<bare JID>``. The
+            same view is returned for repeated calls.
+
+        Raises:
+            ValueError: if the pool was created without a shared storage.
+        """
+
+        if self.__storage is None:
+            raise ValueError("The pool was created without a shared storage.")
+
+        storage = self.__storages.get(bare_jid)
+        if storage is None:
+            storage = self.__storages[bare_jid] = PrefixedStorage(self.__storage, f"/{bare_jid}")
+
+        return storage
+
+    def register(self, member: PoolMember) -> None:
+        """
+        Register an account with the pool. Done automatically by plugin instances configured to use the pool.
+
+        Args:
+            member: The account.
+        """
+
+        self.__members.add(member)
+
+    def unregister(self, member: PoolMember) -> None:
+        """
+        Unregister an account from the pool. Done automatically by plugin instances configured to use the pool
+        when they are unloaded.
+
+        Args:
+            member: The account.
+        """
+
+        self.__members.discard(member)
+
+    async def initialize(self, initialization: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run the initialization of a session manager once the staggering allows.
+
+        Args:
+            initialization: The coroutine function performing the initialization.
+
+        Returns:
+            The result of the initialization.
+
+        Raises:
+            Exception: all exceptions raised by the initialization are forwarded as-is.
+        """
+
+        self.__waiting += 1
+        try:
+            await self.__semaphore.acquire()
+        finally:
+            self.__waiting -= 1
+
+        try:
+            async with self.__start_lock:
+                delay = self.__next_start - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.__next_start = time.monotonic() + self.__initialization_interval
+
+            self.__initializing += 1
+            start = time.monotonic()
+            try:
+                result = await initialization()
+            except Exception:
+                self.__stats["pool_initializations_failed"] += 1
+                raise
+            finally:
+                self.__initializing -= 1
+                self.__stats["pool_initialization_ms"] += int((time.monotonic() - start) * 1000)
+
+            self.__stats["pool_initializations"] += 1
+
+            return result
+        finally:
+            self.__semaphore.release()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            The counters of all registered accounts summed up, see :attr:`~slixmpp_omemo.XEP_0384.stats`, and
+            the counters of the pool. Counters that are zero are omitted.
+
+            - ``pool_accounts``: the number of registered accounts.
+            - ``pool_initializations``: session managers initialized successfully.
+            - ``pool_initializations_failed``: session manager initializations that failed.
+            - ``pool_initialization_ms``: the time spent on initializations, in milliseconds, summed up.
+            - ``pool_initializations_waiting``: initializations currently waiting for their turn.
+            - ``pool_initializations_running``: initializations currently in progress.
+
+            The ``pubsub_open_circuits`` value refers to the shared health tracking, if any.
+        """
+
+        stats: Counter[str] = Counter()
+        for member in list(self.__members):
+            stats.update(member.stats)
+
+        stats.update(self.__stats)
+        stats["pool_accounts"] = len(self.__members)
+        stats["pool_initializations_waiting"] = self.__waiting
+        stats["pool_initializations_running"] = self.__initializing
+
+        if self.__circuit_breaker is not None:
+            stats["pubsub_open_circuits"] = len(self.__circuit_breaker.open_keys)
+
+        return { key: value for key, value in stats.items() if value != 0 }
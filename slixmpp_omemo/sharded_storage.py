@@ -0,0 +1,160 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Sequence
+import zlib
+
+from omemo.storage import Maybe, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "ShardedStorage",
+    "shard_key"
+]
+
+
+# The first segments of keys that are not specific to a backend
+COMMON_KEYS = frozenset({ "devices", "trust", "queue", "slixmpp" })
+
+# Keys of the plugin that embed a bare JID as their third segment, /slixmpp/<kind>/<bare JID>/...
+SLIXMPP_BARE_JID_KEYS = frozenset({ "device_activity", "gc", "subscribed" })
+
+
+def _find_bare_jid(segments: List[str]) -> Optional[str]:
+    """
+    Args:
+        segments: The segments of a storage key, without the leading empty segment.
+
+    Returns:
+        The bare JID embedded in the key according to the key layouts of the library and the plugin, or
+        ``None`` if the key doesn't belong to a single bare JID.
+    """
+
+    if len(segments) < 3:
+        return None
+
+    # /devices/<bare JID>/... and /trust/<bare JID>/<identity key>
+    if segments[0] in { "devices", "trust" }:
+        return segments[1]
+
+    # /queue/<namespace>/<bare JID>
+    if segments[0] == "queue":
+        return segments[2]
+
+    # /slixmpp/<kind>/<bare JID>/...
+    if segments[0] == "slixmpp":
+        return segments[2] if segments[1] in SLIXMPP_BARE_JID_KEYS else None
+
+    # /<namespace>/<bare JID>/device_ids and /<namespace>/<bare JID>/<device id>/...
+    if segments[2] == "device_ids" or segments[2].isdigit():
+        return segments[1]
+
+    return None
+
+
+def shard_key(key: str) -> str:
+    """
+    Args:
+        key: A storage key.
+
+    Returns:
+        The bare JID embedded in the key, if any, otherwise the key itself. All data of a contact, e.g. its
+        sessions, device information and trust, shares the bare JID and thus the shard. The bare JID is found
+        by the key layouts of the library and the plugin, also below a ``/<bare JID>`` prefix as added by
+        :class:`~slixmpp_omemo.session_manager_pool.SessionManagerPool`, thus domain-only bare JIDs are
+        supported too.
+    """
+
+    segments = key.split("/")[1:]
+
+    bare_jid = _find_bare_jid(segments)
+    if bare_jid is None and len(segments) > 0 and segments[0] not in COMMON_KEYS:
+        bare_jid = _find_bare_jid(segments[1:])
+
+    return key if bare_jid is None else bare_jid
+
+
+class ShardedStorage(Storage):
+    """
+    Storage that distributes the keys over multiple shards, e.g. separate files or database connections, by
+    the bare JID embedded in them. Operations on a shard are serialized using a lock per shard, such that
+    the shards don't have to handle concurrent access, while operations on different shards, i.e. for
+    different conversations, run concurrently. Shards benefit from this if they perform their I/O off the
+    event loop, e.g. in threads.
+
+    The shard of a key is derived from a stable hash of the bare JID modulo the number of shards, thus the
+    number and order of the shards must not change once data was stored.
+    """
+
+    def __init__(
+        self,
+        shards: Sequence[Storage],
+        flush: Optional[Callable[[Storage], Awaitable[None]]] = None,
+        key: Callable[[str], str] = shard_key
+    ) -> None:
+        """
+        Args:
+            shards: The shards.
+            flush: A coroutine function that flushes a shard, called by :meth:`flush`, e.g. to force deferred
+                writes of each shard to disk.
+            key: The function that selects the part of a key that determines the shard, :func:`shard_key` by
+                default.
+
+        Raises:
+            ValueError: if no shards are given.
+        """
+
+        if len(shards) == 0:
+            raise ValueError("At least one shard is required.")
+
+        # The shards cache on their own, if at all
+        super().__init__(True)
+
+        self.__shards = list(shards)
+        self.__locks: List[asyncio.Lock] = [ asyncio.Lock() for _ in shards ]
+        self.__flush = flush
+        self.__key = key
+
+    def shard_index(self, key: str) -> int:
+        """
+        Args:
+            key: A storage key.
+
+        Returns:
+            The index of the shard the key is stored in.
+        """
+
+        return zlib.crc32(self.__key(key).encode("utf-8")) % len(self.__shards)
+
+    async def flush(self) -> None:
+        """
+        Flush all shards in parallel, using the ``flush`` function passed to the constructor. Does nothing if
+        no such function was passed.
+        """
+
+        flush = self.__flush
+        if flush is None:
+            return
+
+        async def flush_shard(index: int) -> None:
+            async with self.__locks[index]:
+                await flush(self.__shards[index])
+
+        await asyncio.gather(*(flush_shard(index) for index in range(len(self.__shards))))
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        index = self.shard_index(key)
+
+        async with self.__locks[index]:
+            return await self.__shards[index].load(key)
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        index = self.shard_index(key)
+
+        async with self.__locks[index]:
+            await self.__shards[index].store(key, value)
+
+    async def _delete(self, key: str) -> None:
+        index = self.shard_index(key)
+
+        async with self.__locks[index]:
+            await self.__shards[index].delete(key)
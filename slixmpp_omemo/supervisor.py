@@ -0,0 +1,663 @@
+import asyncio
+import bisect
+from collections import Counter
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+import queue
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Protocol, Set, Tuple
+
+from slixmpp.clientxmpp import ClientXMPP
+
+from .session_manager_pool import SessionManagerPool
+
+
+__all__ = [
+    "Account",
+    "AccountFactory",
+    "HashRing",
+    "Supervisor",
+    "XMPPAccount"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class Account(Protocol):
+    """
+    An account hosted by a worker process of the :class:`Supervisor`, usually an :class:`XMPPAccount`.
+    """
+
+    async def start(self) -> None:
+        """
+        Start the account. Should return promptly, the worker processes its commands one after the other.
+        """
+
+    async def stop(self) -> None:
+        """
+        Stop the account, such that another worker process can take it over.
+        """
+
+
+AccountFactory = Callable[[str, SessionManagerPool], Account]
+"""
+Creates the account of a bare JID in a worker process. The session manager pool of the worker process is
+passed, which the account should be registered with, e.g. by assigning it to the ``session_manager_pool``
+config option of the :class:`~slixmpp_omemo.XEP_0384` plugin instance, such that its stats are collected.
+
+The factory is sent to the worker processes and thus has to be picklable, e.g. a module-level function.
+Accounts may move between worker processes, thus their storage must be reachable from all worker processes.
+"""
+
+
+class XMPPAccount:
+    """
+    Adapter that hosts a :class:`~slixmpp.clientxmpp.ClientXMPP` instance, with the
+    :class:`~slixmpp_omemo.XEP_0384` plugin registered, as an :class:`Account`.
+    """
+
+    def __init__(self, xmpp: ClientXMPP, disconnect_wait: float = 2.0) -> None:
+        """
+        Args:
+            xmpp: The client, configured but not connected yet.
+            disconnect_wait: The time to wait for the send queue to flush when stopping, in seconds.
+        """
+
+        self.__xmpp = xmpp
+        self.__disconnect_wait = disconnect_wait
+
+    async def start(self) -> None:
+        # Connecting, including reconnects, continues in the background
+        self.__xmpp.connect()
+
+    async def stop(self) -> None:
+        await self.__xmpp.disconnect(wait=self.__disconnect_wait)
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes. Each node is placed on the ring ``replicas`` times, such that adding
+    or removing a node only moves the keys of about one node's share.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100) -> None:
+        """
+        Args:
+            nodes: The initial nodes.
+            replicas: The number of points per node on the ring.
+        """
+
+        self.__replicas = replicas
+        self.__points: List[Tuple[int, str]] = []
+        self.__nodes: Set[str] = set()
+
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        """
+        Args:
+            value: The value to hash.
+
+        Returns:
+            A hash of the value that is stable across processes, unlike the builtin :func:`hash`.
+        """
+
+        return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "big")
+
+    @property
+    def nodes(self) -> FrozenSet[str]:
+        """
+        Returns:
+            The nodes on the ring.
+        """
+
+        return frozenset(self.__nodes)
+
+    def add(self, node: str) -> None:
+        """
+        Args:
+            node: The node to add. Nothing happens if it is on the ring already.
+        """
+
+        if node in self.__nodes:
+            return
+
+        self.__nodes.add(node)
+        for replica in range(self.__replicas):
+            bisect.insort(self.__points, (self.__hash(f"{node}#{replica}"), node))
+
+    def remove(self, node: str) -> None:
+        """
+        Args:
+            node: The node to remove. Nothing happens if it is not on the ring.
+        """
+
+        if node not in self.__nodes:
+            return
+
+        self.__nodes.discard(node)
+        self.__points = [ point for point in self.__points if point[1] != node ]
+
+    def node_for(self, key: str) -> str:
+        """
+        Args:
+            key: The key.
+
+        Returns:
+            The node the key belongs to.
+
+        Raises:
+            LookupError: if the ring is empty.
+        """
+
+        if len(self.__points) == 0:
+            raise LookupError("The ring is empty.")
+
+        index = bisect.bisect(self.__points, (self.__hash(key), ""))
+
+        return self.__points[index % len(self.__points)][1]
+
+
+class _Worker(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    A worker process and its command queue.
+    """
+
+    process: BaseProcess
+    commands: "Queue[Tuple[Any, ...]]"
+
+
+def _worker_main(
+    worker_id: int,
+    factory: AccountFactory,
+    commands: "Queue[Tuple[Any, ...]]",
+    events: "Queue[Tuple[Any, ...]]",
+    metrics_interval: float,
+    max_concurrent_initializations: int
+) -> None:
+    """
+    Entry point of the worker processes.
+
+    Args:
+        worker_id: The id of the worker.
+        factory: Creates the accounts.
+        commands: The queue to receive commands from the supervisor on.
+        events: The queue to send events to the supervisor on.
+        metrics_interval: The interval to report metrics in, in seconds.
+        max_concurrent_initializations: The maximum number of session managers to initialize at the same time.
+    """
+
+    asyncio.run(_run_worker(
+        worker_id,
+        factory,
+        commands,
+        events,
+        metrics_interval,
+        max_concurrent_initializations
+    ))
+
+
+async def _run_worker(
+    worker_id: int,
+    factory: AccountFactory,
+    commands: "Queue[Tuple[Any, ...]]",
+    events: "Queue[Tuple[Any, ...]]",
+    metrics_interval: float,
+    max_concurrent_initializations: int
+) -> None:
+    """
+    Host accounts as instructed by the supervisor, until told to stop.
+
+    Args:
+        worker_id: The id of the worker.
+        factory: Creates the accounts.
+        commands: The queue to receive commands from the supervisor on.
+        events: The queue to send events to the supervisor on.
+        metrics_interval: The interval to report metrics in, in seconds.
+        max_concurrent_initializations: The maximum number of session managers to initialize at the same time.
+    """
+
+    loop = asyncio.get_running_loop()
+    pool = SessionManagerPool(max_concurrent_initializations=max_concurrent_initializations)
+    accounts: Dict[str, Account] = {}
+
+    def report() -> None:
+        events.put(("metrics", worker_id, { **pool.stats, "worker_accounts": len(accounts) }))
+
+    async def report_periodically() -> None:
+        while True:
+            report()
+            await asyncio.sleep(metrics_interval)
+
+    reporter = asyncio.create_task(report_periodically())
+
+    try:
+        while True:
+            command = await loop.run_in_executor(None, commands.get)
+
+            if command[0] == "add":
+                bare_jid: str = command[1]
+                try:
+                    account = factory(bare_jid, pool)
+                    await account.start()
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    log.exception(f"Worker {worker_id} failed to start account {bare_jid}.")
+                    events.put(("failed", worker_id, bare_jid, repr(e)))
+                else:
+                    accounts[bare_jid] = account
+                    events.put(("added", worker_id, bare_jid))
+
+            if command[0] == "remove":
+                bare_jid = command[1]
+                removed = accounts.pop(bare_jid, None)
+                if removed is not None:
+                    try:
+                        await removed.stop()
+                    except Exception:  # pylint: disable=broad-exception-caught
+                        log.exception(f"Worker {worker_id} failed to stop account {bare_jid}.")
+                events.put(("removed", worker_id, bare_jid))
+
+            if command[0] == "stop":
+                break
+    finally:
+        reporter.cancel()
+
+        for bare_jid, account in accounts.items():
+            try:
+                await account.stop()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception(f"Worker {worker_id} failed to stop account {bare_jid}.")
+        accounts.clear()
+
+        report()
+        events.put(("stopped", worker_id))
+
+
+class Supervisor:
+    """
+    Distributes accounts across worker processes by consistent hashing of their bare JIDs, such that the
+    ratchet and XML work of many accounts is spread over multiple cores.
+
+    When workers are added or removed, or a worker process dies, the accounts whose worker changed are moved:
+    the account is stopped on its previous worker first, and started on its new worker once the stop is
+    confirmed, such that an account never runs in two processes at the same time. Each worker hosts its
+    accounts with a :class:`~slixmpp_omemo.session_manager_pool.SessionManagerPool` and reports the pool's
+    stats periodically.
+
+    Warning:
+        The supervisor must be used from a single event loop. The worker processes are spawned, thus the
+        factory and everything it references have to be importable by the worker processes.
+    """
+
+    def __init__(
+        self,
+        factory: AccountFactory,
+        metrics_interval: float = 10.0,
+        replicas: int = 100,
+        max_concurrent_initializations: int = 4,
+        context: Optional[BaseContext] = None
+    ) -> None:
+        """
+        Args:
+            factory: Creates the accounts in the worker processes.
+            metrics_interval: The interval the workers report metrics in, in seconds.
+            replicas: The number of points per worker on the consistent hashing ring.
+            max_concurrent_initializations: The maximum number of session managers to initialize at the same
+                time per worker.
+            context: The multiprocessing context to create the workers with. Defaults to the spawn context.
+        """
+
+        self.__factory = factory
+        self.__metrics_interval = metrics_interval
+        self.__max_concurrent_initializations = max_concurrent_initializations
+        self.__context = multiprocessing.get_context("spawn") if context is None else context
+        self.__events: "Queue[Tuple[Any, ...]]" = self.__context.Queue()
+
+        self.__ring = HashRing(replicas=replicas)
+        self.__workers: Dict[int, _Worker] = {}
+        self.__stopping_workers: Dict[int, _Worker] = {}
+        self.__next_worker_id = 0
+
+        self.__wanted: Set[str] = set()
+        self.__hosts: Dict[str, int] = {}
+        self.__in_transit: Dict[str, int] = {}
+        self.__unconfirmed: Set[str] = set()
+        self.__settled = asyncio.Event()
+        self.__settled.set()
+
+        self.__metrics: Dict[int, Dict[str, int]] = {}
+        self.__stats: Counter[str] = Counter()
+        self.__event_task: Optional[asyncio.Task[None]] = None
+
+    async def start(self, workers: int) -> None:
+        """
+        Start the worker processes.
+
+        Args:
+            workers: The number of worker processes to start.
+        """
+
+        if self.__event_task is None:
+            self.__event_task = asyncio.create_task(self.__process_events())
+
+        for _ in range(workers):
+            self.__spawn()
+
+        self.__rebalance()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Stop all accounts and worker processes.
+
+        Args:
+            timeout: The time to wait for each worker process to exit before terminating it, in seconds.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        for worker_id in list(self.__workers):
+            self.__ring.remove(str(worker_id))
+            worker = self.__workers.pop(worker_id)
+            worker.commands.put(("stop",))
+            self.__stopping_workers[worker_id] = worker
+
+        self.__hosts.clear()
+        self.__in_transit.clear()
+        self.__unconfirmed.clear()
+        self.__settled.set()
+
+        for worker_id, worker in list(self.__stopping_workers.items()):
+            await loop.run_in_executor(None, worker.process.join, timeout)
+            if worker.process.is_alive():
+                log.warning(f"Worker {worker_id} did not exit in time, terminating it.")
+                worker.process.terminate()
+                await loop.run_in_executor(None, worker.process.join)
+
+        if self.__event_task is not None:
+            self.__event_task.cancel()  # pylint: disable=no-member
+            try:
+                await self.__event_task
+            except asyncio.CancelledError:
+                pass
+            self.__event_task = None
+
+        self.__stopping_workers.clear()
+
+    @property
+    def workers(self) -> FrozenSet[int]:
+        """
+        Returns:
+            The ids of the running workers.
+        """
+
+        return frozenset(self.__workers)
+
+    @property
+    def assignments(self) -> Dict[str, int]:
+        """
+        Returns:
+            The worker each account is currently started on or being started on. Accounts that are being moved
+            are omitted.
+        """
+
+        return dict(self.__hosts)
+
+    @property
+    def metrics(self) -> Dict[int, Dict[str, int]]:
+        """
+        Returns:
+            The last metrics reported by each running worker: the stats of its session manager pool, see
+            :attr:`~slixmpp_omemo.session_manager_pool.SessionManagerPool.stats`, and ``worker_accounts``,
+            the number of accounts it hosts.
+        """
+
+        return { worker_id: dict(metrics) for worker_id, metrics in self.__metrics.items() }
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            The metrics of all running workers summed up and the counters of the supervisor. Counters that are
+            zero are omitted.
+
+            - ``supervisor_workers``: the number of running workers.
+            - ``supervisor_accounts``: the number of accounts to host.
+            - ``supervisor_moves``: accounts moved from one worker to another.
+            - ``supervisor_account_failures``: accounts that failed to start.
+            - ``supervisor_worker_failures``: worker processes that died unexpectedly.
+        """
+
+        stats: Counter[str] = Counter()
+        for metrics in self.__metrics.values():
+            stats.update(metrics)
+
+        stats.update(self.__stats)
+        stats["supervisor_workers"] = len(self.__workers)
+        stats["supervisor_accounts"] = len(self.__wanted)
+
+        return { key: value for key, value in stats.items() if value != 0 }
+
+    async def add_worker(self) -> int:
+        """
+        Start a worker process and move the accounts it is responsible for to it.
+
+        Returns:
+            The id of the new worker.
+        """
+
+        worker_id = self.__spawn()
+        self.__rebalance()
+
+        return worker_id
+
+    async def remove_worker(self, worker_id: int) -> None:
+        """
+        Move the accounts of a worker to the remaining workers and stop its process.
+
+        Args:
+            worker_id: The id of the worker.
+
+        Raises:
+            KeyError: if there is no running worker with this id.
+        """
+
+        worker = self.__workers.pop(worker_id)
+        self.__ring.remove(str(worker_id))
+        self.__stopping_workers[worker_id] = worker
+
+        # The removals are queued before the stop command, thus the accounts are stopped cleanly and
+        # confirmed before the process exits
+        for bare_jid, host in list(self.__hosts.items()):
+            if host == worker_id:
+                self.__move_away(bare_jid, worker)
+
+        worker.commands.put(("stop",))
+
+        self.__rebalance()
+
+    async def add_account(self, bare_jid: str) -> None:
+        """
+        Args:
+            bare_jid: The bare JID of the account to host. Nothing happens if it is hosted already.
+        """
+
+        self.__wanted.add(bare_jid)
+        self.__rebalance()
+
+    async def remove_account(self, bare_jid: str) -> None:
+        """
+        Args:
+            bare_jid: The bare JID of the account to stop hosting. Nothing happens if it is not hosted.
+        """
+
+        self.__wanted.discard(bare_jid)
+        self.__rebalance()
+
+    async def wait_settled(self) -> None:
+        """
+        Wait until all accounts are started on their workers and no account is being moved.
+        """
+
+        await self.__settled.wait()
+
+    def __spawn(self) -> int:
+        """
+        Returns:
+            The id of the new worker.
+        """
+
+        worker_id = self.__next_worker_id
+        self.__next_worker_id += 1
+
+        commands: "Queue[Tuple[Any, ...]]" = self.__context.Queue()
+        process = self.__context.Process(  # type: ignore[attr-defined]
+            target=_worker_main,
+            args=(
+                worker_id,
+                self.__factory,
+                commands,
+                self.__events,
+                self.__metrics_interval,
+                self.__max_concurrent_initializations
+            ),
+            name=f"slixmpp-omemo-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+
+        self.__workers[worker_id] = _Worker(process, commands)
+        self.__ring.add(str(worker_id))
+
+        return worker_id
+
+    def __move_away(self, bare_jid: str, worker: _Worker) -> None:
+        """
+        Stop an account on its current worker.
+
+        Args:
+            bare_jid: The bare JID of the account.
+            worker: The worker currently hosting the account.
+        """
+
+        worker_id = self.__hosts.pop(bare_jid)
+        self.__unconfirmed.discard(bare_jid)
+        self.__in_transit[bare_jid] = worker_id
+        worker.commands.put(("remove", bare_jid))
+
+    def __rebalance(self) -> None:
+        """
+        Start, stop and move accounts such that each wanted account is hosted by the worker it hashes to.
+        """
+
+        for bare_jid, worker_id in list(self.__hosts.items()):
+            if bare_jid not in self.__wanted:
+                self.__move_away(bare_jid, self.__workers[worker_id])
+
+        if len(self.__workers) > 0:
+            for bare_jid in sorted(self.__wanted):
+                if bare_jid in self.__in_transit:
+                    continue
+
+                target = int(self.__ring.node_for(bare_jid))
+                host = self.__hosts.get(bare_jid)
+
+                if host is None:
+                    self.__hosts[bare_jid] = target
+                    self.__unconfirmed.add(bare_jid)
+                    self.__workers[target].commands.put(("add", bare_jid))
+
+                elif host != target:
+                    self.__stats["supervisor_moves"] += 1
+                    self.__move_away(bare_jid, self.__workers[host])
+
+        if len(self.__in_transit) == 0 and len(self.__unconfirmed) == 0:
+            self.__settled.set()
+        else:
+            self.__settled.clear()
+
+    def __check_workers(self) -> None:
+        """
+        Detect worker processes that died and reassign their accounts.
+        """
+
+        for worker_id, worker in list(self.__workers.items()):
+            if worker.process.is_alive():
+                continue
+
+            log.warning(f"Worker {worker_id} died with exit code {worker.process.exitcode}.")
+            self.__stats["supervisor_worker_failures"] += 1
+
+            del self.__workers[worker_id]
+            self.__metrics.pop(worker_id, None)
+            self.__ring.remove(str(worker_id))
+
+            for bare_jid, host in list(self.__hosts.items()):
+                if host == worker_id:
+                    del self.__hosts[bare_jid]
+                    self.__unconfirmed.discard(bare_jid)
+
+            for bare_jid, host in list(self.__in_transit.items()):
+                if host == worker_id:
+                    del self.__in_transit[bare_jid]
+
+            self.__rebalance()
+
+        for worker_id, worker in list(self.__stopping_workers.items()):
+            if not worker.process.is_alive():
+                del self.__stopping_workers[worker_id]
+                self.__metrics.pop(worker_id, None)
+
+                for bare_jid, host in list(self.__in_transit.items()):
+                    if host == worker_id:
+                        del self.__in_transit[bare_jid]
+
+                self.__rebalance()
+
+    async def __process_events(self) -> None:
+        """
+        Process the events sent by the workers and check the health of the worker processes.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                event = await loop.run_in_executor(None, self.__events.get, True, 0.5)
+            except queue.Empty:
+                self.__check_workers()
+                continue
+
+            kind: str = event[0]
+            worker_id: int = event[1]
+
+            if kind == "metrics":
+                if worker_id in self.__workers or worker_id in self.__stopping_workers:
+                    self.__metrics[worker_id] = event[2]
+
+            if kind == "added":
+                if self.__hosts.get(event[2]) == worker_id:
+                    self.__unconfirmed.discard(event[2])
+
+            if kind == "failed":
+                log.warning(f"Account {event[2]} failed to start on worker {worker_id}: {event[3]}")
+                self.__stats["supervisor_account_failures"] += 1
+                if self.__hosts.get(event[2]) == worker_id:
+                    self.__unconfirmed.discard(event[2])
+
+            if kind == "removed":
+                if self.__in_transit.get(event[2]) == worker_id:
+                    del self.__in_transit[event[2]]
+
+            if kind == "stopped":
+                self.__stopping_workers.pop(worker_id, None)
+                self.__metrics.pop(worker_id, None)
+
+            self.__rebalance()
+            self.__check_workers()
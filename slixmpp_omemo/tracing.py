@@ -0,0 +1,237 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Coroutine, NamedTuple, Optional, TextIO, TypeVar
+
+from omemo.types import JSONType
+
+from slixmpp.exceptions import IqError, IqTimeout
+from slixmpp.jid import JID
+
+from .circuit_breaker import CircuitOpen
+from .deadline import DeadlineExceeded
+
+
+__all__ = [
+    "JSONLinesSpanExporter",
+    "Span",
+    "SpanExporter",
+    "trace"
+]
+
+
+log = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+
+
+class Span(NamedTuple):
+    # pylint: disable=invalid-name
+    """
+    A single pubsub request, performed as part of an operation of the session manager.
+    """
+
+    operation: str
+    """
+    The session manager operation, e.g. ``"download_bundle"``.
+    """
+
+    request: str
+    """
+    The pubsub request, i.e. the name of the :class:`XEP_0060` method, e.g. ``"get_items"``.
+    """
+
+    jid: str
+    """
+    The JID of the pubsub service.
+    """
+
+    node: str
+    """
+    The pubsub node.
+    """
+
+    path: str
+    """
+    The retry/fallback path of the operation that led to this request, e.g. ``"max_items"`` for the first
+    attempt of a device list download and ``"full"`` for the fallback without ``max_items``. Requests sent to
+    reconfigure a node before publishing again have ``"/reconfigure"`` appended. Operations without fallback
+    use ``"default"``.
+    """
+
+    outcome: str
+    """
+    ``"success"``, ``"error:<condition>"`` for error responses, ``"timeout"``, ``"refused"`` if the request
+    was not sent because the domain is considered unhealthy, ``"deadline"`` if the request was abandoned due
+    to the deadline of an encryption, ``"cancelled"`` or ``"exception:<type>"`` for other failures.
+    """
+
+    start: float
+    """
+    The time at which the request was started, in seconds since the epoch.
+    """
+
+    duration: float
+    """
+    The duration of the request in seconds.
+    """
+
+    def serialize(self) -> JSONType:
+        """
+        Returns:
+            The span in a JSON-serializable form.
+        """
+
+        return {
+            "operation": self.operation,
+            "request": self.request,
+            "jid": self.jid,
+            "node": self.node,
+            "path": self.path,
+            "outcome": self.outcome,
+            "start": self.start,
+            "duration": self.duration
+        }
+
+
+class SpanExporter(ABC):
+    """
+    Receives finished spans, e.g. to write them to a file or forward them to a tracing system.
+
+    Assign an exporter to the ``span_exporter`` config option of the plugin to find out where the time spent
+    on pubsub interactions goes. Every pubsub request sent to upload, download or delete bundles and device
+    lists and to manage device list subscriptions is then reported as a :class:`Span`, including the node, the
+    JID, the retry/fallback path taken, the outcome and the duration.
+    """
+
+    @abstractmethod
+    def export(self, span: Span) -> None:
+        """
+        Export a finished span. Called on the event loop, thus implementations should not block for long.
+
+        Args:
+            span: The span.
+        """
+
+
+class JSONLinesSpanExporter(SpanExporter):
+    """
+    Appends spans to a file, one JSON object per line. The file is opened on the first export and kept open,
+    lines are flushed as they are written.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path: The path of the file to append to.
+        """
+
+        self.__path = path
+        self.__file: Optional[TextIO] = None
+
+    def export(self, span: Span) -> None:
+        if self.__file is None:
+            # Line buffered, such that every span is flushed right away
+            self.__file = open(  # pylint: disable=consider-using-with
+                self.__path,
+                "a",
+                encoding="utf-8",
+                buffering=1
+            )
+
+        self.__file.write(json.dumps(span.serialize()) + "\n")  # pylint: disable=no-member
+
+    def close(self) -> None:
+        """
+        Close the file. A later export opens it again.
+        """
+
+        if self.__file is not None:
+            self.__file.close()  # pylint: disable=no-member
+            self.__file = None
+
+
+def _outcome(exception: Optional[BaseException]) -> str:
+    """
+    Args:
+        exception: The exception raised by a request, or ``None`` if it succeeded.
+
+    Returns:
+        The outcome of the request, as described in :attr:`Span.outcome`.
+    """
+
+    if exception is None:
+        return "success"
+    if isinstance(exception, IqError):
+        return f"error:{exception.condition}"
+    if isinstance(exception, IqTimeout):
+        return "timeout"
+    if isinstance(exception, CircuitOpen):
+        return "refused"
+    if isinstance(exception, DeadlineExceeded):
+        return "deadline"
+    if isinstance(exception, asyncio.CancelledError):
+        return "cancelled"
+
+    return f"exception:{type(exception).__name__}"
+
+
+async def trace(
+    exporter: Optional[SpanExporter],
+    operation: str,
+    request: str,
+    jid: JID,
+    node: str,
+    path: str,
+    coroutine: Coroutine[Any, Any, T]
+) -> T:
+    """
+    Await a pubsub request and export a span describing it.
+
+    Args:
+        exporter: The exporter to pass the span to. If ``None``, the request is awaited without tracing.
+        operation: The session manager operation, see :attr:`Span.operation`.
+        request: The pubsub request, see :attr:`Span.request`.
+        jid: The JID of the pubsub service.
+        node: The pubsub node.
+        path: The retry/fallback path, see :attr:`Span.path`.
+        coroutine: The coroutine performing the request.
+
+    Returns:
+        The result of the request.
+
+    Raises:
+        Exception: all exceptions raised by the request are forwarded as-is. Exceptions raised by the exporter
+            are logged and don't affect the request.
+    """
+
+    if exporter is None:
+        return await coroutine
+
+    start = time.time()
+    start_counter = time.perf_counter()
+    exception: Optional[BaseException] = None
+
+    try:
+        return await coroutine
+    except BaseException as e:
+        exception = e
+        raise
+    finally:
+        # Tracing must never change the outcome of the request
+        try:
+            exporter.export(Span(
+                operation=operation,
+                request=request,
+                jid=str(jid),
+                node=node,
+                path=path,
+                outcome=_outcome(exception),
+                start=start,
+                duration=time.perf_counter() - start_counter
+            ))
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.warning(f"Exporting the span of a {request} request to {jid} failed.", exc_info=True)
@@ -1,9 +1,30 @@
 from abc import ABCMeta, abstractmethod
 import asyncio
+from contextvars import ContextVar
 from copy import copy
+from functools import lru_cache, partial
+import hashlib
 import logging
-from typing import Any, Dict, FrozenSet, Optional, Set, Tuple, Type, Union
+import random
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Counter,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast
+)
 from xml.etree import ElementTree as ET
+import zlib
 
 import omemo
 from omemo.session_manager import EncryptionError, SessionManager
@@ -15,11 +36,12 @@ from omemo.session_manager import (
     DeviceListDownloadFailed,
     DeviceListUploadFailed,
     MessageSendingFailed,
+    NoEligibleDevices,
     SenderNotFound,
     UnknownNamespace
 )
 from omemo.storage import Storage
-from omemo.types import DeviceInformation
+from omemo.types import DeviceInformation, TrustLevel as CoreTrustLevel
 
 import oldmemo
 import oldmemo.etree
@@ -29,7 +51,7 @@ import twomemo.etree
 from xmlschema import XMLSchemaValidationError
 
 from slixmpp.basexmpp import BaseXMPP
-from slixmpp.exceptions import IqError
+from slixmpp.exceptions import IqError, IqTimeout
 from slixmpp.jid import JID
 from slixmpp.plugins.base import BasePlugin
 from slixmpp.plugins.xep_0004 import Form  # type: ignore[attr-defined]
@@ -39,7 +61,17 @@ from slixmpp.plugins.xep_0163 import XEP_0163
 from slixmpp.roster import RosterNode  # type: ignore[attr-defined]
 from slixmpp.stanza import Iq, Message, Presence
 
+from . import fast_etree
 from .base_session_manager import BaseSessionManager, TrustLevel
+from .circuit_breaker import CircuitBreaker, CircuitOpen
+from .deadline import Deadline, DeadlineExceeded
+from .decryption_cache import DecryptionCache, DecryptionOutcome
+from .deferred_delivery import DeferredDeliveryQueue, Recipient
+from .device_activity import DeviceActivity
+from .garbage_collection import GarbageCollectionResult, GarbageCollector
+from .pre_key_refill import PreKeyRefill
+from .session_manager_pool import SessionManagerPool
+from .tracing import SpanExporter, trace
 
 
 __all__ = [
@@ -50,6 +82,48 @@ __all__ = [
 TWOMEMO_DEVICE_LIST_NODE = "urn:xmpp:omemo:2:devices"
 OLDMEMO_DEVICE_LIST_NODE = "eu.siacs.conversations.axolotl.devicelist"
 
+SUBSCRIPTION_INDEX_KEY = "/slixmpp/subscription_index"
+SUBSCRIPTION_INDEX_BUCKETS = 64
+
+XML_VALIDATION_POLICIES = frozenset({ "always", "sampled", "structural" })
+"""
+The policies for the ``xml_validation`` config option. Device lists, bundles and messages are validated
+against the XML schemas given in the specification under the default policy, ``"always"``, which dominates
+the CPU time spent per stanza. ``"structural"`` parses using the structural checks in
+:mod:`slixmpp_omemo.fast_etree` only, ``"sampled"`` validates a random fraction of elements given by
+``xml_validation_sample_rate`` against the schemas and checks the others structurally. Malformed input is
+rejected under all policies.
+"""
+
+EncryptedElements = Tuple[Tuple[str, ET.Element], ...]
+
+ENCRYPTED_TAGS = {
+    f"{{{twomemo.twomemo.NAMESPACE}}}encrypted": twomemo.twomemo.NAMESPACE,
+    f"{{{oldmemo.oldmemo.NAMESPACE}}}encrypted": oldmemo.oldmemo.NAMESPACE
+}
+
+STORE_HINT = ET.Element("{urn:xmpp:hints}store")
+
+# Error conditions that indicate a problem with the remote server rather than with the requested node
+REMOTE_FAILURE_CONDITIONS = frozenset({ "remote-server-not-found", "remote-server-timeout" })
+
+# The recipients a deferred message is currently being delivered to, set while retrying deferred deliveries.
+# Other devices are treated as distrusted in that context, such that key elements are only built for the
+# recipients and the devices that got the message already don't receive it again.
+DELIVERY_TARGETS: ContextVar[Optional[FrozenSet[Recipient]]] = ContextVar("delivery_targets", default=None)
+
+# The deadline of the encryption currently in progress, if any. Pubsub requests performed in that context are
+# abandoned when the deadline expires.
+ENCRYPTION_DEADLINE: ContextVar[Optional[Deadline]] = ContextVar("encryption_deadline", default=None)
+
+# The devices left out of the encryption currently in progress due to inactivity. They are treated as
+# distrusted in that context only, such that messages they send are still decrypted.
+INACTIVE_DEVICES: ContextVar[FrozenSet[Tuple[str, int]]] = ContextVar("inactive_devices", default=frozenset())
+
+# The background pre key refill, set while decrypting if enabled. Bundle uploads caused by consumed pre keys
+# are handed to the refill in that context instead of being performed inline.
+PRE_KEY_REFILL: ContextVar[Optional[PreKeyRefill]] = ContextVar("pre_key_refill", default=None)
+
 
 log = logging.getLogger(__name__)
 
@@ -76,13 +150,59 @@ def _make_options_form(form_type: str, fields: Dict[str, Any]) -> Form:
     return form
 
 
+@lru_cache(maxsize=None)
+def _make_fallback_body(namespace: str, text: str) -> ET.Element:
+    """
+    Build the fallback body element for encrypted messages. The result is cached and must not be modified;
+    append copies of it instead.
+
+    Args:
+        namespace: The namespace of the stanzas the body is used in.
+        text: The fallback text.
+
+    Returns:
+        The body element.
+    """
+
+    body = ET.Element(f"{{{namespace}}}body")
+    body.text = text
+    return body
+
+
+def _make_encrypted_stanza(stanza: Message, message_elt: ET.Element, fallback_message: str) -> Message:
+    """
+    Build the outgoing stanza for an encrypted message. Only the attributes of the source stanza are kept,
+    thus the new stanza is built from those directly instead of copying the whole source stanza and clearing
+    it.
+
+    Args:
+        stanza: The source stanza.
+        message_elt: The serialized OMEMO message element.
+        fallback_message: The text of the fallback body.
+
+    Returns:
+        A new stanza with the attributes of the source stanza, containing the OMEMO message element, the
+        fallback body and the store hint.
+    """
+
+    xml = ET.Element(stanza.xml.tag, stanza.xml.attrib)
+    xml.append(message_elt)
+    xml.append(copy(_make_fallback_body(stanza.namespace, fallback_message)))
+    xml.append(copy(STORE_HINT))
+
+    return stanza.__class__(stream=stanza.stream, xml=xml)
+
+
 async def _publish_item_and_configure_node(
     xep_0060: XEP_0060,
     service: str,
     node: str,
     item: ET.Element,
     item_id: str,
-    options: Dict[str, str]
+    options: Dict[str, str],
+    span_exporter: Optional[SpanExporter],
+    operation: str,
+    path: str
 ) -> None:
     """
     Publishes an item and makes sure that the node is configured correctly.
@@ -95,6 +215,10 @@ async def _publish_item_and_configure_node(
         item_id: The item id to assign to the published item.
         options: The configuration required on the target node. The configuration is applied either
             dynamically using publish options or manually using pubsub node configuration.
+        span_exporter: The exporter to trace the pubsub requests with, if any.
+        operation: The session manager operation the item is published for, used for tracing.
+        path: The retry/fallback path of the operation, used for tracing. The requests sent to reconfigure the
+            node are traced with ``/reconfigure`` appended.
 
     Raises:
         Exception: all exceptions raised by :meth:`XEP_0060.publish` and :meth:`XEP_0060.set_node_config` are
@@ -105,7 +229,15 @@ async def _publish_item_and_configure_node(
     node_config_form = _make_options_form("http://jabber.org/protocol/pubsub#node_config", options)
 
     try:
-        await xep_0060.publish(JID(service), node, item_id, item, publish_options_form)
+        await trace(
+            span_exporter,
+            operation,
+            "publish",
+            JID(service),
+            node,
+            path,
+            xep_0060.publish(JID(service), node, item_id, item, publish_options_form)
+        )
     except IqError as e:
         # There doesn't seem to be a clean way to find the error condition from an IqError yet.
         if e.iq["error"].xml.find("{http://jabber.org/protocol/pubsub#errors}precondition-not-met") is None:
@@ -113,10 +245,26 @@ async def _publish_item_and_configure_node(
 
         # precondition-not-met is raised in case the node already exists with different configuration. Try
         # to manually reconfigure the node as needed.
-        await xep_0060.set_node_config(JID(service), node, node_config_form)
+        await trace(
+            span_exporter,
+            operation,
+            "set_node_config",
+            JID(service),
+            node,
+            f"{path}/reconfigure",
+            xep_0060.set_node_config(JID(service), node, node_config_form)
+        )
 
         # Attempt to publish the item again. This time, precondition-not-met should not fire.
-        await xep_0060.publish(JID(service), node, item_id, item, publish_options_form)
+        await trace(
+            span_exporter,
+            operation,
+            "publish",
+            JID(service),
+            node,
+            f"{path}/reconfigure",
+            xep_0060.publish(JID(service), node, item_id, item, publish_options_form)
+        )
 
 
 def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionManager]:
@@ -139,6 +287,11 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
     class SessionManagerImpl(BaseSessionManager):
         @staticmethod
         async def _upload_bundle(bundle: omemo.Bundle) -> None:
+            pre_key_refill = PRE_KEY_REFILL.get()
+            if pre_key_refill is not None:
+                pre_key_refill.request(bundle.namespace)
+                return
+
             if isinstance(bundle, twomemo.twomemo.BundleImpl):
                 node = "urn:xmpp:omemo:2:bundles"
                 item = twomemo.etree.serialize_bundle(bundle)
@@ -154,7 +307,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                             "pubsub#access_model": "open",
                             "pubsub#persist_items": "true",
                             "pubsub#max_items": "max"
-                        }
+                        },
+                        span_exporter=xep_0384.span_exporter,
+                        operation="upload_bundle",
+                        path="max_items"
                     )
                 except Exception:  # pylint: disable=broad-exception-caught
                     # Try again without MAX_ITEMS set, which is not strictly necessary.
@@ -168,7 +324,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                             options={
                                 "pubsub#access_model": "open",
                                 "pubsub#persist_items": "true"
-                            }
+                            },
+                            span_exporter=xep_0384.span_exporter,
+                            operation="upload_bundle",
+                            path="without_max_items"
                         )
                     except Exception as e:
                         raise BundleUploadFailed(f"Bundle upload failed: {bundle}") from e
@@ -190,7 +349,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                             "pubsub#access_model": "open",
                             "pubsub#persist_items": "true",
                             "pubsub#max_items": "1"
-                        }
+                        },
+                        span_exporter=xep_0384.span_exporter,
+                        operation="upload_bundle",
+                        path="max_items"
                     )
                 except Exception:  # pylint: disable=broad-exception-caught
                     # Try again without MAX_ITEMS set, which is not strictly necessary.
@@ -204,7 +366,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                             options={
                                 "pubsub#access_model": "open",
                                 "pubsub#persist_items": "true"
-                            }
+                            },
+                            span_exporter=xep_0384.span_exporter,
+                            operation="upload_bundle",
+                            path="without_max_items"
                         )
                     except Exception as e:
                         raise BundleUploadFailed(f"Bundle upload failed: {bundle}") from e
@@ -215,14 +380,31 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
 
         @staticmethod
         async def _download_bundle(namespace: str, bare_jid: str, device_id: int) -> omemo.Bundle:
+            # Bundles downloaded earlier in an encryption with a deadline are reused
+            deadline = ENCRYPTION_DEADLINE.get()
+            if deadline is not None and (namespace, bare_jid, device_id) in deadline.bundles:
+                return deadline.bundles[(namespace, bare_jid, device_id)]
+
             items_iq: Optional[Iq] = None
             try:
                 if namespace == twomemo.twomemo.NAMESPACE:
                     node = "urn:xmpp:omemo:2:bundles"
-                    items_iq = await xep_0060.get_items(JID(bare_jid), node, item_ids=[ str(device_id) ])
+                    items_iq = await xep_0384._get_items(  # pylint: disable=protected-access
+                        JID(bare_jid),
+                        node,
+                        operation="download_bundle",
+                        path="item_ids",
+                        item_ids=[ str(device_id) ]
+                    )
                 if namespace == oldmemo.oldmemo.NAMESPACE:
                     node = f"eu.siacs.conversations.axolotl.bundles:{device_id}"
-                    items_iq = await xep_0060.get_items(JID(bare_jid), node, max_items=1)
+                    items_iq = await xep_0384._get_items(  # pylint: disable=protected-access
+                        JID(bare_jid),
+                        node,
+                        operation="download_bundle",
+                        path="max_items",
+                        max_items=1
+                    )
             except Exception as e:
                 if isinstance(e, IqError):
                     if e.condition == "item-not-found":
@@ -231,6 +413,9 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                             f" node doesn't exist."
                         ) from e
 
+                if isinstance(e, DeadlineExceeded) and deadline is not None:
+                    deadline.skipped_bundles.add((namespace, bare_jid, device_id))
+
                 raise BundleDownloadFailed(
                     f"Bundle download failed for {bare_jid}: {device_id} under namespace {namespace}"
                 ) from e
@@ -260,16 +445,23 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                 )
 
             try:
-                if namespace == twomemo.twomemo.NAMESPACE:
-                    return twomemo.etree.parse_bundle(bundle_elt, bare_jid, device_id)
-                if namespace == oldmemo.oldmemo.NAMESPACE:
-                    return oldmemo.etree.parse_bundle(bundle_elt, bare_jid, device_id)
+                bundle = xep_0384._parse_bundle(  # pylint: disable=protected-access
+                    namespace,
+                    bundle_elt,
+                    bare_jid,
+                    device_id
+                )
+            except UnknownNamespace:
+                raise
             except Exception as e:
                 raise BundleDownloadFailed(
                     f"Bundle parsing failed for {bare_jid}: {device_id} under namespace {namespace}"
                 ) from e
 
-            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+            if deadline is not None:
+                deadline.bundles[(namespace, bare_jid, device_id)] = bundle
+
+            return bundle
 
         @staticmethod
         async def _delete_bundle(namespace: str, device_id: int) -> None:
@@ -277,7 +469,15 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                 node = "urn:xmpp:omemo:2:bundles"
 
                 try:
-                    await xep_0060.retract(JID(our_bare_jid), node, [ str(device_id) ], notify=False)
+                    await trace(
+                        xep_0384.span_exporter,
+                        "delete_bundle",
+                        "retract",
+                        JID(our_bare_jid),
+                        node,
+                        "default",
+                        xep_0060.retract(JID(our_bare_jid), node, [ str(device_id) ], notify=False)
+                    )
                 except Exception as e:
                     if isinstance(e, IqError):
                         if e.condition == "item-not-found":
@@ -293,7 +493,15 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                 node = f"eu.siacs.conversations.axolotl.bundles:{device_id}"
 
                 try:
-                    await xep_0060.delete_node(JID(our_bare_jid), node)
+                    await trace(
+                        xep_0384.span_exporter,
+                        "delete_bundle",
+                        "delete_node",
+                        JID(our_bare_jid),
+                        node,
+                        "default",
+                        xep_0060.delete_node(JID(our_bare_jid), node)
+                    )
                 except Exception as e:
                     if isinstance(e, IqError):
                         if e.condition == "item-not-found":
@@ -334,7 +542,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                         "pubsub#access_model": "open",
                         "pubsub#persist_items": "true",
                         "pubsub#max_items": "1"
-                    }
+                    },
+                    span_exporter=xep_0384.span_exporter,
+                    operation="upload_device_list",
+                    path="max_items"
                 )
             except Exception:  # pylint: disable=broad-exception-caught
                 try:
@@ -348,7 +559,10 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                         options={
                             "pubsub#access_model": "open",
                             "pubsub#persist_items": "true"
-                        }
+                        },
+                        span_exporter=xep_0384.span_exporter,
+                        operation="upload_device_list",
+                        path="without_max_items"
                     )
                 except Exception as e:
                     raise DeviceListUploadFailed(
@@ -368,19 +582,35 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                 raise UnknownNamespace(f"Unknown namespace: {namespace}")
 
             try:
-                items_iq = await xep_0060.get_items(JID(bare_jid), node, max_items=1)
+                items_iq = await xep_0384._get_items(  # pylint: disable=protected-access
+                    JID(bare_jid),
+                    node,
+                    operation="download_device_list",
+                    path="max_items",
+                    max_items=1
+                )
             except Exception as e:  # pylint: disable=broad-exception-caught
                 if isinstance(e, IqError):
                     if e.condition == "item-not-found":
                         return {}
 
+                if isinstance(e, (CircuitOpen, DeadlineExceeded)):
+                    raise DeviceListDownloadFailed(
+                        f"Device list download skipped for {bare_jid} under namespace {namespace}: {e}"
+                    ) from e
+
                 log.warning(
                     f"Device list download failed for {bare_jid} under namespace {namespace}, trying again"
                     f" without max_items"
                 )
 
                 try:
-                    items_iq = await xep_0060.get_items(JID(bare_jid), node)
+                    items_iq = await xep_0384._get_items(  # pylint: disable=protected-access
+                        JID(bare_jid),
+                        node,
+                        operation="download_device_list",
+                        path="full"
+                    )
                 except Exception as ex:
                     if isinstance(ex, IqError):
                         if ex.condition == "item-not-found":
@@ -409,11 +639,13 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                 )
 
             try:
-                if namespace == twomemo.twomemo.NAMESPACE:
-                    return twomemo.etree.parse_device_list(device_list_elt)
-                if namespace == oldmemo.oldmemo.NAMESPACE:
-                    return oldmemo.etree.parse_device_list(device_list_elt)
-            except XMLSchemaValidationError as e:
+                return xep_0384._parse_device_list(  # pylint: disable=protected-access
+                    namespace,
+                    device_list_elt
+                )
+            except UnknownNamespace:
+                raise
+            except (XMLSchemaValidationError, ValueError) as e:
                 log.warning(
                     f"Malformed device list for {bare_jid} under namespace {namespace}, treating as empty",
                     exc_info=e
@@ -424,7 +656,26 @@ def _make_session_manager(xmpp: BaseXMPP, xep_0384: "XEP_0384") -> Type[SessionM
                     f"Device list download failed for {bare_jid} under namespace {namespace}"
                 ) from e
 
-            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+        async def update_device_list(
+            self,
+            namespace: str,
+            bare_jid: str,
+            device_list: Dict[int, Optional[str]]
+        ) -> None:
+            await super().update_device_list(namespace, bare_jid, device_list)
+
+            xep_0384._device_list_updated(bare_jid)  # pylint: disable=protected-access
+
+        async def _evaluate_custom_trust_level(self, device: DeviceInformation) -> CoreTrustLevel:
+            targets = DELIVERY_TARGETS.get()
+            recipients = { (device.bare_jid, device.device_id), (device.bare_jid, None) }
+            if targets is not None and not targets & recipients:
+                return CoreTrustLevel.DISTRUSTED
+
+            if (device.bare_jid, device.device_id) in INACTIVE_DEVICES.get():
+                return CoreTrustLevel.DISTRUSTED
+
+            return await super()._evaluate_custom_trust_level(device)
 
         @property
         def _btbv_enabled(self) -> bool:
@@ -511,19 +762,25 @@ async def _prepare(
         Exception: all exceptions raised by :meth:`SessionManager.create` are forwarded as-is.
     """
 
+    # The preparation runs in its own task, which must not inherit the deadline of an encryption that
+    # happened to trigger it
+    ENCRYPTION_DEADLINE.set(None)
+
+    backends: List[omemo.Backend] = [
+        twomemo.Twomemo(
+            storage,
+            max_num_per_session_skipped_keys,
+            max_num_per_message_skipped_keys
+        ),
+        oldmemo.Oldmemo(
+            storage,
+            max_num_per_session_skipped_keys,
+            max_num_per_message_skipped_keys
+        )
+    ]
+
     session_manager = await _make_session_manager(xmpp, xep_0384).create(
-        [
-            twomemo.Twomemo(
-                storage,
-                max_num_per_session_skipped_keys,
-                max_num_per_message_skipped_keys
-            ),
-            oldmemo.Oldmemo(
-                storage,
-                max_num_per_session_skipped_keys,
-                max_num_per_message_skipped_keys
-            )
-        ],
+        backends,
         storage,
         xmpp.boundjid.bare,
         initial_own_label=None,
@@ -543,6 +800,9 @@ async def _prepare(
     # history sync starts and ends (MAM, MUC catch-up, etc.) and to react to those triggers.
     await session_manager.after_history_sync()
 
+    if xep_0384.background_pre_key_refill:
+        await xep_0384._start_pre_key_refill(session_manager, backends)  # pylint: disable=protected-access
+
     return session_manager
 
 
@@ -575,7 +835,41 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
     dependencies = { "xep_0004", "xep_0030", "xep_0060", "xep_0163", "xep_0280", "xep_0334" }
     default_config = {
         # TODO: Improve fallback text :)
-        "fallback_message": "This message is OMEMO encrypted."
+        "fallback_message": "This message is OMEMO encrypted.",
+        # See reconcile_subscriptions
+        "subscription_reconciliation_concurrency": 4,
+        "subscription_reconciliation_rate": 10.0,
+        # See XML_VALIDATION_POLICIES
+        "xml_validation": "always",
+        "xml_validation_sample_rate": 0.1,
+        # See slixmpp_omemo.decryption_cache
+        "decryption_cache_size": 0,
+        "decryption_cache_max_age": 7 * 24 * 60 * 60,
+        "decryption_cache_persistent": False,
+        "decryption_cache_key": None,
+        # See encrypt_message and retry_deferred_deliveries
+        "deferred_delivery": False,
+        "deferred_delivery_key": None,
+        "deferred_delivery_retry_interval": 5 * 60,
+        "deferred_delivery_max_age": 7 * 24 * 60 * 60,
+        # See slixmpp_omemo.circuit_breaker
+        "pubsub_failure_threshold": 3,
+        "pubsub_reset_timeout": 30.0,
+        "pubsub_max_reset_timeout": 10 * 60.0,
+        # See slixmpp_omemo.tracing
+        "span_exporter": None,
+        # See slixmpp_omemo.garbage_collection
+        "garbage_collection": False,
+        "garbage_collection_interval": 24 * 60 * 60,
+        "garbage_collection_max_inactive_age": 90 * 24 * 60 * 60,
+        "garbage_collection_batch_size": 100,
+        # See slixmpp_omemo.device_activity
+        "inactive_device_max_age": None,
+        # See slixmpp_omemo.session_manager_pool
+        "session_manager_pool": None,
+        # See slixmpp_omemo.pre_key_refill
+        "background_pre_key_refill": False,
+        "background_pre_key_refill_delay": 1.0
     }
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
@@ -583,8 +877,33 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
         self.__session_manager: Optional[SessionManager] = None
         self.__session_manager_task: Optional[asyncio.Task[SessionManager]] = None
+        self.__subscription_index_lock = asyncio.Lock()
+        self.__reconciliation_task: Optional[asyncio.Task[None]] = None
+        self.__reconciliation_requested = False
+        self.__stats: Counter[str] = Counter()
+        self.__decryption_cache: Optional[DecryptionCache] = None
+        self.__deferred_delivery_queue: Optional[DeferredDeliveryQueue] = None
+        self.__deferred_delivery_task: Optional[asyncio.Task[None]] = None
+        self.__deferred_delivery_requested = False
+        self.__deferred_delivery_timer: Optional[asyncio.Task[None]] = None
+        self.__circuit_breaker: Optional[CircuitBreaker] = None
+        self.__garbage_collection_timer: Optional[asyncio.Task[None]] = None
+        self.__device_activity: Optional[DeviceActivity] = None
+        self.__pre_key_refill: Optional[PreKeyRefill] = None
 
     def plugin_init(self) -> None:
+        if self.xml_validation not in XML_VALIDATION_POLICIES:
+            raise ValueError(f"Unknown XML validation policy: {self.xml_validation}")
+        if self.deferred_delivery and self.deferred_delivery_key is None:
+            raise ValueError(
+                "Deferred delivery requires a deferred_delivery_key to encrypt the queued messages with."
+            )
+        if not self.subscription_reconciliation_rate > 0:
+            raise ValueError(
+                "The subscription reconciliation rate must be positive:"
+                f" {self.subscription_reconciliation_rate}"
+            )
+
         xmpp: BaseXMPP = self.xmpp
 
         xep_0060: XEP_0060 = xmpp["xep_0060"]
@@ -597,10 +916,15 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         xmpp.add_event_handler("oldmemo_device_list_publish", self._on_device_list_update)
 
         xmpp.add_event_handler("changed_subscription", self._on_subscription_changed)
+        xmpp.add_event_handler("roster_update", self._on_roster_update)
 
         xep_0163.add_interest(TWOMEMO_DEVICE_LIST_NODE)
         xep_0163.add_interest(OLDMEMO_DEVICE_LIST_NODE)
 
+        pool: Optional[SessionManagerPool] = self.session_manager_pool
+        if pool is not None:
+            pool.register(self)
+
     def plugin_end(self) -> None:
         xmpp: BaseXMPP = self.xmpp
 
@@ -608,14 +932,34 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
         xmpp.del_event_handler("twomemo_device_list_publish", self._on_device_list_update)
         xmpp.del_event_handler("oldmemo_device_list_publish", self._on_device_list_update)
+        xmpp.del_event_handler("roster_update", self._on_roster_update)
 
         xep_0163.remove_interest(TWOMEMO_DEVICE_LIST_NODE)
         xep_0163.remove_interest(OLDMEMO_DEVICE_LIST_NODE)
 
+        pool: Optional[SessionManagerPool] = self.session_manager_pool
+        if pool is not None:
+            pool.unregister(self)
+
         self.__session_manager = None
         if self.__session_manager_task is not None:
             self.__session_manager_task.cancel()  # pylint: disable=no-member
             self.__session_manager_task = None
+        if self.__reconciliation_task is not None:
+            self.__reconciliation_task.cancel()  # pylint: disable=no-member
+            self.__reconciliation_task = None
+        if self.__deferred_delivery_task is not None:
+            self.__deferred_delivery_task.cancel()  # pylint: disable=no-member
+            self.__deferred_delivery_task = None
+        if self.__deferred_delivery_timer is not None:
+            self.__deferred_delivery_timer.cancel()  # pylint: disable=no-member
+            self.__deferred_delivery_timer = None
+        if self.__garbage_collection_timer is not None:
+            self.__garbage_collection_timer.cancel()  # pylint: disable=no-member
+            self.__garbage_collection_timer = None
+        if self.__pre_key_refill is not None:
+            self.__pre_key_refill.close()
+            self.__pre_key_refill = None
 
     def session_bind(self, jid: JID) -> None:
         # Trigger async creation of the session manager
@@ -684,8 +1028,74 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
             replaced by calling :meth:`set_trust` with a different trust level. If they are not replaced or
             still evaluate to the undecided trust level after the call, the encryption will fail with an
             exception. See :meth:`encrypt` for details.
+
+        Note:
+            Trust decisions requested concurrently for the same devices are merged: this method is called only
+            once per device, with the identifier of the call to :meth:`encrypt_message` that requested the
+            decision first. All other calls wait for that decision to complete.
         """
 
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Counters of the work performed, and avoided, by the plugin. The counters are kept in memory and
+            start at zero when the plugin is loaded. Counters that were never incremented are omitted.
+
+            - ``xml_schema_validations``: device lists, bundles and messages parsed with XML schema
+              validation.
+            - ``xml_structural_parses``: device lists, bundles and messages parsed with structural checks
+              only.
+            - ``decryption_cache_hits``: messages whose decryption outcome was served by the decryption cache.
+            - ``decryption_cache_misses``: messages with an id that were looked up in the decryption cache but
+              not found.
+            - ``deferred_deliveries_queued``: (message, recipient) pairs whose delivery was deferred.
+            - ``deferred_deliveries_completed``: deferred (message, recipient) pairs delivered later on.
+            - ``deferred_deliveries_expired``: deferred (message, recipient) pairs dropped after the max age.
+            - ``deferred_deliveries_failed``: deferred (message, device) pairs dropped after a permanent
+              failure.
+            - ``deadline_skipped_devices``: devices not encrypted for because their bundle download was
+              skipped due to the ``timeout`` passed to :meth:`encrypt_message`.
+            - ``pubsub_circuits_opened``: times a remote domain was marked unhealthy, including failed probes.
+            - ``pubsub_requests_refused``: device list and bundle downloads and device list (un)subscriptions
+              refused for unhealthy domains.
+            - ``garbage_collected_devices``: devices whose data was purged by :meth:`collect_garbage`.
+            - ``garbage_collected_bytes``: the JSON-serialized size of the values purged by
+              :meth:`collect_garbage`.
+            - ``garbage_collected_sessions``: listed devices whose sessions were purged by
+              :meth:`collect_garbage` due to inactivity, see ``inactive_device_max_age``.
+            - ``inactive_devices_skipped``: recipient devices left out of encryptions due to inactivity, see
+              ``inactive_device_max_age``.
+            - ``bundle_uploads_deferred``: bundle uploads after consumed pre keys that were handed to the
+              background pre key refill, see ``background_pre_key_refill``.
+            - ``pre_key_refills``: bundles published by the background pre key refill.
+            - ``pre_key_refill_failures``: background pre key refills or bundle uploads that failed.
+            - ``pre_keys_generated``: pre keys generated by the background pre key refill.
+
+            In addition, the following values describe the current state and are included while not zero:
+
+            - ``deferred_delivery_queue_size``: the number of pending (message, recipient) pairs.
+            - ``deferred_delivery_queue_age``: the age of the oldest pending message in whole seconds.
+            - ``pubsub_open_circuits``: the number of domains currently marked unhealthy.
+        """
+
+        stats = dict(self.__stats)
+
+        if self.__pre_key_refill is not None:
+            stats.update(self.__pre_key_refill.stats)
+
+        queue = self.__deferred_delivery_queue
+        oldest_timestamp = None if queue is None else queue.oldest_timestamp
+        if queue is not None and oldest_timestamp is not None:
+            stats["deferred_delivery_queue_size"] = queue.size
+            stats["deferred_delivery_queue_age"] = int(time.time() - oldest_timestamp)
+
+        open_circuits = 0 if self.__circuit_breaker is None else len(self.__circuit_breaker.open_keys)
+        if open_circuits > 0:
+            stats["pubsub_open_circuits"] = open_circuits
+
+        return stats
+
     async def get_session_manager(self) -> SessionManager:
         """
         Access the session manager, which is the main interface to the underlying OMEMO library. A lot of
@@ -703,16 +1113,325 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         # If the session manager is neither available nor currently being built, build it in a way that other
         # tasks can await the build task
         if self.__session_manager_task is None:
-            self.__session_manager_task = asyncio.create_task(_prepare(self.xmpp, self, self.storage))
+            # With the background refill, the library only refills pre keys inline as a last resort
+            prepare = partial(
+                _prepare,
+                self.xmpp,
+                self,
+                self.storage,
+                pre_key_refill_threshold=25 if self.background_pre_key_refill else 99
+            )
+
+            pool: Optional[SessionManagerPool] = self.session_manager_pool
+            self.__session_manager_task = asyncio.create_task(
+                prepare() if pool is None else pool.initialize(prepare)
+            )
             session_manager = await self.__session_manager_task
             self.__session_manager = session_manager
             self.__session_manager_task = None
+            if self.deferred_delivery:
+                # Deliver messages deferred in previous sessions and retry regularly from now on
+                self.__request_deferred_delivery()
+                self.__deferred_delivery_timer = asyncio.create_task(self.__run_deferred_delivery_timer())
+            if self.garbage_collection:
+                self.__garbage_collection_timer = asyncio.create_task(self.__run_garbage_collection_timer())
             self.xmpp.event("omemo_initialized")
             return session_manager
 
         # If the session manager is currently being built, wait for it to be done
         return await self.__session_manager_task
 
+    def _device_list_updated(self, bare_jid: str) -> None:
+        """
+        Called by the session manager whenever the cached device list of a bare JID was updated, regardless of
+        whether the update originates from PEP, a manual refresh or the library itself.
+
+        Args:
+            bare_jid: The bare JID whose device list was updated.
+        """
+
+        # Device lists updated while retrying deferred deliveries are picked up by that retry already
+        queue = self.__deferred_delivery_queue
+        if queue is not None and DELIVERY_TARGETS.get() is None and queue.is_pending(bare_jid):
+            self.__request_deferred_delivery()
+
+    async def _start_pre_key_refill(
+        self,
+        session_manager: SessionManager,
+        backends: List[omemo.Backend]
+    ) -> None:
+        """
+        Called once the session manager is prepared, if the background pre key refill is enabled.
+
+        Args:
+            session_manager: The session manager.
+            backends: The backends loaded by the session manager.
+        """
+
+        device, _ = await session_manager.get_own_device_information()
+
+        async def upload_bundle(bundle: omemo.Bundle) -> None:
+            # The refill runs in a task created while decrypting, its uploads must not be handed back to it
+            PRE_KEY_REFILL.set(None)
+
+            await session_manager._upload_bundle(bundle)  # pylint: disable=protected-access
+
+        if self.__pre_key_refill is not None:
+            self.__pre_key_refill.close()
+
+        self.__pre_key_refill = PreKeyRefill(
+            backends,
+            device.bare_jid,
+            device.device_id,
+            upload_bundle,
+            self.background_pre_key_refill_delay
+        )
+
+    async def _get_items(self, jid: JID, node: str, *, operation: str, path: str, **kwargs: Any) -> Iq:
+        """
+        Retrieve pubsub items via :meth:`XEP_0060.get_items`, with the health of the domain of the JID
+        tracked. Downloads from a domain that repeatedly timed out or reported remote server failures are
+        refused without sending a request, until a probe request to the domain succeeds again.
+
+        Args:
+            jid: The JID of the pubsub service.
+            node: The node to retrieve the items from.
+            operation: The session manager operation the items are retrieved for, used for tracing.
+            path: The retry/fallback path of the operation, used for tracing.
+            kwargs: Further arguments to pass to :meth:`XEP_0060.get_items`.
+
+        Returns:
+            The pubsub items response.
+
+        Raises:
+            CircuitOpen: if the domain is considered unhealthy.
+            DeadlineExceeded: if the deadline of the encryption in progress expired.
+            Exception: all exceptions raised by :meth:`XEP_0060.get_items` are forwarded as-is.
+        """
+
+        return await trace(self.span_exporter, operation, "get_items", jid, node, path, self.__get_items(
+            jid,
+            node,
+            **kwargs
+        ))
+
+    async def __get_items(self, jid: JID, node: str, **kwargs: Any) -> Iq:
+        """
+        Untraced implementation of :meth:`_get_items`.
+        """
+
+        xep_0060: XEP_0060 = self.xmpp["xep_0060"]
+
+        return await self.__send_pubsub_request(jid, lambda: xep_0060.get_items(jid, node, **kwargs))
+
+    async def __send_pubsub_request(self, jid: JID, send: Callable[[], Awaitable[Iq]]) -> Iq:
+        """
+        Send a pubsub request with the health of the domain of the JID tracked, and abandon it if the deadline
+        of the encryption in progress expires.
+
+        Args:
+            jid: The JID of the pubsub service.
+            send: Sends the request. Only called if the domain is considered healthy and the deadline didn't
+                expire yet.
+
+        Returns:
+            The response.
+
+        Raises:
+            CircuitOpen: if the domain is considered unhealthy.
+            DeadlineExceeded: if the deadline of the encryption in progress expired.
+            Exception: all exceptions raised by the request are forwarded as-is.
+        """
+
+        circuit_breaker = self.__get_circuit_breaker()
+        domain = jid.domain
+
+        if not circuit_breaker.allow(domain):
+            self.__stats["pubsub_requests_refused"] += 1
+            raise CircuitOpen(f"The pubsub service of {domain} is considered unhealthy.")
+
+        deadline = ENCRYPTION_DEADLINE.get()
+
+        try:
+            if deadline is not None:
+                deadline.check()
+
+            request = send()
+            response: Iq = await (request if deadline is None else deadline.wait_for(request))
+        except (IqError, IqTimeout) as e:
+            if isinstance(e, IqTimeout) or e.condition in REMOTE_FAILURE_CONDITIONS:
+                if circuit_breaker.record_failure(domain):
+                    log.warning(f"Pubsub requests to {domain} are failing, skipping them for a while.")
+                    self.__stats["pubsub_circuits_opened"] += 1
+            else:
+                # Any other error response proves that the domain is reachable
+                circuit_breaker.record_success(domain)
+            raise
+        except BaseException:
+            # This includes requests abandoned due to the deadline of an encryption, which say nothing about
+            # the health of the domain
+            circuit_breaker.release(domain)
+            raise
+
+        circuit_breaker.record_success(domain)
+
+        return response
+
+    def __get_circuit_breaker(self) -> CircuitBreaker:
+        """
+        Returns:
+            The health tracking of pubsub services, created on first use, or shared by the session manager
+            pool.
+        """
+
+        pool: Optional[SessionManagerPool] = self.session_manager_pool
+        if pool is not None and pool.circuit_breaker is not None:
+            return pool.circuit_breaker
+
+        if self.__circuit_breaker is None:
+            self.__circuit_breaker = CircuitBreaker(
+                self.pubsub_failure_threshold,
+                self.pubsub_reset_timeout,
+                self.pubsub_max_reset_timeout
+            )
+
+        return self.__circuit_breaker
+
+    def __schema_validation_enabled(self) -> bool:
+        """
+        Returns:
+            Whether to parse the next element using the schema-validating parsers of the OMEMO libraries
+            rather than the structural parsers in :mod:`slixmpp_omemo.fast_etree`, according to the
+            ``xml_validation`` policy.
+        """
+
+        if self.xml_validation == "structural":
+            return False
+
+        if self.xml_validation == "sampled":
+            sample_rate: float = self.xml_validation_sample_rate
+            return random.random() < sample_rate
+
+        return True
+
+    def _parse_device_list(self, namespace: str, element: ET.Element) -> Dict[int, Optional[str]]:
+        """
+        Parse a device list according to the ``xml_validation`` policy.
+
+        Args:
+            namespace: The OMEMO version namespace of the device list.
+            element: The XML element to parse the device list from.
+
+        Returns:
+            The extracted device list.
+
+        Raises:
+            UnknownNamespace: if the namespace is unknown.
+            ValueError: in case the element does not match the structure given in the specification.
+            XMLSchemaValidationError: in case the element does not conform to the XML schema given in the
+                specification.
+        """
+
+        if namespace not in { twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE }:
+            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+
+        if self.__schema_validation_enabled():
+            self.__stats["xml_schema_validations"] += 1
+            if namespace == twomemo.twomemo.NAMESPACE:
+                return twomemo.etree.parse_device_list(element)
+            return oldmemo.etree.parse_device_list(element)
+
+        self.__stats["xml_structural_parses"] += 1
+        if namespace == twomemo.twomemo.NAMESPACE:
+            return fast_etree.parse_twomemo_device_list(element)
+        return fast_etree.parse_oldmemo_device_list(element)
+
+    def _parse_bundle(
+        self,
+        namespace: str,
+        element: ET.Element,
+        bare_jid: str,
+        device_id: int
+    ) -> omemo.Bundle:
+        """
+        Parse a bundle according to the ``xml_validation`` policy.
+
+        Args:
+            namespace: The OMEMO version namespace of the bundle.
+            element: The XML element to parse the bundle from.
+            bare_jid: The bare JID this bundle belongs to.
+            device_id: The device id of the specific device this bundle belongs to.
+
+        Returns:
+            The extracted bundle.
+
+        Raises:
+            UnknownNamespace: if the namespace is unknown.
+            ValueError: in case the element does not match the structure given in the specification, or in
+                case of malformed key material.
+            XMLSchemaValidationError: in case the element does not conform to the XML schema given in the
+                specification.
+        """
+
+        if namespace not in { twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE }:
+            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+
+        if self.__schema_validation_enabled():
+            self.__stats["xml_schema_validations"] += 1
+            if namespace == twomemo.twomemo.NAMESPACE:
+                return twomemo.etree.parse_bundle(element, bare_jid, device_id)
+            return oldmemo.etree.parse_bundle(element, bare_jid, device_id)
+
+        self.__stats["xml_structural_parses"] += 1
+        if namespace == twomemo.twomemo.NAMESPACE:
+            return fast_etree.parse_twomemo_bundle(element, bare_jid, device_id)
+        return fast_etree.parse_oldmemo_bundle(element, bare_jid, device_id)
+
+    async def _parse_message(
+        self,
+        namespace: str,
+        element: ET.Element,
+        sender_bare_jid: str,
+        session_manager: SessionManager
+    ) -> omemo.Message:
+        """
+        Parse an encrypted message according to the ``xml_validation`` policy.
+
+        Args:
+            namespace: The OMEMO version namespace of the message.
+            element: The XML element to parse the message from.
+            sender_bare_jid: The bare JID of the sender.
+            session_manager: The session manager, required to look up the sending device for oldmemo.
+
+        Returns:
+            The extracted message.
+
+        Raises:
+            UnknownNamespace: if the namespace is unknown.
+            ValueError: in case the element does not match the structure given in the specification, or in
+                case of malformed data not caught by the XML schema validation.
+            XMLSchemaValidationError: in case the element does not conform to the XML schema given in the
+                specification.
+            SenderNotFound: in case the public information about the sending device could not be found or is
+                incomplete.
+        """
+
+        if namespace not in { twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE }:
+            raise UnknownNamespace(f"Unknown namespace: {namespace}")
+
+        own_bare_jid: str = self.xmpp.boundjid.bare
+
+        if self.__schema_validation_enabled():
+            self.__stats["xml_schema_validations"] += 1
+            if namespace == twomemo.twomemo.NAMESPACE:
+                return twomemo.etree.parse_message(element, sender_bare_jid)
+            return await oldmemo.etree.parse_message(element, sender_bare_jid, own_bare_jid, session_manager)
+
+        self.__stats["xml_structural_parses"] += 1
+        if namespace == twomemo.twomemo.NAMESPACE:
+            return fast_etree.parse_twomemo_message(element, sender_bare_jid)
+        return await fast_etree.parse_oldmemo_message(element, sender_bare_jid, own_bare_jid, session_manager)
+
     async def _on_device_list_update(self, msg: Message) -> None:
         """
         Callback to handle PEP updates to the device list node of either OMEMO protocol version.
@@ -739,8 +1458,8 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         twomemo_device_list_elt = item.find(f"{{{twomemo.twomemo.NAMESPACE}}}devices")
         if twomemo_device_list_elt is not None:
             try:
-                device_list = twomemo.etree.parse_device_list(twomemo_device_list_elt)
-            except XMLSchemaValidationError:
+                device_list = self._parse_device_list(twomemo.twomemo.NAMESPACE, twomemo_device_list_elt)
+            except (XMLSchemaValidationError, ValueError):
                 pass
             else:
                 namespace = twomemo.twomemo.NAMESPACE
@@ -748,8 +1467,8 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         oldmemo_device_list_elt = item.find(f"{{{oldmemo.oldmemo.NAMESPACE}}}list")
         if oldmemo_device_list_elt is not None:
             try:
-                device_list = oldmemo.etree.parse_device_list(oldmemo_device_list_elt)
-            except XMLSchemaValidationError:
+                device_list = self._parse_device_list(oldmemo.oldmemo.NAMESPACE, oldmemo_device_list_elt)
+            except (XMLSchemaValidationError, ValueError):
                 pass
             else:
                 namespace = oldmemo.oldmemo.NAMESPACE
@@ -798,7 +1517,8 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
     async def _subscribe(self, namespace: str, jid: JID) -> None:
         """
-        Manually subscribe to the device list pubsub node of the JID and track the subscription status.
+        Manually subscribe to the device list pubsub node of the JID and track the subscription status. The
+        subscription is skipped if the domain of the JID is considered unhealthy, see :meth:`_get_items`.
 
         Args:
             namespace: The OMEMO version namespace (not the node).
@@ -821,17 +1541,28 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         xep_0060: XEP_0060 = self.xmpp["xep_0060"]
 
         try:
-            await xep_0060.subscribe(jid, node)
-        except IqError as e:
+            await trace(
+                self.span_exporter,
+                "subscribe",
+                "subscribe",
+                jid,
+                node,
+                "default",
+                self.__send_pubsub_request(jid, lambda: xep_0060.subscribe(jid, node))
+            )
+        except (IqError, IqTimeout, CircuitOpen, DeadlineExceeded) as e:
             # Failure to subscribe is non-critical here, simply debug log the error (and don't update the
             # subscription status).
             log.debug(f"Couldn't subscribe to {namespace} device list of {jid.bare}", exc_info=e)
         else:
             await self.storage.store(f"/slixmpp/subscribed/{jid.bare}/{namespace}", True)
+            await self.__update_subscription_index(jid.bare)
 
     async def _unsubscribe(self, namespace: str, jid: JID) -> None:
         """
         Manually unsubscribe from the device list pubsub node of the JID and track the subscription status.
+        The unsubscription is skipped if the domain of the JID is considered unhealthy, see
+        :meth:`_get_items`.
 
         Args:
             namespace: The OMEMO version namespace (not the node).
@@ -854,14 +1585,199 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         xep_0060: XEP_0060 = self.xmpp["xep_0060"]
 
         try:
-            await xep_0060.unsubscribe(jid, node)
-        except IqError as e:
+            await trace(
+                self.span_exporter,
+                "unsubscribe",
+                "unsubscribe",
+                jid,
+                node,
+                "default",
+                self.__send_pubsub_request(jid, lambda: xep_0060.unsubscribe(jid, node))
+            )
+        except (IqError, IqTimeout, CircuitOpen, DeadlineExceeded) as e:
             # Don't really care about any of the possible Iq error cases:
             # https://xmpp.org/extensions/xep-0060.html#subscriber-unsubscribe-error
             # Worst case we keep receiving updates we don't need.
             log.debug(f"Couldn't unsubscribe from {namespace} device list of {jid.bare}", exc_info=e)
 
         await self.storage.store(f"/slixmpp/subscribed/{jid.bare}/{namespace}", False)
+        await self.__update_subscription_index(jid.bare)
+
+    async def __update_subscription_index(self, bare_jid: str) -> None:
+        """
+        Add a bare JID to the index of JIDs with a manual subscription to at least one of their device lists,
+        or remove it from the index once all of its manual subscriptions are gone. The index allows
+        :meth:`reconcile_subscriptions` and :meth:`collect_garbage` to find the subscribed JIDs without
+        scanning the storage. It is split into :data:`SUBSCRIPTION_INDEX_BUCKETS` buckets by a stable hash of
+        the bare JID, and a bucket is only written if its membership changes.
+
+        Args:
+            bare_jid: The bare JID to add to or remove from the index.
+        """
+
+        subscribed = False
+        for namespace in [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]:
+            subscribed |= (await self.storage.load_primitive(
+                f"/slixmpp/subscribed/{bare_jid}/{namespace}",
+                bool
+            )).maybe(False)
+
+        bucket = zlib.crc32(bare_jid.encode("utf-8")) % SUBSCRIPTION_INDEX_BUCKETS
+        key = f"{SUBSCRIPTION_INDEX_KEY}/{bucket}"
+
+        async with self.__subscription_index_lock:
+            indexed = (await self.storage.load_list(key, str)).maybe([])
+
+            if subscribed and bare_jid not in indexed:
+                await self.storage.store(key, [ *indexed, bare_jid ])
+
+            if not subscribed and bare_jid in indexed:
+                if len(indexed) == 1:
+                    await self.storage.delete(key)
+                else:
+                    await self.storage.store(
+                        key,
+                        [ indexed_jid for indexed_jid in indexed if indexed_jid != bare_jid ]
+                    )
+
+    async def __load_subscription_index(self) -> List[str]:
+        """
+        Load the index of JIDs with a manual subscription to at least one of their device lists. The first
+        call builds the index from the JIDs that could have been subscribed to before the index existed: those
+        of the roster and the JIDs with cached device lists.
+
+        Returns:
+            The bare JIDs in the index.
+        """
+
+        storage = self.storage
+
+        migrated = (await storage.load_primitive(f"{SUBSCRIPTION_INDEX_KEY}/migrated", bool)).maybe(False)
+        if not migrated:
+            roster: RosterNode = self.xmpp.client_roster
+
+            candidates = { JID(jid).bare for jid in roster }
+            for namespace in [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]:
+                candidates.update((await storage.load_list(f"/{namespace}/bare_jids", str)).maybe([]))
+
+            for bare_jid in sorted(candidates):
+                await self.__update_subscription_index(bare_jid)
+
+            await storage.store(f"{SUBSCRIPTION_INDEX_KEY}/migrated", True)
+
+        result: List[str] = []
+        for bucket in range(SUBSCRIPTION_INDEX_BUCKETS):
+            result.extend((await storage.load_list(f"{SUBSCRIPTION_INDEX_KEY}/{bucket}", str)).maybe([]))
+
+        return result
+
+    def _on_roster_update(self, _iq: Iq) -> None:
+        """
+        Callback to handle roster results and roster pushes. Schedules a reconciliation of the manual device
+        list subscriptions with the updated roster, see :meth:`reconcile_subscriptions`.
+
+        Args:
+            _iq: The roster result or push.
+        """
+
+        # If a reconciliation is running already, request another run once it's done, such that changes
+        # applied by this roster update are not missed.
+        reconciliation_task = self.__reconciliation_task
+        if reconciliation_task is not None and not reconciliation_task.done():  # pylint: disable=no-member
+            self.__reconciliation_requested = True
+            return
+
+        self.__reconciliation_task = asyncio.create_task(self.__run_subscription_reconciliation())
+
+    async def __run_subscription_reconciliation(self) -> None:
+        """
+        Run :meth:`reconcile_subscriptions` in the background until no further run is requested.
+        """
+
+        while True:
+            self.__reconciliation_requested = False
+
+            try:
+                await self.reconcile_subscriptions()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.warning("Subscription reconciliation failed.", exc_info=True)
+
+            if not self.__reconciliation_requested:
+                break
+
+    async def reconcile_subscriptions(self) -> None:
+        """
+        Reconcile the manual device list subscriptions with the roster in bulk. Manual subscriptions are
+        removed for contacts with mutual presence subscription, since PEP keeps their device lists up-to-date
+        already, and restored for tracked roster contacts without working PEP. This is done automatically
+        whenever the roster is received or updated by a roster push.
+
+        The (un)subscribe IQs are sent with bounded concurrency and a rate limit, configured using the
+        ``subscription_reconciliation_concurrency`` and ``subscription_reconciliation_rate`` (IQs per second)
+        plugin options. Each completed IQ is recorded in the storage right away, thus a reconciliation that
+        was interrupted, e.g. by a crash, continues where it stopped the next time it runs.
+        """
+
+        storage = self.storage
+        roster: RosterNode = self.xmpp.client_roster
+
+        # Diff the roster against the subscription index. Roster contacts without mutual presence subscription
+        # are checked too, since their manual subscriptions might have been removed while PEP was enabled.
+        candidates = set(await self.__load_subscription_index())
+        candidates.update(
+            JID(jid).bare for jid in roster if roster[jid]["subscription"] != "both"
+        )
+
+        operations: List[Tuple[str, JID, bool]] = []
+        for bare_jid in sorted(candidates):
+            jid = JID(bare_jid)
+
+            pep_enabled = roster.has_jid(jid.bare) and roster[jid.bare]["subscription"] == "both"
+
+            for namespace in [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]:
+                subscribed = (await storage.load_primitive(
+                    f"/slixmpp/subscribed/{jid.bare}/{namespace}",
+                    bool
+                )).maybe(None)
+
+                if subscribed is None:
+                    # This JID is not tracked for this namespace.
+                    continue
+
+                if pep_enabled and subscribed:
+                    operations.append((namespace, jid, False))
+
+                if not pep_enabled and not subscribed:
+                    operations.append((namespace, jid, True))
+
+        if len(operations) == 0:
+            return
+
+        log.debug(f"Reconciling {len(operations)} manual device list subscription(s) with the roster")
+
+        semaphore = asyncio.Semaphore(max(1, self.subscription_reconciliation_concurrency))
+        pacing_lock = asyncio.Lock()
+        interval = 1 / self.subscription_reconciliation_rate
+        loop = asyncio.get_running_loop()
+        next_start = loop.time()
+
+        async def reconcile(namespace: str, jid: JID, subscribe: bool) -> None:
+            nonlocal next_start
+
+            async with semaphore:
+                # Space out the start of the IQs according to the rate limit
+                async with pacing_lock:
+                    delay = next_start - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_start = max(next_start, loop.time()) + interval
+
+                if subscribe:
+                    await self._subscribe(namespace, jid)
+                else:
+                    await self._unsubscribe(namespace, jid)
+
+        await asyncio.gather(*(reconcile(*operation) for operation in operations))
 
     async def refresh_device_lists(self, jids: Set[JID], force_download: bool = False) -> None:
         """
@@ -886,12 +1802,10 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         storage = self.storage
         roster: RosterNode = self.xmpp.client_roster
 
-        for jid in jids:
-            jid = JID(jid.bare)
-
+        async def refresh(jid: JID) -> None:
             if jid.bare == self.xmpp.boundjid.bare:
                 # Skip ourselves
-                continue
+                return
 
             # Track which namespaces require a manual refresh
             refresh_namespaces: Set[str] = \
@@ -924,11 +1838,15 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
                 except omemo.DeviceListDownloadFailed as e:
                     log.debug(f"Couldn't manually fetch {namespace} device list, probably doesn't exist: {e}")
 
+        # Refresh concurrently, such that a slow pubsub service only delays the device lists it serves
+        await asyncio.gather(*(refresh(JID(bare_jid)) for bare_jid in { jid.bare for jid in jids }))
+
     async def encrypt_message(
         self,
         stanza: Message,
         recipient_jids: Union[JID, Set[JID]],
-        identifier: Optional[str] = None
+        identifier: Optional[str] = None,
+        timeout: Optional[float] = None
     ) -> Tuple[Dict[str, Message], FrozenSet[EncryptionError]]:
         """
         Encrypt a message stanza. Selects the optimal OMEMO protocol version for each recipient device.
@@ -942,6 +1860,14 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
                 :meth:`_prompt_manual_trust` in case a trust decision is required for any of the recipient
                 devices. This value is not processed or altered, it is simply passed through. Refer to the
                 documentation of :meth:`_devices_blindly_trusted` or :meth:`_prompt_manual_trust` for details.
+            timeout: The time budget in seconds for device list and bundle downloads, or ``None`` to wait for
+                all of them. Downloads still outstanding when the budget runs out are cancelled, and downloads
+                that weren't started yet are skipped. The message is encrypted for all devices that are ready
+                by then, using cached device lists and existing sessions. Devices that were skipped due to
+                their bundle downloads are reported as non-critical errors with
+                :class:`~omemo.session_manager.BundleDownloadFailed`. Recipients whose devices were all
+                skipped are left out instead of failing the encryption, recipients without a cached device
+                list still fail it. Trust decisions are not subject to the time budget.
 
         Returns:
             Encrypted messages ready to be sent and a set of non-critical errors encountered during
@@ -960,6 +1886,16 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         Raises:
             Exception: all exceptions raised by :meth:`SessionManager.encrypt` are forwarded as-is.
 
+        Note:
+            With the ``deferred_delivery`` config option enabled, the message is queued persistently for
+            devices whose bundle could not be downloaded, and for recipients without a single known device,
+            instead of failing the whole encryption with :class:`~omemo.session_manager.NoEligibleDevices`.
+            The plugin encrypts and sends the message for those recipients only once their device list is
+            updated or on the next periodic retry, see :meth:`retry_deferred_deliveries`. The bundle download
+            failures are returned as non-critical errors regardless. Deferred messages are kept in
+            :attr:`storage` until delivered or expired after ``deferred_delivery_max_age`` seconds, encrypted
+            using the 128, 192 or 256 bit AES key that has to be set as ``deferred_delivery_key``.
+
         Tip:
             In contrast to one to one messages, MUC messages are reflected to the sender. Thus, the sender
             usually does not add messages to their local message log when sending them, but when the
@@ -971,6 +1907,14 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
             the local message log.
         """
 
+        if timeout is not None:
+            # Run the encryption in the context of the deadline, which is picked up by all pubsub requests
+            token = ENCRYPTION_DEADLINE.set(Deadline(timeout))
+            try:
+                return await self.encrypt_message(stanza, recipient_jids, identifier)
+            finally:
+                ENCRYPTION_DEADLINE.reset(token)
+
         if isinstance(recipient_jids, JID):
             recipient_jids = { recipient_jids }
         if not recipient_jids:
@@ -981,6 +1925,11 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
         recipient_bare_jids = frozenset({ recipient_jid.bare for recipient_jid in recipient_jids })
 
+        # The devices of the own bare JID are encrypted for as well
+        all_bare_jids = recipient_bare_jids | { self.xmpp.boundjid.bare }
+
+        inactive_devices = await self.__find_inactive_devices(all_bare_jids)
+
         # Prepare the plaintext for all protocol versions
         plaintexts: Dict[str, bytes] = {}
 
@@ -999,15 +1948,85 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
         session_manager = await self.get_session_manager()
 
-        messages, encryption_errors = await session_manager.encrypt(
-            recipient_bare_jids,
-            plaintexts,
-            backend_priority_order=list(filter(
-                lambda namespace: namespace in plaintexts,
-                [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]
-            )),
-            identifier=identifier
-        )
+        deadline = ENCRYPTION_DEADLINE.get()
+        if deadline is not None:
+            # The library downloads the bundles of new devices one recipient after the other. Download them
+            # for all recipients concurrently first, such that a slow pubsub service doesn't use up the time
+            # budget for the others. The downloaded bundles are reused for session building.
+            await asyncio.gather(*(
+                session_manager.get_device_information(bare_jid)
+                for bare_jid
+                in recipient_bare_jids | { self.xmpp.boundjid.bare }
+            ))
+
+        # Recipients without a single known device are deferred instead of failing the whole encryption, if
+        # deferred delivery is enabled. Deferred deliveries themselves are never deferred again.
+        defer = self.deferred_delivery and DELIVERY_TARGETS.get() is None
+        deferred_bare_jids: FrozenSet[str] = frozenset()
+
+        # Recipients whose devices were all skipped due to the deadline are left out, their devices are
+        # reported as non-critical errors instead.
+        skipped_bare_jids: FrozenSet[str] = frozenset()
+
+        inactive_devices_token = INACTIVE_DEVICES.set(inactive_devices)
+        try:
+            while True:
+                try:
+                    messages, encryption_errors = await session_manager.encrypt(
+                        recipient_bare_jids - deferred_bare_jids - skipped_bare_jids,
+                        plaintexts,
+                        backend_priority_order=list(filter(
+                            lambda namespace: namespace in plaintexts,
+                            [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]
+                        )),
+                        identifier=identifier
+                    )
+                except NoEligibleDevices as e:
+                    readmitted = frozenset(device for device in inactive_devices if device[0] in e.bare_jids)
+                    if len(readmitted) > 0:
+                        # The active devices of these recipients are not available, e.g. due to bundle
+                        # download failures. Encrypt for their inactive devices instead of not at all.
+                        inactive_devices -= readmitted
+                        INACTIVE_DEVICES.set(inactive_devices)
+                    elif deadline is not None and e.bare_jids <= frozenset(
+                        bare_jid for _, bare_jid, _ in deadline.skipped_bundles
+                    ):
+                        skipped_bare_jids |= e.bare_jids
+                    elif defer and await self.__devices_unknown(e.bare_jids):
+                        deferred_bare_jids |= e.bare_jids
+                    else:
+                        raise
+                else:
+                    break
+        finally:
+            INACTIVE_DEVICES.reset(inactive_devices_token)
+
+        if len(inactive_devices) > 0:
+            self.__stats["inactive_devices_skipped"] += len(inactive_devices)
+
+        if deadline is not None:
+            encryption_errors = encryption_errors | self.__skipped_device_errors(
+                deadline,
+                messages,
+                encryption_errors
+            )
+
+        if defer:
+            deferred: FrozenSet[Recipient] = frozenset(
+                (bare_jid, None) for bare_jid in deferred_bare_jids
+            ) | frozenset(
+                (error.bare_jid, error.device_id)
+                for error in encryption_errors
+                if isinstance(error.exception, (BundleDownloadFailed, BundleNotFound))
+            )
+
+            if len(deferred) > 0:
+                await self.__get_deferred_delivery_queue().put(
+                    ET.tostring(stanza.xml, encoding="unicode"),
+                    identifier,
+                    deferred
+                )
+                self.__stats["deferred_deliveries_queued"] += len(deferred)
 
         encrypted_messages: Dict[str, Message] = {}
 
@@ -1022,24 +2041,187 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
             if message_elt is None:
                 raise UnknownNamespace(f"OMEMO version namespace {namespace} unknown")
 
-            stanza_copy = copy(stanza)
-            stanza_copy.clear()
-            stanza_copy.append(message_elt)
-            stanza_copy["body"] = self.fallback_message
-            stanza_copy.enable("store")
-
-            encrypted_messages[namespace] = stanza_copy
+            encrypted_messages[namespace] = _make_encrypted_stanza(stanza, message_elt, self.fallback_message)
 
         return encrypted_messages, encryption_errors
 
-    async def decrypt_message(self, stanza: Message) -> Tuple[Message, DeviceInformation]:
+    async def retry_deferred_deliveries(self) -> None:
+        """
+        Retry the delivery of messages deferred by :meth:`encrypt_message`. Each message is encrypted for its
+        pending recipients only, and sent. This is done automatically when the device list of a pending
+        recipient is updated and every ``deferred_delivery_retry_interval`` seconds, but can be triggered
+        manually, e.g. after reconnecting.
+
+        Recipients stay pending while their bundles or device lists are unavailable. Other failures, e.g.
+        :class:`~omemo.KeyExchangeFailed` due to an invalid bundle, are final. A retry is only sent if it is
+        encrypted for at least one pending recipient, and it is kept from the carbon copies to the own devices
+        unless one of them is pending, since all other devices of the own account got the message already.
+        Messages older than ``deferred_delivery_max_age`` seconds are dropped without delivery.
+        """
+
+        queue = self.__get_deferred_delivery_queue()
+        session_manager = await self.get_session_manager()
+        own_bare_jid = self.xmpp.boundjid.bare
+
+        for deferred_message in await queue.messages():
+            if time.time() - deferred_message.timestamp > self.deferred_delivery_max_age:
+                log.warning(f"Dropping deferred message {deferred_message.message_id} after max age.")
+                self.__stats["deferred_deliveries_expired"] += len(deferred_message.recipients)
+                await queue.remove(deferred_message.message_id)
+                continue
+
+            stanza = Message(stream=self.xmpp, xml=ET.fromstring(deferred_message.stanza))
+
+            targets = deferred_message.recipients
+            pending: Set[Recipient] = set()
+            failed: Set[Recipient] = set()
+            encrypted_messages: Dict[str, Message] = {}
+
+            # Recipients that are still lacking a single eligible device are excluded one by one, like
+            # encrypt_message does for the initial attempt
+            while len(targets) > 0:
+                token = DELIVERY_TARGETS.set(targets)
+                try:
+                    encrypted_messages, encryption_errors = await self.encrypt_message(
+                        stanza,
+                        { JID(bare_jid) for bare_jid, _ in targets },
+                        deferred_message.identifier
+                    )
+                except NoEligibleDevices as e:
+                    pending.update(target for target in targets if target[0] in e.bare_jids)
+                    targets = frozenset(target for target in targets if target[0] not in e.bare_jids)
+                    continue
+                except Exception:  # pylint: disable=broad-exception-caught
+                    log.warning(
+                        f"Retrying deferred message {deferred_message.message_id} failed.",
+                        exc_info=True
+                    )
+                    pending.update(targets)
+                    targets = frozenset()
+                    continue
+                finally:
+                    DELIVERY_TARGETS.reset(token)
+
+                # Only unavailable bundles are worth another attempt, other failures would happen again
+                retryable = {
+                    (error.bare_jid, error.device_id)
+                    for error in encryption_errors
+                    if isinstance(error.exception, (BundleDownloadFailed, BundleNotFound))
+                }
+                final = { (error.bare_jid, error.device_id) for error in encryption_errors } - retryable
+
+                for bare_jid, device_id in targets:
+                    if device_id is None:
+                        # All devices of the bare JID were targeted, only the failed ones remain pending
+                        pending.update(recipient for recipient in retryable if recipient[0] == bare_jid)
+                        failed.update(recipient for recipient in final if recipient[0] == bare_jid)
+                    elif (bare_jid, device_id) in retryable:
+                        pending.add((bare_jid, device_id))
+                    elif (bare_jid, device_id) in final:
+                        failed.add((bare_jid, device_id))
+                    elif all(
+                        device.device_id != device_id
+                        for device
+                        in await session_manager.get_device_information(bare_jid)
+                    ):
+                        # Devices with an unknown identity key are excluded silently if their bundle is
+                        # still not available, they remain pending. Devices that were removed from the device
+                        # list remain known as inactive and are considered done.
+                        pending.add((bare_jid, device_id))
+
+                break
+
+            # Whether the retry is encrypted for at least one device that didn't get the message yet
+            delivered = False
+            for bare_jid, device_id in targets:
+                if device_id is None:
+                    devices = await session_manager.get_device_information(bare_jid)
+                    active_devices = sum(1 for device in devices if any(dict(device.active).values()))
+                    failed_devices = sum(1 for recipient in pending | failed if recipient[0] == bare_jid)
+                    delivered |= active_devices > failed_devices
+                else:
+                    delivered |= (bare_jid, device_id) not in pending | failed
+
+            if delivered:
+                for encrypted_message in encrypted_messages.values():
+                    if all(bare_jid != own_bare_jid for bare_jid, _ in targets):
+                        # The other devices of the own account got the carbon copy of the first attempt
+                        encrypted_message.enable("carbon_private")
+                        encrypted_message.enable("no-copy")
+                    encrypted_message.send()
+
+            if len(failed) > 0:
+                log.warning(
+                    f"Dropping deferred message {deferred_message.message_id} for {len(failed)} device(s)"
+                    f" after a permanent failure."
+                )
+                self.__stats["deferred_deliveries_failed"] += len(failed)
+
+            completed = deferred_message.recipients - pending - failed
+            self.__stats["deferred_deliveries_completed"] += len(completed)
+            await queue.update(deferred_message.message_id, frozenset(pending))
+
+    async def collect_garbage(self) -> GarbageCollectionResult:
+        """
+        Purge the sessions and device information of devices that were removed from the device lists of their
+        owners more than ``garbage_collection_max_inactive_age`` seconds ago, and of sessions that are not
+        backed by device information, in batches of ``garbage_collection_batch_size`` devices. The own device
+        and trust decisions are never purged. See :class:`~slixmpp_omemo.garbage_collection.GarbageCollector`
+        for details.
+
+        Devices that remain in their owner's device lists are only collected if ``inactive_device_max_age`` is
+        set, such that their activity is tracked: the sessions of listed devices without recorded activity for
+        more than ``garbage_collection_max_inactive_age`` seconds are purged, their device information is
+        kept.
+
+        This is done automatically every ``garbage_collection_interval`` seconds if ``garbage_collection`` is
+        enabled, but can be triggered manually.
+
+        Returns:
+            The number of purged devices, and the number and size of the deleted values.
+        """
+
+        session_manager = await self.get_session_manager()
+        own_device, _ = await session_manager.get_own_device_information()
+
+        collector = GarbageCollector(
+            self.storage,
+            [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ],
+            own_device.bare_jid,
+            own_device.device_id,
+            None if self.inactive_device_max_age is None else self.__get_device_activity()
+        )
+
+        result = await collector.collect(
+            await self.__load_subscription_index(),
+            self.garbage_collection_max_inactive_age,
+            self.garbage_collection_batch_size
+        )
+
+        if result.devices > 0:
+            self.__stats["garbage_collected_devices"] += result.devices
+        if result.sessions > 0:
+            self.__stats["garbage_collected_sessions"] += result.sessions
+        if result.size > 0:
+            self.__stats["garbage_collected_bytes"] += result.size
+
+        return result
+
+    async def decrypt_message(
+        self,
+        stanza: Message,
+        encrypted_elements: Optional[EncryptedElements] = None
+    ) -> Tuple[Message, DeviceInformation]:
         """
-        Decrypt an OMEMO-encrypted message. Use :meth:`is_encrypted` to check whether a stanza contains an
-        OMEMO-encrypted message. The original stanza is not modified by this method. For oldmemo, the optional
-        fallback body is replaced with the decrypted content. For newmemo, the whole SCE stanza is returned.
+        Decrypt an OMEMO-encrypted message. Use :meth:`is_encrypted` or :meth:`find_encrypted_elements` to
+        check whether a stanza contains an OMEMO-encrypted message. The original stanza is not modified by
+        this method. For oldmemo, the optional fallback body is replaced with the decrypted content. For
+        newmemo, the whole SCE stanza is returned.
 
         Args:
             stanza: The message stanza.
+            encrypted_elements: The encrypted elements of the stanza as returned by
+                :meth:`find_encrypted_elements`, to avoid looking them up a second time. Looked up if omitted.
 
         Returns:
             The decrypted stanza and information about the sending device.
@@ -1047,6 +2229,8 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
         Raises:
             ValueError: in case there is malformed data not caught be the XML schema validation.
             ValueError: in case a groupchat message is passed but XEP-0045 is not loaded.
+            ValueError: in case the element does not match the structure given in the specification and was
+                not validated against the XML schema, depending on the ``xml_validation`` policy.
             XMLSchemaValidationError: in case the element does not conform to the XML schema given in the
                 specification.
             SenderNotFound: in case the public information about the sending device could not be found or is
@@ -1074,11 +2258,18 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
 
         session_manager = await self.get_session_manager()
 
-        message: Optional[omemo.Message] = None
+        namespace: Optional[str] = None
         encrypted_elt: Optional[ET.Element] = None
 
-        twomemo_encrypted_elt = stanza.xml.findall(f"{{{twomemo.twomemo.NAMESPACE}}}encrypted")
-        oldmemo_encrypted_elt = stanza.xml.findall(f"{{{oldmemo.oldmemo.NAMESPACE}}}encrypted")
+        encrypted_elts = self.find_encrypted_elements(stanza) if encrypted_elements is None \
+            else encrypted_elements
+
+        twomemo_encrypted_elt = [
+            elt for namespace, elt in encrypted_elts if namespace == twomemo.twomemo.NAMESPACE
+        ]
+        oldmemo_encrypted_elt = [
+            elt for namespace, elt in encrypted_elts if namespace == oldmemo.oldmemo.NAMESPACE
+        ]
 
         if len(twomemo_encrypted_elt) > 1:
             raise ValueError(
@@ -1094,28 +2285,70 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
             raise ValueError("Stanza contains a mix of encrypted elements in different OMEMO namespaces")
 
         if len(twomemo_encrypted_elt) == 1:
+            namespace = twomemo.twomemo.NAMESPACE
             encrypted_elt = twomemo_encrypted_elt[0]
-            message = twomemo.etree.parse_message(encrypted_elt, sender_bare_jid)
 
         if len(oldmemo_encrypted_elt) == 1:
+            namespace = oldmemo.oldmemo.NAMESPACE
             encrypted_elt = oldmemo_encrypted_elt[0]
-            message = await oldmemo.etree.parse_message(
-                encrypted_elt,
-                sender_bare_jid,
-                xmpp.boundjid.bare,
-                session_manager
-            )
 
-        if message is None or encrypted_elt is None:
-            raise ValueError(f"No supported encrypted content found in stanza: {message}")
+        if namespace is None or encrypted_elt is None:
+            raise ValueError(f"No supported encrypted content found in stanza: {stanza}")
+
+        decryption_cache = self.__get_decryption_cache()
+        cache_key: Optional[str] = None
+        outcome: Optional[DecryptionOutcome] = None
+
+        if decryption_cache is not None:
+            cache_key = self.__decryption_cache_key(stanza, sender_bare_jid, namespace, encrypted_elt)
+            if cache_key is not None:
+                outcome = await decryption_cache.get(cache_key)
+                self.__stats["decryption_cache_misses" if outcome is None else "decryption_cache_hits"] += 1
+
+        plaintext: Optional[bytes]
+        device_information: DeviceInformation
+
+        if outcome is None:
+            pre_key_refill_token = PRE_KEY_REFILL.set(self.__pre_key_refill)
+            try:
+                message = await self._parse_message(
+                    namespace,
+                    encrypted_elt,
+                    sender_bare_jid,
+                    session_manager
+                )
+                plaintext, device_information, __ = await session_manager.decrypt(message)
+            except Exception as e:
+                if decryption_cache is not None and cache_key is not None:
+                    failure = DecryptionOutcome.from_failure(namespace, e)
+                    if failure is not None:
+                        await decryption_cache.put(cache_key, failure)
+                raise
+            finally:
+                PRE_KEY_REFILL.reset(pre_key_refill_token)
+
+            # Includes messages that carry a key exchange initiated by the device
+            await self._record_device_activity(device_information.bare_jid, device_information.device_id)
+
+            if decryption_cache is not None and cache_key is not None:
+                await decryption_cache.put(cache_key, DecryptionOutcome(
+                    namespace,
+                    plaintext,
+                    device_information,
+                    None,
+                    time.time()
+                ))
+        else:
+            outcome.raise_failure()
 
-        plaintext, device_information, __ = await session_manager.decrypt(message)
+            plaintext = outcome.plaintext
+            device_information = cast(DeviceInformation, outcome.device_information)
 
-        if message.namespace == twomemo.twomemo.NAMESPACE:
+        if namespace == twomemo.twomemo.NAMESPACE:
             # Do SCE unpacking here
             raise NotImplementedError(f"SCE not supported yet. Plaintext: {plaintext}")
 
-        if message.namespace == oldmemo.oldmemo.NAMESPACE:
+        if namespace == oldmemo.oldmemo.NAMESPACE:
             stanza = copy(stanza)
 
             # Remove all body elements from the original element, since those act as fallbacks in case the
@@ -1138,10 +2371,293 @@ class XEP_0384(BasePlugin, metaclass=ABCMeta):  # pylint: disable=invalid-name
             encrypted with any supported version of OMEMO.
         """
 
-        if stanza.xml.find(f"{{{twomemo.twomemo.NAMESPACE}}}encrypted") is not None:
+        namespaces = { namespace for namespace, _ in self.find_encrypted_elements(stanza) }
+
+        if twomemo.twomemo.NAMESPACE in namespaces:
             return twomemo.twomemo.NAMESPACE
 
-        if stanza.xml.find(f"{{{oldmemo.oldmemo.NAMESPACE}}}encrypted") is not None:
+        if oldmemo.oldmemo.NAMESPACE in namespaces:
             return oldmemo.oldmemo.NAMESPACE
 
         return None
+
+    @staticmethod
+    def find_encrypted_elements(stanza: Message) -> EncryptedElements:
+        """
+        Find the OMEMO-encrypted elements among the children of a stanza in a single pass. Pass the result to
+        :meth:`decrypt_message` to decrypt the stanza without looking them up again.
+
+        Args:
+            stanza: The stanza.
+
+        Returns:
+            The OMEMO version namespace and the element of each encrypted element, in document order. Empty if
+            the stanza is not encrypted with any supported version of OMEMO.
+        """
+
+        return tuple(
+            (ENCRYPTED_TAGS[child.tag], child)
+            for child
+            in stanza.xml
+            if child.tag in ENCRYPTED_TAGS
+        )
+
+    def __get_decryption_cache(self) -> Optional[DecryptionCache]:
+        """
+        Returns:
+            The decryption cache, created on first use according to the configuration, or ``None`` if the
+            decryption cache is disabled.
+        """
+
+        max_entries: int = self.decryption_cache_size
+        if max_entries <= 0:
+            return None
+
+        if self.__decryption_cache is None:
+            self.__decryption_cache = DecryptionCache(
+                max_entries,
+                self.decryption_cache_max_age,
+                self.storage if self.decryption_cache_persistent else None,
+                self.decryption_cache_key
+            )
+
+        return self.__decryption_cache
+
+    @staticmethod
+    def __decryption_cache_key(
+        stanza: Message,
+        sender_bare_jid: str,
+        namespace: str,
+        encrypted_elt: ET.Element
+    ) -> Optional[str]:
+        """
+        Build the decryption cache key of a message. Messages are identified by their XEP-0359 origin-id,
+        falling back to the stanza-id, and the sending device. A digest of the encrypted content is included
+        such that a reused id can't make the cache return the outcome of a different message.
+
+        Args:
+            stanza: The message stanza.
+            sender_bare_jid: The bare JID of the sender.
+            namespace: The OMEMO version namespace of the encrypted element.
+            encrypted_elt: The encrypted element.
+
+        Returns:
+            The cache key, or ``None`` if the message can't be identified.
+        """
+
+        message_id: Optional[str] = None
+
+        origin_id_elt = stanza.xml.find("{urn:xmpp:sid:0}origin-id")
+        if origin_id_elt is not None and origin_id_elt.get("id"):
+            message_id = f"origin-id {origin_id_elt.get('id')}"
+        else:
+            stanza_id_elt = stanza.xml.find("{urn:xmpp:sid:0}stanza-id")
+            if stanza_id_elt is not None and stanza_id_elt.get("id"):
+                message_id = f"stanza-id {stanza_id_elt.get('by', '')} {stanza_id_elt.get('id')}"
+
+        header_elt = encrypted_elt.find(f"{{{namespace}}}header")
+        sender_device_id = None if header_elt is None else header_elt.get("sid")
+
+        if message_id is None or sender_device_id is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update("".join(
+            f"{part}\0"
+            for part
+            in [ namespace, sender_bare_jid, sender_device_id, message_id ]
+        ).encode("utf-8"))
+        for elt in encrypted_elt.iter():
+            digest.update((elt.text or "").encode("utf-8") + b"\0")
+
+        return digest.hexdigest()
+
+    async def __devices_unknown(self, bare_jids: FrozenSet[str]) -> bool:
+        """
+        Args:
+            bare_jids: The bare JIDs to check.
+
+        Returns:
+            Whether not a single device is known for any of the bare JIDs, i.e. their device lists are empty
+            or the bundles of all their devices failed to download.
+        """
+
+        session_manager = await self.get_session_manager()
+
+        for bare_jid in bare_jids:
+            if len(await session_manager.get_device_information(bare_jid)) > 0:
+                return False
+
+        return True
+
+    async def _record_device_activity(self, bare_jid: str, device_id: int) -> None:
+        """
+        Record that a device was active just now, if ``inactive_device_max_age`` is set. The activity of the
+        devices of the own account is not tracked, since they are never left out.
+
+        Args:
+            bare_jid: The bare JID of the device.
+            device_id: The id of the device.
+        """
+
+        if self.inactive_device_max_age is None or bare_jid == self.xmpp.boundjid.bare:
+            return
+
+        await self.__get_device_activity().record(bare_jid, device_id)
+
+    def __get_device_activity(self) -> DeviceActivity:
+        """
+        Returns:
+            The activity tracker of the devices, created on first use.
+        """
+
+        if self.__device_activity is None:
+            # Record activity precisely enough for the configured max age, but not more often than hourly
+            self.__device_activity = DeviceActivity(
+                self.storage,
+                min(60 * 60, self.inactive_device_max_age / 10)
+            )
+
+        return self.__device_activity
+
+    async def __find_inactive_devices(self, bare_jids: FrozenSet[str]) -> FrozenSet[Tuple[str, int]]:
+        """
+        Args:
+            bare_jids: The bare JIDs of the recipients, including the own bare JID.
+
+        Returns:
+            The devices of the recipients to leave out of the encryption due to inactivity. Empty unless
+            ``inactive_device_max_age`` is set. The devices of the own account and devices targeted explicitly
+            by a deferred delivery are never left out.
+        """
+
+        max_age: Optional[float] = self.inactive_device_max_age
+        if max_age is None:
+            return frozenset()
+
+        session_manager = await self.get_session_manager()
+        targets = DELIVERY_TARGETS.get() or frozenset()
+        device_activity = self.__get_device_activity()
+
+        inactive_devices: Set[Tuple[str, int]] = set()
+        for bare_jid in bare_jids - { self.xmpp.boundjid.bare }:
+            device_ids = frozenset(
+                device.device_id
+                for device
+                in await session_manager.get_device_information(bare_jid)
+                if any(active for _, active in device.active)
+            )
+
+            inactive_devices.update(
+                (bare_jid, device_id)
+                for device_id
+                in await device_activity.inactive_devices(bare_jid, device_ids, max_age)
+                if (bare_jid, device_id) not in targets
+            )
+
+        return frozenset(inactive_devices)
+
+    def __get_deferred_delivery_queue(self) -> DeferredDeliveryQueue:
+        """
+        Returns:
+            The queue of deferred deliveries, created on first use.
+        """
+
+        if self.__deferred_delivery_queue is None:
+            self.__deferred_delivery_queue = DeferredDeliveryQueue(self.storage, self.deferred_delivery_key)
+
+        return self.__deferred_delivery_queue
+
+    def __request_deferred_delivery(self) -> None:
+        """
+        Schedule a run of :meth:`retry_deferred_deliveries` in the background. If a run is in progress
+        already, another run is requested once it's done.
+        """
+
+        task = self.__deferred_delivery_task
+        if task is not None and not task.done():  # pylint: disable=no-member
+            self.__deferred_delivery_requested = True
+            return
+
+        self.__deferred_delivery_task = asyncio.create_task(self.__run_deferred_delivery())
+
+    async def __run_deferred_delivery(self) -> None:
+        """
+        Run :meth:`retry_deferred_deliveries` in the background until no further run is requested.
+        """
+
+        # Don't inherit the deadline of an encryption that happened to trigger the retry
+        ENCRYPTION_DEADLINE.set(None)
+
+        while True:
+            self.__deferred_delivery_requested = False
+
+            try:
+                await self.retry_deferred_deliveries()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.warning("Retrying deferred deliveries failed.", exc_info=True)
+
+            if not self.__deferred_delivery_requested:
+                break
+
+    async def __run_deferred_delivery_timer(self) -> None:
+        """
+        Request a retry of the deferred deliveries every ``deferred_delivery_retry_interval`` seconds.
+        """
+
+        while True:
+            await asyncio.sleep(self.deferred_delivery_retry_interval)
+
+            if self.__get_deferred_delivery_queue().size > 0:
+                self.__request_deferred_delivery()
+
+    async def __run_garbage_collection_timer(self) -> None:
+        """
+        Run :meth:`collect_garbage` every ``garbage_collection_interval`` seconds.
+        """
+
+        while True:
+            await asyncio.sleep(self.garbage_collection_interval)
+
+            try:
+                await self.collect_garbage()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.warning("Garbage collection failed.", exc_info=True)
+
+    def __skipped_device_errors(
+        self,
+        deadline: Deadline,
+        messages: Iterable[omemo.Message],
+        encryption_errors: FrozenSet[EncryptionError]
+    ) -> FrozenSet[EncryptionError]:
+        """
+        Args:
+            deadline: The deadline of an encryption.
+            messages: The messages produced by the encryption.
+            encryption_errors: The non-critical errors reported by the encryption.
+
+        Returns:
+            Non-critical errors for the devices that were not encrypted for because their bundle downloads
+            were skipped due to the deadline, and that are not covered by the reported errors already.
+        """
+
+        covered = { (error.bare_jid, error.device_id) for error in encryption_errors } | {
+            (key.bare_jid, key.device_id) for message in messages for key, _ in message.keys
+        }
+
+        skipped_errors: Dict[Tuple[str, int], EncryptionError] = {}
+        for namespace, bare_jid, device_id in sorted(deadline.skipped_bundles):
+            if (bare_jid, device_id) not in covered and (bare_jid, device_id) not in skipped_errors:
+                skipped_errors[(bare_jid, device_id)] = EncryptionError(
+                    namespace,
+                    bare_jid,
+                    device_id,
+                    BundleDownloadFailed(
+                        f"Bundle download skipped for {bare_jid}: {device_id} under namespace {namespace}:"
+                        f" The deadline expired."
+                    )
+                )
+
+        self.__stats["deadline_skipped_devices"] += len(skipped_errors)
+
+        return frozenset(skipped_errors.values())
@@ -0,0 +1,514 @@
+import asyncio
+from typing import Any, Dict, FrozenSet, List, MutableMapping, MutableSequence, Optional, Tuple, Union
+from xml.etree import ElementTree as ET
+
+import omemo
+from omemo.session_manager import BundleNotFound, SessionManager, UnknownNamespace
+from omemo.storage import Storage
+from omemo.types import DeviceInformation
+
+import oldmemo
+import oldmemo.etree
+import twomemo
+import twomemo.etree
+
+from slixmpp.clientxmpp import ClientXMPP
+from slixmpp.jid import JID
+from slixmpp.plugins import register_plugin
+from slixmpp.stanza import Iq, Message
+from slixmpp.xmlstream import StanzaBase
+from slixmpp.xmlstream.handler import Callback
+from slixmpp.xmlstream.matcher import MatchXPath
+
+from slixmpp_omemo import XEP_0384
+from slixmpp_omemo.xep_0384 import OLDMEMO_DEVICE_LIST_NODE, TWOMEMO_DEVICE_LIST_NODE
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "LoopbackClient",
+    "LoopbackPlugin",
+    "LoopbackServer",
+    "create_session_manager",
+    "serialize_message"
+]
+
+
+CLIENT_NS = "jabber:client"
+PUBSUB_NS = "http://jabber.org/protocol/pubsub"
+PUBSUB_OWNER_NS = "http://jabber.org/protocol/pubsub#owner"
+STANZAS_NS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+TWOMEMO_BUNDLES_NODE = "urn:xmpp:omemo:2:bundles"
+
+
+class LoopbackServer:
+    """
+    Stand-in for the pubsub service and message routing of an XMPP server. Pubsub items and messages are kept
+    in their serialized XML form, in containers that can be replaced by the proxies of a multiprocessing
+    manager, such that clients in multiple processes can share the server.
+    """
+
+    def __init__(
+        self,
+        items: Optional[MutableMapping[Tuple[str, str, str], str]] = None,
+        messages: Optional[MutableSequence[Tuple[str, str]]] = None
+    ) -> None:
+        """
+        Args:
+            items: The pubsub items, by service bare JID, node and item id. Defaults to a dictionary.
+            messages: The routed message stanzas and the bare JIDs of their recipients, in the order they were
+                sent. Defaults to a list.
+        """
+
+        self.items: MutableMapping[Tuple[str, str, str], str] = {} if items is None else items
+        self.messages: MutableSequence[Tuple[str, str]] = [] if messages is None else messages
+
+        # Pubsub requests other than item retrieval, by sender bare JID, kept in memory of this process only
+        self.requests: List[Tuple[str, str, str, str]] = []
+
+    def get_item(self, jid: str, node: str, item_id: str) -> Optional[ET.Element]:
+        """
+        Args:
+            jid: The bare JID of the pubsub service.
+            node: The node.
+            item_id: The id of the item.
+
+        Returns:
+            The payload of the item, if it exists.
+        """
+
+        item = self.items.get((jid, node, item_id), None)
+
+        return None if item is None else ET.fromstring(item)
+
+    def get_items(self, jid: str, node: str) -> List[Tuple[str, ET.Element]]:
+        """
+        Args:
+            jid: The bare JID of the pubsub service.
+            node: The node.
+
+        Returns:
+            The ids and payloads of the items of the node, in the order they were first published.
+        """
+
+        return [
+            (item_id, ET.fromstring(item))
+            for (item_jid, item_node, item_id), item
+            in list(self.items.items())
+            if item_jid == jid and item_node == node
+        ]
+
+    def publish(self, jid: str, node: str, item_id: str, payload: ET.Element) -> None:
+        """
+        Args:
+            jid: The bare JID of the pubsub service.
+            node: The node.
+            item_id: The id of the item.
+            payload: The payload of the item.
+        """
+
+        self.items[(jid, node, item_id)] = ET.tostring(payload, encoding="unicode")
+
+    def retract(self, jid: str, node: str, item_id: Optional[str] = None) -> None:
+        """
+        Args:
+            jid: The bare JID of the pubsub service.
+            node: The node.
+            item_id: The id of the item to retract, or ``None`` to delete the whole node.
+        """
+
+        for key in list(self.items.keys()):
+            if key[:2] == (jid, node) and item_id in { None, key[2] }:
+                del self.items[key]
+
+    def route(self, stanza: ET.Element) -> None:
+        """
+        Args:
+            stanza: The message stanza to deliver to the bare JID it is addressed to.
+        """
+
+        self.messages.append((JID(stanza.get("to", "")).bare, ET.tostring(stanza, encoding="unicode")))
+
+    def messages_for(self, bare_jid: str, start: int = 0) -> Tuple[int, List[ET.Element]]:
+        """
+        Args:
+            bare_jid: The bare JID of the recipient.
+            start: The number of routed messages that were looked at by a previous call already.
+
+        Returns:
+            The number of routed messages looked at, and the message stanzas among those not looked at before
+            that are addressed to the bare JID.
+        """
+
+        messages = list(self.messages[start:])
+
+        return start + len(messages), [
+            ET.fromstring(stanza) for recipient, stanza in messages if recipient == bare_jid
+        ]
+
+    def handle_iq(self, sender: JID, iq: ET.Element) -> ET.Element:
+        """
+        Process a pubsub request.
+
+        Args:
+            sender: The full JID of the sender.
+            iq: The request.
+
+        Returns:
+            The response.
+        """
+
+        service = JID(iq.get("to") or sender.bare).bare
+
+        response = ET.Element(f"{{{CLIENT_NS}}}iq", { "type": "result", "id": iq.get("id", "") })
+        if iq.get("to"):
+            response.set("from", iq.get("to", ""))
+        response.set("to", sender.full)
+
+        def error(condition: str) -> ET.Element:
+            response.set("type", "error")
+            error_elt = ET.SubElement(response, f"{{{CLIENT_NS}}}error", { "type": "cancel" })
+            ET.SubElement(error_elt, f"{{{STANZAS_NS}}}{condition}")
+            return response
+
+        pubsub_elt = iq.find(f"{{{PUBSUB_NS}}}pubsub")
+        if pubsub_elt is None:
+            owner_elt = iq.find(f"{{{PUBSUB_OWNER_NS}}}pubsub")
+            if owner_elt is None:
+                return error("feature-not-implemented")
+
+            for child in owner_elt:
+                node = child.get("node", "")
+                if child.tag == f"{{{PUBSUB_OWNER_NS}}}delete":
+                    self.requests.append((sender.bare, "delete_node", service, node))
+                    self.retract(service, node)
+                    return response
+                if child.tag == f"{{{PUBSUB_OWNER_NS}}}configure":
+                    self.requests.append((sender.bare, "set_node_config", service, node))
+                    return response
+
+            return error("feature-not-implemented")
+
+        for child in pubsub_elt:
+            node = child.get("node", "")
+
+            if child.tag == f"{{{PUBSUB_NS}}}items":
+                items = self.get_items(service, node)
+                if len(items) == 0:
+                    return error("item-not-found")
+
+                item_ids = { item_elt.get("id") for item_elt in child.iter(f"{{{PUBSUB_NS}}}item") }
+                if len(item_ids) > 0:
+                    items = [ item for item in items if item[0] in item_ids ]
+                max_items = child.get("max_items")
+                if max_items is not None:
+                    items = items[-int(max_items):]
+
+                result_elt = ET.SubElement(response, f"{{{PUBSUB_NS}}}pubsub")
+                items_elt = ET.SubElement(result_elt, f"{{{PUBSUB_NS}}}items", { "node": node })
+                for item_id, payload in items:
+                    ET.SubElement(items_elt, f"{{{PUBSUB_NS}}}item", { "id": item_id }).append(payload)
+                return response
+
+            if child.tag == f"{{{PUBSUB_NS}}}publish":
+                if service != sender.bare:
+                    return error("forbidden")
+
+                self.requests.append((sender.bare, "publish", service, node))
+                for item_elt in child.iter(f"{{{PUBSUB_NS}}}item"):
+                    for payload in item_elt[:1]:
+                        self.publish(service, node, item_elt.get("id", "current"), payload)
+                return response
+
+            if child.tag == f"{{{PUBSUB_NS}}}retract":
+                self.requests.append((sender.bare, "retract", service, node))
+                for item_elt in child.iter(f"{{{PUBSUB_NS}}}item"):
+                    self.retract(service, node, item_elt.get("id", ""))
+                return response
+
+            if child.tag in { f"{{{PUBSUB_NS}}}subscribe", f"{{{PUBSUB_NS}}}unsubscribe" }:
+                self.requests.append((sender.bare, child.tag.split("}")[1], service, node))
+                return response
+
+        return error("feature-not-implemented")
+
+
+def serialize_message(message: omemo.Message) -> ET.Element:
+    """
+    Args:
+        message: The message to serialize.
+
+    Returns:
+        The serialized message as an XML element.
+    """
+
+    if message.namespace == twomemo.twomemo.NAMESPACE:
+        return twomemo.etree.serialize_message(message)
+    if message.namespace == oldmemo.oldmemo.NAMESPACE:
+        return oldmemo.etree.serialize_message(message)
+
+    raise UnknownNamespace(f"Unknown namespace: {message.namespace}")
+
+
+def _bundle_node(namespace: str, device_id: int) -> Tuple[str, str]:
+    """
+    Args:
+        namespace: The OMEMO version namespace.
+        device_id: The device id.
+
+    Returns:
+        The node and item id the bundle of the device is published under.
+    """
+
+    if namespace == twomemo.twomemo.NAMESPACE:
+        return TWOMEMO_BUNDLES_NODE, str(device_id)
+
+    return f"eu.siacs.conversations.axolotl.bundles:{device_id}", "current"
+
+
+def _device_list_node(namespace: str) -> str:
+    """
+    Args:
+        namespace: The OMEMO version namespace.
+
+    Returns:
+        The node the device list is published under.
+    """
+
+    return TWOMEMO_DEVICE_LIST_NODE if namespace == twomemo.twomemo.NAMESPACE else OLDMEMO_DEVICE_LIST_NODE
+
+
+async def create_session_manager(server: LoopbackServer, bare_jid: str) -> SessionManager:
+    """
+    Create a session manager for a bare JID which trusts all devices and interacts with the loopback server.
+
+    Args:
+        server: The loopback server.
+        bare_jid: The bare JID of the account.
+
+    Returns:
+        The session manager, with its device list and bundles published on the loopback server.
+    """
+
+    own_bare_jid = bare_jid
+
+    class LoopbackSessionManager(SessionManager):
+        @staticmethod
+        async def _upload_bundle(bundle: omemo.Bundle) -> None:
+            node, item_id = _bundle_node(bundle.namespace, bundle.device_id)
+            if isinstance(bundle, twomemo.twomemo.BundleImpl):
+                server.publish(own_bare_jid, node, item_id, twomemo.etree.serialize_bundle(bundle))
+            if isinstance(bundle, oldmemo.oldmemo.BundleImpl):
+                server.publish(own_bare_jid, node, item_id, oldmemo.etree.serialize_bundle(bundle))
+
+        @staticmethod
+        async def _download_bundle(namespace: str, bare_jid: str, device_id: int) -> omemo.Bundle:
+            bundle_elt = server.get_item(bare_jid, *_bundle_node(namespace, device_id))
+            if bundle_elt is None:
+                raise BundleNotFound(
+                    f"Bundle of {bare_jid}: {device_id} not found under namespace {namespace}"
+                )
+
+            if namespace == twomemo.twomemo.NAMESPACE:
+                return twomemo.etree.parse_bundle(bundle_elt, bare_jid, device_id)
+            return oldmemo.etree.parse_bundle(bundle_elt, bare_jid, device_id)
+
+        @staticmethod
+        async def _delete_bundle(namespace: str, device_id: int) -> None:
+            server.retract(own_bare_jid, *_bundle_node(namespace, device_id))
+
+        @staticmethod
+        async def _upload_device_list(namespace: str, device_list: Dict[int, Optional[str]]) -> None:
+            if namespace == twomemo.twomemo.NAMESPACE:
+                server.publish(
+                    own_bare_jid,
+                    TWOMEMO_DEVICE_LIST_NODE,
+                    "current",
+                    twomemo.etree.serialize_device_list(device_list)
+                )
+            if namespace == oldmemo.oldmemo.NAMESPACE:
+                server.publish(
+                    own_bare_jid,
+                    OLDMEMO_DEVICE_LIST_NODE,
+                    "current",
+                    oldmemo.etree.serialize_device_list(device_list)
+                )
+
+        @staticmethod
+        async def _download_device_list(namespace: str, bare_jid: str) -> Dict[int, Optional[str]]:
+            device_list_elt = server.get_item(bare_jid, _device_list_node(namespace), "current")
+            if device_list_elt is None:
+                return {}
+
+            if namespace == twomemo.twomemo.NAMESPACE:
+                return twomemo.etree.parse_device_list(device_list_elt)
+            return oldmemo.etree.parse_device_list(device_list_elt)
+
+        async def _evaluate_custom_trust_level(self, device: DeviceInformation) -> omemo.TrustLevel:
+            return omemo.TrustLevel.TRUSTED
+
+        async def _make_trust_decision(
+            self,
+            undecided: FrozenSet[DeviceInformation],
+            identifier: Optional[str]
+        ) -> None:
+            pass
+
+        @staticmethod
+        async def _send_message(message: omemo.Message, bare_jid: str) -> None:
+            stanza = ET.Element(f"{{{CLIENT_NS}}}message", {
+                "from": own_bare_jid,
+                "to": bare_jid,
+                "type": "chat"
+            })
+            stanza.append(serialize_message(message))
+            server.route(stanza)
+
+    storage = MemoryStorage()
+
+    return await LoopbackSessionManager.create(
+        [ twomemo.Twomemo(storage), oldmemo.Oldmemo(storage) ],
+        storage,
+        bare_jid,
+        initial_own_label=None,
+        undecided_trust_level_name="undecided"
+    )
+
+
+class LoopbackPlugin(XEP_0384):
+    """
+    Plugin implementation with in-memory storage which blindly trusts all devices.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+
+        self.__storage = MemoryStorage()
+
+    @property
+    def storage(self) -> Storage:
+        return self.__storage
+
+    @property
+    def memory_storage(self) -> MemoryStorage:
+        """
+        Returns:
+            The storage, to inspect its data.
+        """
+
+        return self.__storage
+
+    @property
+    def _btbv_enabled(self) -> bool:
+        return True
+
+    async def _devices_blindly_trusted(self, blindly_trusted: object, identifier: object) -> None:
+        pass
+
+    async def _prompt_manual_trust(self, manually_trusted: object, identifier: object) -> None:
+        pass
+
+
+register_plugin(LoopbackPlugin)
+
+
+class LoopbackClient(ClientXMPP):
+    """
+    Client with the :class:`LoopbackPlugin` registered, which is connected to a :class:`LoopbackServer`
+    instead of a real XMPP server. Stanzas are handed to the server directly, without a stream, and messages
+    routed to the client are polled from the server.
+    """
+
+    def __init__(
+        self,
+        jid: str,
+        server: LoopbackServer,
+        config: Optional[Dict[str, Any]] = None,
+        poll_interval: float = 0.01
+    ) -> None:
+        """
+        Args:
+            jid: The full JID of the client.
+            server: The loopback server.
+            config: The config of the plugin.
+            poll_interval: The interval to poll the server for messages in, in seconds.
+        """
+
+        super().__init__(jid, "password")
+
+        self.__server = server
+        self.__poll_interval = poll_interval
+        self.__polled = 0
+        self.__receiver: Optional[asyncio.Task[None]] = None
+
+        self.received: List[Message] = []
+        self.register_handler(Callback(
+            "Loopback Messages",
+            MatchXPath(f"{{{CLIENT_NS}}}message"),
+            self.received.append  # type: ignore[arg-type]
+        ))
+
+        self.register_plugin("xep_0384", config)
+
+    @property
+    def omemo(self) -> LoopbackPlugin:
+        """
+        Returns:
+            The plugin instance.
+        """
+
+        plugin: LoopbackPlugin = self["xep_0384"]
+        return plugin
+
+    def connect(self, host: Optional[str] = None, port: Optional[int] = None) -> "asyncio.Future[bool]":
+        self.session_bind_event.set()
+        self.event("session_bind", self.boundjid)
+        self.event("session_start")
+
+        self.__receiver = asyncio.create_task(self.__receive())
+
+        future: "asyncio.Future[bool]" = asyncio.get_running_loop().create_future()
+        future.set_result(True)
+        return future
+
+    def disconnect(
+        self,
+        wait: Union[float, int] = 2.0,
+        reason: Optional[str] = None,
+        ignore_send_queue: bool = False
+    ) -> "asyncio.Future[None]":
+        if self.__receiver is not None:
+            self.__receiver.cancel()  # pylint: disable=no-member
+            self.__receiver = None
+
+        self.session_bind_event.clear()
+        self.event("disconnected", reason)
+
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def send(self, data: Union[StanzaBase, str], use_filters: bool = True) -> None:
+        if isinstance(data, Iq):
+            response = self.__server.handle_iq(self.boundjid, data.xml)
+            asyncio.get_running_loop().call_soon(self._spawn_event, response)
+            return
+
+        if isinstance(data, Message):
+            stanza = ET.fromstring(ET.tostring(data.xml))
+            stanza.set("from", self.boundjid.full)
+            self.__server.route(stanza)
+
+    async def __receive(self) -> None:
+        """
+        Poll the server for messages routed to this client and process them.
+        """
+
+        while True:
+            self.__polled, messages = self.__server.messages_for(self.boundjid.bare, self.__polled)
+            for message in messages:
+                self._spawn_event(message)
+
+            await asyncio.sleep(self.__poll_interval)
@@ -0,0 +1,32 @@
+from typing import Dict
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+
+
+__all__ = [
+    "MemoryStorage"
+]
+
+
+class MemoryStorage(Storage):
+    """
+    Storage implementation that keeps all data in a dictionary and counts the writes.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(True)
+
+        self.data: Dict[str, JSONType] = {}
+        self.writes = 0
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        return Just(self.data[key]) if key in self.data else Nothing()
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        self.data[key] = value
+        self.writes += 1
+
+    async def _delete(self, key: str) -> None:
+        self.data.pop(key, None)
+        self.writes += 1
@@ -0,0 +1,272 @@
+import asyncio
+from typing import Dict, FrozenSet, List, NoReturn, Optional, Tuple
+
+import omemo
+from omemo.session_manager import UnknownTrustLevel
+from omemo.types import DeviceInformation, TrustLevel as CoreTrustLevel
+import pytest
+
+from slixmpp_omemo import TrustLevel
+from slixmpp_omemo import base_session_manager
+from slixmpp_omemo.base_session_manager import BaseSessionManager
+
+
+__all__ = [
+    "SessionManagerImpl",
+    "make_device",
+    "test_blind_trust",
+    "test_cancelled_trust_decision_waiter",
+    "test_concurrent_trust_decisions",
+    "test_manual_trust",
+    "test_trust_cache_bound",
+    "test_trust_evaluation"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class SessionManagerImpl(BaseSessionManager):
+    """
+    Session manager that serves device information and trust from memory.
+    """
+
+    def __init__(self, devices: FrozenSet[DeviceInformation], btbv_enabled: bool = True) -> None:
+        super().__init__()
+
+        self.devices = devices
+        self.btbv_enabled = btbv_enabled
+        self.trust: Dict[Tuple[str, bytes], str] = {}
+        self.blindly_trusted: List[FrozenSet[DeviceInformation]] = []
+        self.manually_trusted: List[FrozenSet[DeviceInformation]] = []
+        self.manual_trust_gate: Optional[asyncio.Event] = None
+
+    async def get_device_information(self, bare_jid: str) -> FrozenSet[DeviceInformation]:
+        return frozenset(device._replace(trust_level_name=self.trust.get(
+            (device.bare_jid, device.identity_key),
+            device.trust_level_name
+        )) for device in self.devices if device.bare_jid == bare_jid)
+
+    async def set_trust(self, bare_jid: str, identity_key: bytes, trust_level_name: str) -> None:
+        self.trust[(bare_jid, identity_key)] = trust_level_name
+
+    @property
+    def _btbv_enabled(self) -> bool:
+        return self.btbv_enabled
+
+    async def _devices_blindly_trusted(
+        self,
+        blindly_trusted: FrozenSet[DeviceInformation],
+        identifier: Optional[str]
+    ) -> None:
+        self.blindly_trusted.append(blindly_trusted)
+
+    async def _prompt_manual_trust(
+        self,
+        manually_trusted: FrozenSet[DeviceInformation],
+        identifier: Optional[str]
+    ) -> None:
+        self.manually_trusted.append(manually_trusted)
+
+        if self.manual_trust_gate is not None:
+            await self.manual_trust_gate.wait()
+
+    @staticmethod
+    async def _upload_bundle(bundle: omemo.Bundle) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _download_bundle(namespace: str, bare_jid: str, device_id: int) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _delete_bundle(namespace: str, device_id: int) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _upload_device_list(namespace: str, device_list: Dict[int, Optional[str]]) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _download_device_list(namespace: str, bare_jid: str) -> NoReturn:
+        raise NotImplementedError()
+
+    @staticmethod
+    async def _send_message(message: omemo.Message, bare_jid: str) -> NoReturn:
+        raise NotImplementedError()
+
+
+def make_device(
+    bare_jid: str,
+    device_id: int,
+    trust_level: TrustLevel = TrustLevel.UNDECIDED
+) -> DeviceInformation:
+    """
+    Args:
+        bare_jid: The bare JID of the device.
+        device_id: The device id.
+        trust_level: The trust level of the device.
+
+    Returns:
+        Information about an active twomemo device with a random-looking identity key.
+    """
+
+    return DeviceInformation(
+        namespaces=frozenset({ "urn:xmpp:omemo:2" }),
+        active=frozenset({ ("urn:xmpp:omemo:2", True) }),
+        bare_jid=bare_jid,
+        device_id=device_id,
+        identity_key=device_id.to_bytes(32, "big"),
+        trust_level_name=trust_level.value,
+        label=None
+    )
+
+
+async def test_blind_trust() -> None:
+    """
+    Test that new devices of many bare JIDs are blindly trusted in a single decision.
+    """
+
+    devices = frozenset(make_device(f"user{i % 10}@example.org", i) for i in range(100))
+
+    session_manager = SessionManagerImpl(devices)
+    await session_manager._make_trust_decision(devices, "identifier")  # pylint: disable=protected-access
+
+    assert session_manager.trust == {
+        (device.bare_jid, device.identity_key): TrustLevel.BLINDLY_TRUSTED.value for device in devices
+    }
+    assert session_manager.blindly_trusted == [ devices ]
+    assert len(session_manager.manually_trusted) == 0
+
+
+async def test_manual_trust() -> None:
+    """
+    Test that bare JIDs with manually verified devices and all bare JIDs with BTBV disabled are prompted for
+    manual trust decisions.
+    """
+
+    verified = make_device("verified@example.org", 1, TrustLevel.TRUSTED)
+    undecided = frozenset({ make_device("verified@example.org", 2), make_device("new@example.org", 3) })
+
+    session_manager = SessionManagerImpl(undecided | { verified })
+    await session_manager._make_trust_decision(undecided, None)  # pylint: disable=protected-access
+
+    assert session_manager.blindly_trusted == [ frozenset({ make_device("new@example.org", 3) }) ]
+    assert session_manager.manually_trusted == [ frozenset({ make_device("verified@example.org", 2) }) ]
+
+    session_manager = SessionManagerImpl(undecided, btbv_enabled=False)
+    await session_manager._make_trust_decision(undecided, None)  # pylint: disable=protected-access
+
+    assert len(session_manager.blindly_trusted) == 0
+    assert session_manager.manually_trusted == [ undecided ]
+
+
+async def test_trust_evaluation() -> None:
+    """
+    Test that cached trust evaluations follow trust level and BTBV changes.
+    """
+
+    device = make_device("user@example.org", 1, TrustLevel.BLINDLY_TRUSTED)
+
+    session_manager = SessionManagerImpl(frozenset({ device }))
+
+    # pylint: disable=protected-access
+    assert await session_manager._evaluate_custom_trust_level(device) is CoreTrustLevel.TRUSTED
+    assert await session_manager._evaluate_custom_trust_level(device) is CoreTrustLevel.TRUSTED
+
+    session_manager.btbv_enabled = False
+    assert await session_manager._evaluate_custom_trust_level(device) is CoreTrustLevel.UNDECIDED
+
+    device = device._replace(trust_level_name=TrustLevel.DISTRUSTED.value)
+    assert await session_manager._evaluate_custom_trust_level(device) is CoreTrustLevel.DISTRUSTED
+
+    with pytest.raises(UnknownTrustLevel):
+        await session_manager._evaluate_custom_trust_level(device._replace(trust_level_name="UNKNOWN"))
+
+
+async def test_trust_cache_bound(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that the trust evaluation cache evicts the least recently used devices once full.
+    """
+
+    monkeypatch.setattr(base_session_manager, "TRUST_CACHE_MAX_ENTRIES", 2)
+
+    devices = [ make_device("user@example.org", i, TrustLevel.BLINDLY_TRUSTED) for i in range(3) ]
+
+    session_manager = SessionManagerImpl(frozenset(devices))
+
+    # pylint: disable=protected-access
+    await session_manager._evaluate_custom_trust_level(devices[0])
+    await session_manager._evaluate_custom_trust_level(devices[1])
+    await session_manager._evaluate_custom_trust_level(devices[0])
+    await session_manager._evaluate_custom_trust_level(devices[2])
+
+    trust_cache = getattr(session_manager, "_BaseSessionManager__trust_cache")
+    assert list(trust_cache) == [
+        (devices[0].bare_jid, devices[0].identity_key),
+        (devices[2].bare_jid, devices[2].identity_key)
+    ]
+
+
+async def test_concurrent_trust_decisions() -> None:
+    """
+    Test that concurrent trust decisions on overlapping sets of devices prompt only once per device.
+    """
+
+    devices = frozenset(make_device("user@example.org", i) for i in range(4))
+
+    session_manager = SessionManagerImpl(devices, btbv_enabled=False)
+    session_manager.manual_trust_gate = asyncio.Event()
+
+    first = frozenset(device for device in devices if device.device_id < 3)
+    second = frozenset(device for device in devices if device.device_id > 0)
+
+    # pylint: disable=protected-access
+    first_task = asyncio.create_task(session_manager._make_trust_decision(first, "first"))
+    while len(session_manager.manually_trusted) < 1:
+        await asyncio.sleep(0)
+
+    second_task = asyncio.create_task(session_manager._make_trust_decision(second, "second"))
+    while len(session_manager.manually_trusted) < 2:
+        await asyncio.sleep(0)
+
+    # The second decision only prompts for the device that isn't part of the first decision, and waits for
+    # the first decision to complete.
+    assert session_manager.manually_trusted == [ first, second - first ]
+    assert not second_task.done()
+
+    session_manager.manual_trust_gate.set()
+    await asyncio.gather(first_task, second_task)
+
+
+async def test_cancelled_trust_decision_waiter() -> None:
+    """
+    Test that cancelling an encryption which waits for the trust decision of another encryption does not
+    affect the decision.
+    """
+
+    devices = frozenset(make_device("user@example.org", i) for i in range(2))
+
+    session_manager = SessionManagerImpl(devices, btbv_enabled=False)
+    session_manager.manual_trust_gate = asyncio.Event()
+
+    # pylint: disable=protected-access
+    owner_task = asyncio.create_task(session_manager._make_trust_decision(devices, "owner"))
+    while len(session_manager.manually_trusted) < 1:
+        await asyncio.sleep(0)
+
+    cancelled_task = asyncio.create_task(session_manager._make_trust_decision(devices, "cancelled"))
+    waiter_task = asyncio.create_task(session_manager._make_trust_decision(devices, "waiter"))
+    await asyncio.sleep(0)
+
+    # Cancel a waiter while the prompt of the owner is still pending
+    cancelled_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled_task
+
+    assert not owner_task.done()
+
+    session_manager.manual_trust_gate.set()
+    await asyncio.gather(owner_task, waiter_task)
+
+    assert session_manager.manually_trusted == [ devices ]
@@ -0,0 +1,86 @@
+from typing import Dict, List
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+import pytest
+
+from slixmpp_omemo.caching_storage import CachingStorage
+
+
+__all__ = [
+    "CountingStorage",
+    "test_delete",
+    "test_eviction"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class CountingStorage(Storage):
+    """
+    Storage implementation that keeps all data in a dictionary and records the operations performed on it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(True)
+
+        self.data: Dict[str, JSONType] = {}
+        self.operations: List[str] = []
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        self.operations.append(f"load {key}")
+        return Just(self.data[key]) if key in self.data else Nothing()
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        self.operations.append(f"store {key}")
+        self.data[key] = value
+
+    async def _delete(self, key: str) -> None:
+        self.operations.append(f"delete {key}")
+        self.data.pop(key, None)
+
+
+async def test_eviction() -> None:
+    """
+    Test that loads are served from the cache and that the least recently used keys are evicted.
+    """
+
+    wrapped = CountingStorage()
+    wrapped.data.update({ "/a": 1, "/b": 2, "/c": 3 })
+    storage = CachingStorage(wrapped, 2)
+
+    assert (await storage.load("/a")).from_just() == 1
+    assert (await storage.load("/b")).from_just() == 2
+    assert (await storage.load("/a")).from_just() == 1
+    assert wrapped.operations == [ "load /a", "load /b" ]
+
+    # Evicts /b, the least recently used key
+    assert (await storage.load("/c")).from_just() == 3
+    assert storage.size == 2
+    assert (await storage.load("/a")).from_just() == 1
+    assert (await storage.load("/b")).from_just() == 2
+    assert wrapped.operations == [ "load /a", "load /b", "load /c", "load /b" ]
+
+    # Writes go through to the wrapped storage right away
+    await storage.store("/c", 4)
+    assert wrapped.data["/c"] == 4
+    assert (await storage.load("/c")).from_just() == 4
+
+
+async def test_delete() -> None:
+    """
+    Test that deleted and missing keys are cached as absent.
+    """
+
+    wrapped = CountingStorage()
+    wrapped.data["/a"] = 1
+    storage = CachingStorage(wrapped, 10)
+
+    assert (await storage.load("/a")).from_just() == 1
+    await storage.delete("/a")
+    assert "/a" not in wrapped.data
+    assert (await storage.load("/a")).is_nothing
+    assert (await storage.load("/missing")).is_nothing
+    assert (await storage.load("/missing")).is_nothing
+    assert wrapped.operations == [ "load /a", "delete /a", "load /missing" ]
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from slixmpp_omemo.circuit_breaker import CircuitBreaker, CircuitState
+
+
+__all__ = [
+    "test_backoff",
+    "test_disabled",
+    "test_open_and_close",
+    "test_release"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class Clock:
+    """
+    Replacement for :func:`time.monotonic` that only advances manually.
+    """
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(name="clock")
+def fixture_clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    """
+    Returns:
+        A manually advanced clock, installed in place of :func:`time.monotonic`.
+    """
+
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+async def test_open_and_close(clock: Clock) -> None:
+    """
+    Test that a circuit opens after consecutive failures, allows a single probe once the reset timeout passed,
+    and closes again on success.
+    """
+
+    breaker = CircuitBreaker(3, 30, 600)
+
+    assert not breaker.record_failure("example.org")
+    breaker.record_success("example.org")
+    assert not breaker.record_failure("example.org")
+    assert not breaker.record_failure("example.org")
+    assert breaker.state("example.org") is CircuitState.CLOSED
+    assert breaker.record_failure("example.org")
+
+    assert breaker.state("example.org") is CircuitState.OPEN
+    assert breaker.open_keys == frozenset({ "example.org" })
+    assert not breaker.allow("example.org")
+    assert breaker.allow("example.com")
+
+    clock.now += 30
+    assert breaker.state("example.org") is CircuitState.HALF_OPEN
+    assert breaker.allow("example.org")
+    assert not breaker.allow("example.org")
+
+    breaker.record_success("example.org")
+    assert breaker.state("example.org") is CircuitState.CLOSED
+    assert breaker.allow("example.org")
+    assert breaker.open_keys == frozenset()
+
+
+async def test_backoff(clock: Clock) -> None:
+    """
+    Test that failed probes double the reset timeout up to the maximum, and that failures of requests started
+    before the circuit opened are ignored.
+    """
+
+    breaker = CircuitBreaker(1, 30, 100)
+
+    assert breaker.record_failure("example.org")
+    assert not breaker.record_failure("example.org")
+
+    # The reset timeout doubles with every failed probe, capped at the maximum
+    for reset_timeout in [ 30, 60, 100, 100 ]:
+        clock.now += reset_timeout - 1
+        assert not breaker.allow("example.org")
+
+        clock.now += 1
+        assert breaker.allow("example.org")
+        assert breaker.record_failure("example.org")
+
+
+async def test_release(clock: Clock) -> None:
+    """
+    Test that releasing a probe without outcome allows another probe.
+    """
+
+    breaker = CircuitBreaker(1, 30, 600)
+
+    breaker.record_failure("example.org")
+    clock.now += 30
+
+    assert breaker.allow("example.org")
+    assert not breaker.allow("example.org")
+    breaker.release("example.org")
+    assert breaker.allow("example.org")
+
+
+async def test_disabled(clock: Clock) -> None:
+    """
+    Test that a failure threshold of zero disables the breaker.
+    """
+
+    breaker = CircuitBreaker(0, 30, 600)
+
+    for _ in range(10):
+        assert not breaker.record_failure("example.org")
+        assert breaker.allow("example.org")
+
+    clock.now += 1
+    assert breaker.state("example.org") is CircuitState.CLOSED
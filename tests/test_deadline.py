@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from slixmpp_omemo.deadline import Deadline, DeadlineExceeded
+
+
+__all__ = [
+    "test_expired",
+    "test_forwarded_timeout",
+    "test_futures",
+    "test_wait_for"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_wait_for() -> None:
+    """
+    Test that coroutines completing before the deadline return their result, and that coroutines still running
+    when the deadline expires are cancelled.
+    """
+
+    deadline = Deadline(0.1)
+    assert 0 < deadline.remaining <= 0.1
+
+    async def sleep_and_return(seconds: float) -> str:
+        await asyncio.sleep(seconds)
+        return "done"
+
+    assert await deadline.wait_for(sleep_and_return(0)) == "done"
+
+    cancelled = False
+
+    async def sleep_until_cancelled() -> None:
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    with pytest.raises(DeadlineExceeded):
+        await deadline.wait_for(sleep_until_cancelled())
+
+    assert cancelled
+    assert deadline.remaining <= 0
+
+
+async def test_expired() -> None:
+    """
+    Test that coroutines are not started at all once the deadline expired.
+    """
+
+    deadline = Deadline(0)
+    started = False
+
+    async def start() -> None:
+        nonlocal started
+        started = True
+
+    with pytest.raises(DeadlineExceeded):
+        await deadline.wait_for(start())
+
+    assert not started
+
+
+async def test_forwarded_timeout() -> None:
+    """
+    Test that timeouts raised by the coroutine itself before the deadline are not mistaken for the deadline.
+    """
+
+    deadline = Deadline(10)
+
+    async def time_out() -> None:
+        raise asyncio.TimeoutError()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await deadline.wait_for(time_out())
+
+
+async def test_futures() -> None:
+    """
+    Test that futures are cancelled when the deadline expires, and right away if it expired already.
+    """
+
+    deadline = Deadline(0.1)
+
+    future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    with pytest.raises(DeadlineExceeded):
+        await deadline.wait_for(future)
+
+    assert future.cancelled()
+
+    future = asyncio.get_running_loop().create_future()
+    with pytest.raises(DeadlineExceeded):
+        await deadline.wait_for(future)
+
+    assert future.cancelled()
+
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
@@ -0,0 +1,178 @@
+import os
+import time
+from typing import Optional
+
+from omemo import DecryptionFailed, KeyExchangeFailed, MessageNotForUs, NoSession
+from omemo.types import DeviceInformation
+import pytest
+
+from slixmpp_omemo.decryption_cache import INDEX_KEY, DecryptionCache, DecryptionOutcome
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_eviction",
+    "test_expiry",
+    "test_failures",
+    "test_index",
+    "test_persistence"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_outcome(plaintext: bytes, timestamp: Optional[float] = None) -> DecryptionOutcome:
+    """
+    Args:
+        plaintext: The plaintext of the outcome.
+        timestamp: The timestamp of the outcome, defaults to the current time.
+
+    Returns:
+        A successful decryption outcome.
+    """
+
+    return DecryptionOutcome(
+        namespace="urn:xmpp:omemo:2",
+        plaintext=plaintext,
+        device_information=DeviceInformation(
+            namespaces=frozenset({ "urn:xmpp:omemo:2" }),
+            active=frozenset({ ("urn:xmpp:omemo:2", True) }),
+            bare_jid="alice@example.org",
+            device_id=42,
+            identity_key=b"\x01" * 32,
+            trust_level_name="trusted",
+            label="Phone"
+        ),
+        failure=None,
+        timestamp=time.time() if timestamp is None else timestamp
+    )
+
+
+async def test_eviction() -> None:
+    """
+    Test that the least recently used outcomes are evicted once the cache is full.
+    """
+
+    cache = DecryptionCache(2, 60)
+
+    await cache.put("a", make_outcome(b"a"))
+    await cache.put("b", make_outcome(b"b"))
+    assert await cache.get("a") is not None
+    await cache.put("c", make_outcome(b"c"))
+
+    assert await cache.get("b") is None
+    assert (await cache.get("a") or make_outcome(b"")).plaintext == b"a"
+    assert (await cache.get("c") or make_outcome(b"")).plaintext == b"c"
+
+
+async def test_expiry() -> None:
+    """
+    Test that outcomes older than the maximum age are treated as absent.
+    """
+
+    cache = DecryptionCache(10, 60)
+
+    await cache.put("old", make_outcome(b"old", timestamp=1.0))
+    await cache.put("new", make_outcome(b"new"))
+
+    assert await cache.get("old") is None
+    assert await cache.get("new") is not None
+
+
+async def test_failures() -> None:
+    """
+    Test that permanent failures are raised again with a matching type, and other failures are not cached.
+    """
+
+    outcome = DecryptionOutcome.from_failure("urn:xmpp:omemo:2", MessageNotForUs("not for us"))
+    assert outcome is not None
+    outcome = DecryptionOutcome.parse(outcome.serialize())
+    with pytest.raises(MessageNotForUs, match="not for us"):
+        outcome.raise_failure()
+
+    # Failures that depend on the session state or the configuration might not happen again
+    for exception in [
+        NoSession("no session"),
+        KeyExchangeFailed("key exchange failed"),
+        DecryptionFailed("broken"),
+        ValueError("XEP-0045 not loaded"),
+        ConnectionError()
+    ]:
+        assert DecryptionOutcome.from_failure("urn:xmpp:omemo:2", exception) is None
+
+    # Failures cached by earlier versions are treated as absent
+    serialized = make_outcome(b"").serialize()
+    assert isinstance(serialized, dict)
+    serialized["failure"] = [ "NoSession", "no session" ]
+    with pytest.raises(ValueError):
+        DecryptionOutcome.parse(serialized)
+
+    make_outcome(b"plaintext").raise_failure()
+
+
+async def test_persistence() -> None:
+    """
+    Test that persisted outcomes are available to other cache instances sharing the storage and key, and that
+    outcomes persisted using a different key are treated as absent.
+    """
+
+    for key in [ None, os.urandom(32) ]:
+        storage = MemoryStorage()
+
+        cache = DecryptionCache(10, 60, storage, key)
+        await cache.put("a", make_outcome(b"a"))
+
+        # Sealed outcomes are opaque strings, unsealed outcomes are stored as JSON objects
+        assert isinstance(storage.data["/slixmpp/decryption_cache/a"], str) == (key is not None)
+
+        outcome = await DecryptionCache(10, 60, storage, key).get("a")
+        assert outcome is not None
+        assert outcome == make_outcome(b"a", timestamp=outcome.timestamp)
+
+    storage = MemoryStorage()
+    await DecryptionCache(10, 60, storage, os.urandom(32)).put("a", make_outcome(b"a"))
+    assert await DecryptionCache(10, 60, storage, os.urandom(32)).get("a") is None
+    assert await DecryptionCache(10, 60, storage).get("a") is None
+
+
+async def test_index() -> None:
+    """
+    Test that caching an outcome only rewrites the index buckets of the cached and evicted keys, and that the
+    persisted outcomes are loaded oldest first.
+    """
+
+    storage = MemoryStorage()
+    cache = DecryptionCache(100, 60, storage)
+    for i in range(100):
+        await cache.put(f"key-{i}", make_outcome(b"a"))
+
+    buckets = { key: value for key, value in storage.data.items() if key.startswith(f"{INDEX_KEY}/") }
+    assert sum(len(value) for value in buckets.values() if isinstance(value, list)) == 100
+    assert len(buckets) > 1
+
+    # One write for the outcome, one for its bucket, and one per evicted outcome and its bucket at most
+    writes = storage.writes
+    await cache.put("key-100", make_outcome(b"a"))
+    assert storage.writes - writes <= 4
+    assert await DecryptionCache(100, 60, storage).get("key-0") is None
+    assert await DecryptionCache(100, 60, storage).get("key-100") is not None
+
+    # The least recently used order is not persisted, outcomes are loaded oldest first
+    storage = MemoryStorage()
+    now = time.time()
+    cache = DecryptionCache(3, 60, storage)
+    for i, key in enumerate([ "c", "b", "a" ]):
+        await cache.put(key, make_outcome(key.encode(), now - i))
+
+    cache = DecryptionCache(2, 60, storage)
+    assert await cache.get("b") is not None
+    await cache.put("d", make_outcome(b"d"))
+
+    # The oldest outcome and the least recently used one are evicted
+    cache = DecryptionCache(2, 60, storage)
+    assert await cache.get("a") is None
+    assert await cache.get("b") is not None
+    assert await cache.get("c") is None
+    assert await cache.get("d") is not None
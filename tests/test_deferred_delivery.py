@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from slixmpp_omemo.deferred_delivery import DeferredDeliveryQueue
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_encryption",
+    "test_malformed",
+    "test_persistence",
+    "test_update"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_persistence() -> None:
+    """
+    Test that deferred messages are available to other queue instances sharing the storage.
+    """
+
+    storage = MemoryStorage()
+
+    queue = DeferredDeliveryQueue(storage)
+    first = await queue.put(
+        "<message/>",
+        "chat",
+        frozenset({ ("alice@example.org", 1), ("bob@example.org", None) })
+    )
+    second = await queue.put("<message><body/></message>", None, frozenset({ ("alice@example.org", 2) }))
+
+    assert queue.size == 3
+    assert queue.oldest_timestamp == first.timestamp
+    assert queue.is_pending("bob@example.org")
+    assert not queue.is_pending("carol@example.org")
+
+    loaded = DeferredDeliveryQueue(storage)
+    assert loaded.size == 0
+    assert await loaded.messages() == [ first, second ]
+    assert loaded.size == 3
+
+
+async def test_update() -> None:
+    """
+    Test that updating the pending recipients persists them, and that messages without pending recipients are
+    removed.
+    """
+
+    storage = MemoryStorage()
+
+    queue = DeferredDeliveryQueue(storage)
+    message = await queue.put(
+        "<message/>",
+        None,
+        frozenset({ ("alice@example.org", 1), ("bob@example.org", 2) })
+    )
+
+    await queue.update(message.message_id, frozenset({ ("bob@example.org", 2) }))
+    assert not queue.is_pending("alice@example.org")
+    assert [ m.recipients for m in await DeferredDeliveryQueue(storage).messages() ] \
+        == [ frozenset({ ("bob@example.org", 2) }) ]
+
+    await queue.update(message.message_id, frozenset())
+    assert queue.size == 0
+    assert queue.oldest_timestamp is None
+    assert await DeferredDeliveryQueue(storage).messages() == []
+    assert f"/slixmpp/deferred_delivery/{message.message_id}" not in storage.data
+
+
+async def test_malformed() -> None:
+    """
+    Test that malformed persisted messages are skipped on load but kept, and that missing messages are dropped
+    from the index.
+    """
+
+    storage = MemoryStorage()
+
+    queue = DeferredDeliveryQueue(storage)
+    message = await queue.put("<message/>", None, frozenset({ ("alice@example.org", 1) }))
+    await storage.store("/slixmpp/deferred_delivery/list", [ message.message_id, "broken", "missing" ])
+    await storage.store("/slixmpp/deferred_delivery/broken", { "stanza": "<message/>" })
+
+    assert await DeferredDeliveryQueue(storage).messages() == [ message ]
+    assert storage.data["/slixmpp/deferred_delivery/list"] == [ message.message_id, "broken" ]
+    assert "/slixmpp/deferred_delivery/broken" in storage.data
+
+
+async def test_encryption() -> None:
+    """
+    Test that messages are stored encrypted with the key, and skipped without losing them on load with a
+    different key.
+    """
+
+    storage = MemoryStorage()
+    key = os.urandom(32)
+
+    queue = DeferredDeliveryQueue(storage, key)
+    message = await queue.put(
+        "<message><body>Secret</body></message>",
+        None,
+        frozenset({ ("alice@example.org", 1) })
+    )
+
+    stored = storage.data[f"/slixmpp/deferred_delivery/{message.message_id}"]
+    assert isinstance(stored, str)
+    assert "Secret" not in stored
+    assert "alice@example.org" not in stored
+
+    assert await DeferredDeliveryQueue(storage, key).messages() == [ message ]
+
+    await queue.update(message.message_id, frozenset({ ("alice@example.org", 1), ("bob@example.org", 2) }))
+    assert [ m.recipients for m in await DeferredDeliveryQueue(storage, key).messages() ] \
+        == [ frozenset({ ("alice@example.org", 1), ("bob@example.org", 2) }) ]
+
+    # A queue using the wrong key keeps the messages it can't read when it is written to
+    wrong_key_queue = DeferredDeliveryQueue(storage, os.urandom(32))
+    assert await wrong_key_queue.messages() == []
+    other = await wrong_key_queue.put("<message/>", None, frozenset({ ("bob@example.org", 1) }))
+    await wrong_key_queue.remove(other.message_id)
+
+    assert [ m.recipients for m in await DeferredDeliveryQueue(storage, key).messages() ] \
+        == [ frozenset({ ("alice@example.org", 1), ("bob@example.org", 2) }) ]
@@ -0,0 +1,67 @@
+import pytest
+
+from slixmpp_omemo.device_activity import DeviceActivity
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_inactive_devices",
+    "test_record"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_record(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that activity is persisted with the configured resolution.
+    """
+
+    storage = MemoryStorage()
+    device_activity = DeviceActivity(storage, resolution=60)
+
+    monkeypatch.setattr("time.time", lambda: 1000.0)
+    await device_activity.record("bob@example.org", 1)
+    monkeypatch.setattr("time.time", lambda: 1030.0)
+    await device_activity.record("bob@example.org", 1)
+    assert storage.writes == 1
+
+    monkeypatch.setattr("time.time", lambda: 1060.0)
+    await device_activity.record("bob@example.org", 1)
+    assert storage.writes == 2
+    assert storage.data["/slixmpp/device_activity/bob@example.org"] == { "1": 1060.0 }
+
+    assert await DeviceActivity(storage).last_activity("bob@example.org") == { 1: 1060.0 }
+
+
+async def test_inactive_devices(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that devices become inactive after the max age, unless all devices of the bare JID are inactive, and
+    that devices returning to the device list get a fresh grace period.
+    """
+
+    storage = MemoryStorage()
+    device_activity = DeviceActivity(storage, resolution=10)
+
+    monkeypatch.setattr("time.time", lambda: 0.0)
+    assert await device_activity.inactive_devices("bob@example.org", { 1, 2 }, 100) == frozenset()
+
+    monkeypatch.setattr("time.time", lambda: 50.0)
+    await device_activity.record("bob@example.org", 2)
+
+    monkeypatch.setattr("time.time", lambda: 120.0)
+    assert await device_activity.inactive_devices("bob@example.org", { 1, 2 }, 100) == frozenset({ 1 })
+
+    # Device 2 is removed from the device list and device 1 is the only one left, thus it is kept
+    assert await device_activity.inactive_devices("bob@example.org", { 1 }, 100) == frozenset()
+    assert await device_activity.last_activity("bob@example.org") == { 1: 0.0 }
+
+    # Device 2 returns
+    monkeypatch.setattr("time.time", lambda: 500.0)
+    assert await device_activity.inactive_devices("bob@example.org", { 1, 2 }, 100) == frozenset({ 1 })
+    assert await device_activity.last_activity("bob@example.org") == { 1: 0.0, 2: 500.0 }
+
+    assert await device_activity.inactive_devices("bob@example.org", set(), 100) == frozenset()
+    assert "/slixmpp/device_activity/bob@example.org" not in storage.data
@@ -0,0 +1,197 @@
+import copy
+import os
+from xml.etree import ElementTree as ET
+
+import oldmemo
+import oldmemo.etree
+import pytest
+import twomemo
+import twomemo.etree
+import x3dh
+import xeddsa
+
+from slixmpp_omemo import fast_etree
+
+
+__all__ = [
+    "test_bundles",
+    "test_device_lists",
+    "test_malformed_bundles",
+    "test_malformed_device_lists",
+    "test_malformed_messages"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_bundle_contents() -> x3dh.Bundle:
+    """
+    Returns:
+        Bundle contents with random keys, suitable for serialization by both OMEMO versions.
+    """
+
+    signed_pre_key_sig = bytearray(os.urandom(64))
+    signed_pre_key_sig[63] &= 0x7f
+
+    return x3dh.Bundle(
+        xeddsa.seed_to_ed25519_pub(os.urandom(32)),
+        xeddsa.priv_to_curve25519_pub(os.urandom(32)),
+        bytes(signed_pre_key_sig),
+        frozenset(xeddsa.priv_to_curve25519_pub(os.urandom(32)) for _ in range(10))
+    )
+
+
+async def test_device_lists() -> None:
+    """
+    Test that the structural device list parsers produce the same results as the schema-validating ones.
+    """
+
+    device_list = { 1: "Phone", 2: None, 0xFFFFFFFF: "" }
+
+    element = twomemo.etree.serialize_device_list(device_list)
+    assert fast_etree.parse_twomemo_device_list(element) == twomemo.etree.parse_device_list(element)
+
+    element = oldmemo.etree.serialize_device_list(device_list)
+    assert fast_etree.parse_oldmemo_device_list(element) == oldmemo.etree.parse_device_list(element)
+
+    assert len(fast_etree.parse_twomemo_device_list(twomemo.etree.serialize_device_list({}))) == 0
+
+
+async def test_bundles() -> None:
+    """
+    Test that the structural bundle parsers produce the same results as the schema-validating ones.
+    """
+
+    contents = make_bundle_contents()
+    pre_key_ids = { pre_key: pre_key_id for pre_key_id, pre_key in enumerate(contents.pre_keys) }
+
+    element = twomemo.etree.serialize_bundle(
+        twomemo.twomemo.BundleImpl("alice@example.org", 42, contents, 7, pre_key_ids)
+    )
+    expected = twomemo.etree.parse_bundle(element, "alice@example.org", 42)
+    parsed = fast_etree.parse_twomemo_bundle(element, "alice@example.org", 42)
+    assert (parsed.bundle, parsed.signed_pre_key_id, parsed.pre_key_ids) \
+        == (expected.bundle, expected.signed_pre_key_id, expected.pre_key_ids)
+
+    element = oldmemo.etree.serialize_bundle(
+        oldmemo.oldmemo.BundleImpl("alice@example.org", 42, contents, 7, pre_key_ids)
+    )
+    expected_old = oldmemo.etree.parse_bundle(element, "alice@example.org", 42)
+    parsed_old = fast_etree.parse_oldmemo_bundle(element, "alice@example.org", 42)
+    assert (parsed_old.bundle, parsed_old.signed_pre_key_id, parsed_old.pre_key_ids) \
+        == (expected_old.bundle, expected_old.signed_pre_key_id, expected_old.pre_key_ids)
+
+
+async def test_malformed_device_lists() -> None:
+    """
+    Test that the structural device list parsers reject malformed input.
+    """
+
+    for device_id in [ "-1", "4294967296", "1_000", "0x10", "", "١" ]:
+        element = ET.Element("{urn:xmpp:omemo:2}devices")
+        ET.SubElement(element, "{urn:xmpp:omemo:2}device", { "id": device_id })
+        with pytest.raises(ValueError):
+            fast_etree.parse_twomemo_device_list(element)
+
+    element = twomemo.etree.serialize_device_list({ 1: None })
+    ET.SubElement(element, "{urn:xmpp:omemo:2}unexpected")
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_device_list(element)
+
+    element = oldmemo.etree.serialize_device_list({ 1: None })
+    del element[0].attrib["id"]
+    with pytest.raises(ValueError):
+        fast_etree.parse_oldmemo_device_list(element)
+
+    with pytest.raises(ValueError):
+        fast_etree.parse_oldmemo_device_list(twomemo.etree.serialize_device_list({ 1: None }))
+
+
+async def test_malformed_bundles() -> None:
+    """
+    Test that the structural bundle parsers reject malformed input.
+    """
+
+    contents = make_bundle_contents()
+    pre_key_ids = { pre_key: pre_key_id for pre_key_id, pre_key in enumerate(contents.pre_keys) }
+
+    valid = twomemo.etree.serialize_bundle(
+        twomemo.twomemo.BundleImpl("alice@example.org", 42, contents, 7, pre_key_ids)
+    )
+
+    # Missing signed pre key
+    element = copy.deepcopy(valid)
+    element.remove(element[0])
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_bundle(element, "alice@example.org", 42)
+
+    # Duplicate identity key
+    element = copy.deepcopy(valid)
+    element.append(copy.deepcopy(element[2]))
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_bundle(element, "alice@example.org", 42)
+
+    # Invalid base64
+    element = copy.deepcopy(valid)
+    element[2].text = "not base64!"
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_bundle(element, "alice@example.org", 42)
+
+    # No pre keys
+    element = copy.deepcopy(valid)
+    element[3].clear()
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_bundle(element, "alice@example.org", 42)
+
+    # Truncated signature
+    element = oldmemo.etree.serialize_bundle(
+        oldmemo.oldmemo.BundleImpl("alice@example.org", 42, contents, 7, pre_key_ids)
+    )
+    element[1].text = "AAAA"
+    with pytest.raises(ValueError):
+        fast_etree.parse_oldmemo_bundle(element, "alice@example.org", 42)
+
+
+async def test_malformed_messages() -> None:
+    """
+    Test that the structural message parsers reject malformed input before touching the key material.
+    """
+
+    # Missing header
+    element = ET.Element("{urn:xmpp:omemo:2}encrypted")
+    ET.SubElement(element, "{urn:xmpp:omemo:2}payload").text = "AAAA"
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_message(element, "alice@example.org")
+
+    # Header without keys
+    element = ET.Element("{urn:xmpp:omemo:2}encrypted")
+    ET.SubElement(element, "{urn:xmpp:omemo:2}header", { "sid": "1" })
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_message(element, "alice@example.org")
+
+    # Keys without jid
+    element = ET.Element("{urn:xmpp:omemo:2}encrypted")
+    header_elt = ET.SubElement(element, "{urn:xmpp:omemo:2}header", { "sid": "1" })
+    keys_elt = ET.SubElement(header_elt, "{urn:xmpp:omemo:2}keys")
+    ET.SubElement(keys_elt, "{urn:xmpp:omemo:2}key", { "rid": "2" }).text = "AAAA"
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_message(element, "alice@example.org")
+
+    # Invalid boolean
+    keys_elt.set("jid", "bob@example.org")
+    keys_elt[0].set("kex", "yes")
+    with pytest.raises(ValueError):
+        fast_etree.parse_twomemo_message(element, "alice@example.org")
+
+    # Missing iv, the session manager is never consulted
+    element = ET.Element("{eu.siacs.conversations.axolotl}encrypted")
+    header_elt = ET.SubElement(element, "{eu.siacs.conversations.axolotl}header", { "sid": "1" })
+    ET.SubElement(header_elt, "{eu.siacs.conversations.axolotl}key", { "rid": "2" }).text = "AAAA"
+    with pytest.raises(ValueError):
+        await fast_etree.parse_oldmemo_message(
+            element,
+            "alice@example.org",
+            "bob@example.org",
+            None  # type: ignore[arg-type]
+        )
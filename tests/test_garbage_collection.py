@@ -0,0 +1,182 @@
+import pytest
+
+from slixmpp_omemo.device_activity import DeviceActivity
+from slixmpp_omemo.garbage_collection import SESSION_KEYS, GarbageCollector
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "DeviceStorage",
+    "test_inactive_age",
+    "test_inactive_listed_devices",
+    "test_orphaned_sessions",
+    "test_own_device"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+NAMESPACE = "urn:xmpp:omemo:2"
+
+
+class DeviceStorage(MemoryStorage):
+    """
+    Memory storage with helpers to add devices and sessions.
+    """
+
+    def add_device(self, bare_jid: str, device_id: int, active: bool, session: bool = True) -> None:
+        """
+        Add the device information and optionally a session for a device.
+
+        Args:
+            bare_jid: The bare JID of the device.
+            device_id: The id of the device.
+            active: Whether the device is active.
+            session: Whether to add a session.
+        """
+
+        device_list = self.data.setdefault(f"/devices/{bare_jid}/list", [])
+        assert isinstance(device_list, list)
+        device_list.append(device_id)
+        self.data[f"/devices/{bare_jid}/{device_id}/namespaces"] = [ NAMESPACE ]
+        self.data[f"/devices/{bare_jid}/{device_id}/active"] = { NAMESPACE: active }
+        self.data[f"/devices/{bare_jid}/{device_id}/label"] = None
+        self.data[f"/devices/{bare_jid}/{device_id}/identity_key"] = "aWs="
+
+        if session:
+            self.add_session(bare_jid, device_id)
+
+    def add_session(self, bare_jid: str, device_id: int) -> None:
+        """
+        Add a session for a device.
+
+        Args:
+            bare_jid: The bare JID of the device.
+            device_id: The id of the device.
+        """
+
+        bare_jids = self.data.setdefault(f"/{NAMESPACE}/bare_jids", [])
+        assert isinstance(bare_jids, list)
+        if bare_jid not in bare_jids:
+            bare_jids.append(bare_jid)
+
+        device_ids = self.data.setdefault(f"/{NAMESPACE}/{bare_jid}/device_ids", [])
+        assert isinstance(device_ids, list)
+        device_ids.append(device_id)
+
+        for key in SESSION_KEYS:
+            self.data[f"/{NAMESPACE}/{bare_jid}/{device_id}/{key}"] = "x" * 10
+
+
+async def test_inactive_age(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that inactive devices are purged once inactive for longer than the max age only.
+    """
+
+    storage = DeviceStorage()
+    storage.add_device("alice@example.org", 1, True)
+    storage.add_device("bob@example.org", 2, True)
+    storage.add_device("bob@example.org", 3, False)
+    storage.add_device("bob@example.org", 4, False, session=False)
+    storage.data["/trust/bob@example.org/aWs="] = "TRUSTED"
+
+    collector = GarbageCollector(storage, [ NAMESPACE ], "alice@example.org", 1)
+
+    monkeypatch.setattr("time.time", lambda: 1000.0)
+    result = await collector.collect([ "bob@example.org" ], max_inactive_age=100)
+    assert result.devices == 0
+    assert storage.data["/slixmpp/gc/bob@example.org"] == { "3": 1000.0, "4": 1000.0 }
+
+    # Device 4 becomes active again in the meantime
+    storage.data["/devices/bob@example.org/4/active"] = { NAMESPACE: True }
+
+    monkeypatch.setattr("time.time", lambda: 1100.0)
+    result = await collector.collect([ "bob@example.org" ], max_inactive_age=100, batch_size=1)
+    assert result.devices == 1
+    assert result.keys == len(SESSION_KEYS) + 4
+    assert result.size == len(SESSION_KEYS) * 12 + 20 + 27 + 4 + 6
+
+    assert storage.data["/devices/bob@example.org/list"] == [ 2, 4 ]
+    assert storage.data[f"/{NAMESPACE}/bob@example.org/device_ids"] == [ 2 ]
+    assert not any(key.startswith(f"/{NAMESPACE}/bob@example.org/3/") for key in storage.data)
+    assert "/devices/bob@example.org/3/active" not in storage.data
+    assert "/slixmpp/gc/bob@example.org" not in storage.data
+    assert storage.data["/trust/bob@example.org/aWs="] == "TRUSTED"
+
+
+async def test_inactive_listed_devices(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that the sessions of listed devices are purged once their last recorded activity is older than the
+    max age, while their device information is kept, and that listed devices are left alone without a device
+    activity tracker.
+    """
+
+    storage = DeviceStorage()
+    storage.add_device("bob@example.org", 2, True)
+    storage.add_device("bob@example.org", 3, True)
+    storage.add_device("bob@example.org", 4, True)
+
+    device_activity = DeviceActivity(storage, 0)
+    monkeypatch.setattr("time.time", lambda: 1000.0)
+    await device_activity.record("bob@example.org", 2)
+    await device_activity.record("bob@example.org", 3)
+
+    monkeypatch.setattr("time.time", lambda: 1050.0)
+    await device_activity.record("bob@example.org", 3)
+
+    monkeypatch.setattr("time.time", lambda: 1120.0)
+    result = await GarbageCollector(storage, [ NAMESPACE ], "alice@example.org", 1).collect(
+        [ "bob@example.org" ],
+        max_inactive_age=100
+    )
+    assert result == (0, 0, 0, 0)
+
+    collector = GarbageCollector(storage, [ NAMESPACE ], "alice@example.org", 1, device_activity)
+    result = await collector.collect([ "bob@example.org" ], max_inactive_age=100)
+    assert result.devices == 0
+    assert result.sessions == 1
+    assert result.keys == len(SESSION_KEYS)
+    assert result.size == len(SESSION_KEYS) * 12
+
+    # Device 4 has no recorded activity and keeps its session
+    assert storage.data["/devices/bob@example.org/list"] == [ 2, 3, 4 ]
+    assert storage.data[f"/{NAMESPACE}/bob@example.org/device_ids"] == [ 3, 4 ]
+    assert not any(key.startswith(f"/{NAMESPACE}/bob@example.org/2/") for key in storage.data)
+    assert storage.data["/devices/bob@example.org/2/identity_key"] == "aWs="
+    assert "/slixmpp/gc/bob@example.org" not in storage.data
+
+
+async def test_orphaned_sessions() -> None:
+    """
+    Test that sessions without device information are purged right away, and the backend's lists updated.
+    """
+
+    storage = DeviceStorage()
+    storage.add_session("carol@example.org", 5)
+
+    collector = GarbageCollector(storage, [ NAMESPACE ], "alice@example.org", 1)
+    result = await collector.collect()
+
+    assert result.devices == 1
+    assert result.keys == len(SESSION_KEYS)
+    assert f"/{NAMESPACE}/carol@example.org/device_ids" not in storage.data
+    assert storage.data[f"/{NAMESPACE}/bare_jids"] == [ "carol@example.org" ]
+
+
+async def test_own_device() -> None:
+    """
+    Test that the own device is never purged, while other inactive devices of the own account are.
+    """
+
+    storage = DeviceStorage()
+    storage.add_device("alice@example.org", 1, False)
+    storage.add_device("alice@example.org", 2, False)
+
+    collector = GarbageCollector(storage, [ NAMESPACE ], "alice@example.org", 1)
+    result = await collector.collect(max_inactive_age=0)
+
+    assert result.devices == 1
+    assert storage.data["/devices/alice@example.org/list"] == [ 1 ]
+    assert f"/{NAMESPACE}/alice@example.org/1/double_ratchet" in storage.data
@@ -0,0 +1,183 @@
+import asyncio
+from pathlib import Path
+import threading
+import time
+from typing import List
+
+import pytest
+
+from slixmpp_omemo.log_storage import FsyncPolicy, LogStorage
+
+
+__all__ = [
+    "test_compaction",
+    "test_corruption",
+    "test_fsync_executor",
+    "test_interval_fsync",
+    "test_recovery",
+    "test_replay"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_replay(tmp_path: Path) -> None:
+    """
+    Test that stores and deletes are visible after reopening the log.
+    """
+
+    path = str(tmp_path / "omemo.log")
+
+    storage = LogStorage(path)
+    await storage.store("/a", { "nested": [ 1, "two", None ] })
+    await storage.store("/b", "b")
+    await storage.store("/a", "ä")
+    await storage.store("/null", None)
+    await storage.delete("/b")
+    await storage.delete("/missing")
+    storage.close()
+
+    storage = LogStorage(path, disable_cache=True)
+    assert (await storage.load("/a")).from_just() == "ä"
+    assert (await storage.load("/b")).is_nothing
+    assert (await storage.load("/null")).is_just
+    assert (await storage.load("/null")).from_just() is None
+    assert (await storage.load("/missing")).is_nothing
+    storage.close()
+
+
+async def test_recovery(tmp_path: Path) -> None:
+    """
+    Test that a partially written record at the end of the log is cut off.
+    """
+
+    path = tmp_path / "omemo.log"
+
+    storage = LogStorage(str(path))
+    await storage.store("/a", 1)
+    await storage.store("/b", 2)
+    storage.close()
+
+    complete = path.read_bytes()
+    path.write_bytes(complete + b'S "/c" [1, ')
+
+    storage = LogStorage(str(path), disable_cache=True)
+    assert (await storage.load("/b")).from_just() == 2
+    assert (await storage.load("/c")).is_nothing
+    assert storage.size == len(complete)
+
+    await storage.store("/c", 3)
+    storage.close()
+
+    storage = LogStorage(str(path), disable_cache=True)
+    assert (await storage.load("/c")).from_just() == 3
+    storage.close()
+
+
+async def test_corruption(tmp_path: Path) -> None:
+    """
+    Test that a malformed complete record is rejected instead of cutting off the records after it.
+    """
+
+    path = tmp_path / "omemo.log"
+
+    storage = LogStorage(str(path))
+    await storage.store("/a", 1)
+    await storage.store("/b", 2)
+    await storage.store("/c", 3)
+    storage.close()
+
+    complete = path.read_bytes()
+    path.write_bytes(complete.replace(b'S "/b" 2\n', b'S "/b" \xff\n'))
+
+    with pytest.raises(ValueError):
+        LogStorage(str(path))
+
+    # The records after the malformed one are left in place
+    assert path.read_bytes().endswith(b'S "/c" 3\n')
+    assert len(path.read_bytes()) == len(complete)
+
+
+async def test_compaction(tmp_path: Path) -> None:
+    """
+    Test that superseded records are dropped by the background compaction, including writes performed while
+    compacting.
+    """
+
+    path = str(tmp_path / "omemo.log")
+
+    # No fsync is due during the writes, which would yield to the event loop and let the compaction progress
+    storage = LogStorage(
+        path,
+        fsync_policy=FsyncPolicy.BATCH,
+        fsync_batch_size=1000,
+        compaction_min_size=2000,
+        disable_cache=True
+    )
+    for i in range(450):
+        await storage.store(f"/key/{i % 150}", i)
+    await storage.delete("/key/0")
+
+    # The compaction was triggered by the writes above and yields to the event loop in between
+    await asyncio.sleep(0)
+    await storage.store("/key/1", "during compaction")
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+    # Only the record of /key/1 that was superseded during the compaction is left over
+    assert storage.size - storage.live_size == len(b'S "/key/1" 301\n')
+    assert (await storage.load("/key/0")).is_nothing
+    assert (await storage.load("/key/1")).from_just() == "during compaction"
+    assert (await storage.load("/key/149")).from_just() == 449
+    storage.close()
+
+    storage = LogStorage(path, disable_cache=True)
+    assert (await storage.load("/key/1")).from_just() == "during compaction"
+    assert (await storage.load("/key/2")).from_just() == 302
+    assert not (tmp_path / "omemo.log.compact").exists()
+    storage.close()
+
+
+async def test_interval_fsync(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that writes are forced to disk once per interval.
+    """
+
+    synced: List[int] = []
+    monkeypatch.setattr("os.fsync", synced.append)
+
+    storage = LogStorage(str(tmp_path / "omemo.log"), fsync_policy=FsyncPolicy.INTERVAL, fsync_interval=0.01)
+    await storage.store("/a", 1)
+    await storage.store("/b", 2)
+    assert len(synced) == 0
+
+    await asyncio.sleep(0.05)
+    assert len(synced) == 1
+    storage.close()
+
+
+async def test_fsync_executor(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that fsyncs run outside of the event loop thread and that concurrent writes share them.
+    """
+
+    threads: List[int] = []
+
+    def fsync(_fd: int) -> None:
+        threads.append(threading.get_ident())
+        time.sleep(0.02)
+
+    monkeypatch.setattr("os.fsync", fsync)
+
+    storage = LogStorage(str(tmp_path / "omemo.log"))
+    await asyncio.gather(*(storage.store(f"/key/{i}", i) for i in range(10)))
+
+    assert 0 < len(threads) < 10
+    assert threading.get_ident() not in threads
+
+    storage.close()
+
+    storage = LogStorage(str(tmp_path / "omemo.log"), disable_cache=True)
+    assert (await storage.load("/key/9")).from_just() == 9
+    storage.close()
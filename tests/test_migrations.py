@@ -0,0 +1,162 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from omemo.types import JSONType
+import pytest
+
+from slixmpp_omemo.log_storage import LogStorage
+from slixmpp_omemo.migrations import (
+    MigrationFailed,
+    MigrationProgress,
+    dump,
+    iterate_dump,
+    iterate_json_file,
+    iterate_storage,
+    migrate
+)
+from slixmpp_omemo.mmap_storage import MmapStorage
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_damaged_dump",
+    "test_dump_restore",
+    "test_file_backend_keys",
+    "test_iterate_json_file",
+    "test_migrate"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+DATA: Dict[str, JSONType] = {
+    "/devices/bob@example.org/list": {
+        "1": [ "urn:xmpp:omemo:2" ],
+        "2": [ "eu.siacs.conversations.axolotl" ]
+    },
+    "/devices/bob@example.org/1/label": "Phöne \"work\"",
+    "/urn:xmpp:omemo:2/bob@example.org/1/double_ratchet": { "state": "x" * 300, "counter": 12345 },
+    "/trust/bob@example.org/aWs=": "trusted",
+    "/own_device_id": 1234567890,
+    "/empty": {},
+    "/nested": [ [], [ 1.5, -2e10, True, False, None ] ]
+}
+
+
+async def test_iterate_json_file(tmp_path: Path) -> None:
+    """
+    Test that a JSON object is read completely, even if values span many chunks.
+    """
+
+    path = tmp_path / "omemo.json"
+    path.write_text(json.dumps(DATA, indent=4), encoding="utf-8")
+
+    entries = [ entry async for entry in iterate_json_file(str(path), chunk_size=3) ]
+    assert dict(entries) == DATA
+    assert [ key for key, _ in entries ] == list(DATA)
+
+    path.write_text(" { } ", encoding="utf-8")
+    assert [ entry async for entry in iterate_json_file(str(path)) ] == []
+
+    path.write_text(json.dumps(DATA)[:-5], encoding="utf-8")
+    with pytest.raises(ValueError):
+        async for _ in iterate_json_file(str(path), chunk_size=7):
+            pass
+
+
+async def test_migrate(tmp_path: Path) -> None:
+    """
+    Test that entries are copied in batches, verified and reported.
+    """
+
+    path = tmp_path / "omemo.json"
+    path.write_text(json.dumps(DATA), encoding="utf-8")
+
+    target = MemoryStorage()
+    reports: List[MigrationProgress] = []
+    result = await migrate(iterate_json_file(str(path)), target, batch_size=3, progress=reports.append)
+
+    assert target.data == DATA
+    assert result.keys == len(DATA)
+    assert [ report.keys for report in reports ] == [ 3, 6, 7 ]
+
+    class LossyStorage(MemoryStorage):
+        """
+        Storage that drops every write.
+        """
+
+        async def _store(self, key: str, value: JSONType) -> None:
+            pass
+
+    with pytest.raises(MigrationFailed):
+        await migrate(iterate_json_file(str(path)), LossyStorage())
+
+    unverified = await migrate(iterate_json_file(str(path)), LossyStorage(), verify=False)
+    assert unverified == result
+
+
+async def test_dump_restore(tmp_path: Path) -> None:
+    """
+    Test that a dump restores the same entries with the same checksum.
+    """
+
+    source = MemoryStorage()
+    source.data.update(DATA)
+
+    path = str(tmp_path / "omemo.dump")
+    dumped = await dump(iterate_storage(source, [ *DATA, "/missing" ]), path)
+    assert dumped.keys == len(DATA)
+
+    target = MemoryStorage()
+    restored = await migrate(iterate_dump(path), target)
+    assert restored == dumped
+    assert target.data == DATA
+
+
+async def test_damaged_dump(tmp_path: Path) -> None:
+    """
+    Test that truncated or modified dumps are rejected.
+    """
+
+    source = MemoryStorage()
+    source.data.update(DATA)
+
+    path = tmp_path / "omemo.dump"
+    await dump(iterate_storage(source, DATA), str(path))
+    lines = path.read_text(encoding="utf-8").splitlines(keepends=True)
+
+    path.write_text("".join(lines[:-1]), encoding="utf-8")
+    with pytest.raises(MigrationFailed):
+        await migrate(iterate_dump(str(path)), MemoryStorage())
+
+    path.write_text("".join(lines).replace("trusted", "untrusted"), encoding="utf-8")
+    with pytest.raises(MigrationFailed):
+        await migrate(iterate_dump(str(path)), MemoryStorage())
+
+    path.write_text("".join(lines + lines[:1]), encoding="utf-8")
+    with pytest.raises(MigrationFailed):
+        await migrate(iterate_dump(str(path)), MemoryStorage())
+
+
+async def test_file_backend_keys(tmp_path: Path) -> None:
+    """
+    Test migrating from the log-structured storage to the memory-mapped storage using their keys.
+    """
+
+    log = LogStorage(str(tmp_path / "omemo.log"))
+    for key, value in DATA.items():
+        await log.store(key, value)
+    await log.store("/deleted", "value")
+    await log.delete("/deleted")
+    assert sorted(log.keys()) == sorted(DATA)
+
+    mmap = MmapStorage(str(tmp_path / "omemo.mmap"))
+    await migrate(iterate_storage(log, log.keys()), mmap)
+    log.close()
+
+    assert sorted(mmap.keys()) == sorted(DATA)
+    assert { key: (await mmap.load(key)).from_just() for key in mmap.keys() } == DATA
+    mmap.close()
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pytest
+
+from slixmpp_omemo.mmap_storage import MmapStorage, TieredStorage
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_persistence",
+    "test_rebuild",
+    "test_tiered"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_persistence(tmp_path: Path) -> None:
+    """
+    Test that stores, overwrites and deletes are visible after reopening the file.
+    """
+
+    path = str(tmp_path / "public.mmap")
+
+    storage = MmapStorage(path)
+    await storage.store("/devices/bob@example.org/list", { "1": [ "urn:xmpp:omemo:2" ] })
+    await storage.store("/devices/bob@example.org/1/label", None)
+    await storage.store("/devices/bob@example.org/1/label", "Phöne")
+    await storage.store("/devices/bob@example.org/2/label", "Laptop")
+    await storage.delete("/devices/bob@example.org/2/label")
+    await storage.delete("/devices/bob@example.org/3/label")
+    assert storage.live_keys == 2
+    storage.close()
+
+    storage = MmapStorage(path)
+    assert (await storage.load("/devices/bob@example.org/list")).from_just() \
+        == { "1": [ "urn:xmpp:omemo:2" ] }
+    assert (await storage.load("/devices/bob@example.org/1/label")).from_just() == "Phöne"
+    assert (await storage.load("/devices/bob@example.org/2/label")).is_nothing
+    assert storage.live_keys == 2
+
+    await storage.store("/devices/bob@example.org/2/label", "Tablet")
+    assert (await storage.load("/devices/bob@example.org/2/label")).from_just() == "Tablet"
+    storage.close()
+
+
+async def test_rebuild(tmp_path: Path) -> None:
+    """
+    Test that the index grows and superseded records are dropped.
+    """
+
+    path = str(tmp_path / "public.mmap")
+
+    storage = MmapStorage(path, initial_buckets=4, compaction_min_size=0)
+    for i in range(100):
+        await storage.store(f"/devices/contact{i}@example.org/list", { str(i): [ "urn:xmpp:omemo:2" ] })
+    for i in range(0, 100, 2):
+        await storage.delete(f"/devices/contact{i}@example.org/list")
+    for _ in range(3):
+        await storage.store(
+            "/devices/contact1@example.org/list",
+            { "1": [ "eu.siacs.conversations.axolotl" ] }
+        )
+    assert storage.live_keys == 50
+
+    storage.close()
+    storage = MmapStorage(path)
+
+    assert storage.live_keys == 50
+    assert (await storage.load("/devices/contact0@example.org/list")).is_nothing
+    assert (await storage.load("/devices/contact1@example.org/list")).from_just() \
+        == { "1": [ "eu.siacs.conversations.axolotl" ] }
+    assert (await storage.load("/devices/contact99@example.org/list")).from_just() \
+        == { "99": [ "urn:xmpp:omemo:2" ] }
+    assert not (tmp_path / "public.mmap.build").exists()
+    storage.close()
+
+
+async def test_tiered(tmp_path: Path) -> None:
+    """
+    Test that public keys are routed to the public storage and moved there on first load.
+    """
+
+    primary = MemoryStorage()
+    primary.data["/devices/bob@example.org/list"] = { "1": None }
+    primary.data["/devices/bob@example.org/2/label"] = "Stale"
+    public = MmapStorage(str(tmp_path / "public.mmap"))
+    storage = TieredStorage(primary, public)
+
+    await storage.store("/trust/bob@example.org/aWs=", "trusted")
+    await storage.store("/devices/carol@example.org/list", { "5": None })
+    assert (await public.load("/devices/carol@example.org/list")).from_just() == { "5": None }
+    assert (await public.load("/trust/bob@example.org/aWs=")).is_nothing
+    assert primary.data["/trust/bob@example.org/aWs="] == "trusted"
+
+    assert (await storage.load("/devices/bob@example.org/list")).from_just() == { "1": None }
+    assert "/devices/bob@example.org/list" not in primary.data
+    assert (await public.load("/devices/bob@example.org/list")).from_just() == { "1": None }
+
+    await storage.delete("/devices/bob@example.org/2/label")
+    assert (await storage.load("/devices/bob@example.org/2/label")).is_nothing
+    public.close()
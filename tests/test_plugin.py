@@ -1,19 +1,365 @@
+import asyncio
+from copy import copy
+import time
+from typing import FrozenSet, Tuple
+from xml.etree import ElementTree as ET
+
+from omemo.session_manager import BundleDownloadFailed
+import oldmemo
 import pytest
+import twomemo
+
+from slixmpp.jid import JID
+from slixmpp.stanza import Message
 
 import slixmpp_omemo
+from slixmpp_omemo.xep_0384 import (
+    EncryptedElements,
+    OLDMEMO_DEVICE_LIST_NODE,
+    SUBSCRIPTION_INDEX_KEY,
+    TWOMEMO_DEVICE_LIST_NODE,
+    _make_encrypted_stanza
+)
+
+from .loopback import LoopbackClient, LoopbackServer
 
 
 __all__ = [
-    "test_placeholder"
+    "connect",
+    "key_recipients",
+    "test_encrypted_stanza",
+    "test_circuit_open_subscription",
+    "test_expired_deadline",
+    "test_inactive_devices",
+    "test_is_encrypted_after_mutation",
+    "test_placeholder",
+    "test_reconcile_subscriptions",
+    "test_subscription_reconciliation_rate"
 ]
 
 
 pytestmark = pytest.mark.asyncio
 
 
+NAMESPACES = [ twomemo.twomemo.NAMESPACE, oldmemo.oldmemo.NAMESPACE ]
+
+
 async def test_placeholder() -> None:
     """
     Placeholder test.
     """
 
     print(slixmpp_omemo.version)
+
+
+async def connect(server: LoopbackServer, *bare_jids: str) -> Tuple[LoopbackClient, ...]:
+    """
+    Args:
+        server: The loopback server.
+        bare_jids: The bare JIDs of the clients.
+
+    Returns:
+        Connected clients with their OMEMO identities published.
+    """
+
+    clients = tuple(LoopbackClient(f"{bare_jid}/test", server) for bare_jid in bare_jids)
+    for client in clients:
+        client.connect()
+        await client.omemo.get_session_manager()
+
+    return clients
+
+
+async def test_reconcile_subscriptions() -> None:
+    """
+    Test that the reconciliation builds the subscription index, removes manual subscriptions covered by PEP,
+    restores those of roster contacts without PEP, drops unsubscribed JIDs from the index and doesn't write
+    anything if there is nothing to reconcile.
+    """
+
+    server = LoopbackServer()
+    client = LoopbackClient("alice@example.org/test", server)
+    plugin = client.omemo
+    storage = plugin.memory_storage
+
+    # Subscriptions recorded before the index existed: bob has mutual presence subscription by now, carol's
+    # manual subscriptions were removed earlier while PEP was enabled, but PEP doesn't work anymore.
+    for namespace in NAMESPACES:
+        await storage.store(f"/slixmpp/subscribed/bob@example.org/{namespace}", True)
+        await storage.store(f"/slixmpp/subscribed/carol@example.org/{namespace}", False)
+
+    # Dave was only recorded with a cached device list
+    await storage.store(f"/{twomemo.twomemo.NAMESPACE}/bare_jids", [ "dave@example.org" ])
+    await storage.store(f"/slixmpp/subscribed/dave@example.org/{twomemo.twomemo.NAMESPACE}", True)
+
+    client.client_roster.add("bob@example.org", afrom=True, ato=True)
+    client.client_roster.add("carol@example.org", ato=True)
+
+    await plugin.reconcile_subscriptions()
+
+    assert sorted(server.requests) == sorted([
+        ("alice@example.org", "unsubscribe", "bob@example.org", TWOMEMO_DEVICE_LIST_NODE),
+        ("alice@example.org", "unsubscribe", "bob@example.org", OLDMEMO_DEVICE_LIST_NODE),
+        ("alice@example.org", "subscribe", "carol@example.org", TWOMEMO_DEVICE_LIST_NODE),
+        ("alice@example.org", "subscribe", "carol@example.org", OLDMEMO_DEVICE_LIST_NODE)
+    ])
+
+    indexed = [
+        bare_jid
+        for key, value in storage.data.items()
+        if key.startswith(f"{SUBSCRIPTION_INDEX_KEY}/") and isinstance(value, list)
+        for bare_jid in value
+        if isinstance(bare_jid, str)
+    ]
+    assert sorted(indexed) == [ "carol@example.org", "dave@example.org" ]
+    for namespace in NAMESPACES:
+        assert storage.data[f"/slixmpp/subscribed/bob@example.org/{namespace}"] is False
+        assert storage.data[f"/slixmpp/subscribed/carol@example.org/{namespace}"] is True
+
+    # Nothing left to reconcile
+    server.requests.clear()
+    writes = storage.writes
+    await plugin.reconcile_subscriptions()
+    assert len(server.requests) == 0
+    assert storage.writes == writes
+
+    # Bob loses mutual presence subscription, carol gains it
+    client.client_roster["bob@example.org"]["from"] = False
+    client.client_roster["carol@example.org"]["from"] = True
+
+    await plugin.reconcile_subscriptions()
+    assert sorted(request[1:3] for request in server.requests) == [
+        ("subscribe", "bob@example.org"),
+        ("subscribe", "bob@example.org"),
+        ("unsubscribe", "carol@example.org"),
+        ("unsubscribe", "carol@example.org")
+    ]
+
+
+async def test_subscription_reconciliation_rate() -> None:
+    """
+    Test that a reconciliation rate other than a positive number is rejected.
+    """
+
+    with pytest.raises(ValueError):
+        LoopbackClient("alice@example.org/test", LoopbackServer(), { "subscription_reconciliation_rate": 0 })
+
+
+async def test_encrypted_stanza() -> None:
+    """
+    Test that the outgoing stanza of an encrypted message is identical to the stanza built by copying the
+    source stanza, clearing it and filling it again, as was done before.
+    """
+
+    client = LoopbackClient("alice@example.org/test", LoopbackServer())
+
+    stanza = client.make_message(mto=JID("bob@example.org"), mbody="Hello", mtype="chat")
+    stanza["id"] = "message-id"
+    stanza["lang"] = "en"
+    stanza.xml.set("{urn:example:attributes}custom", "value")
+    stanza.xml.append(ET.Element("{http://jabber.org/protocol/chatstates}active"))
+    stanza.xml.append(ET.Element("{urn:example:extension}extension", { "key": "value" }))
+
+    message_elt = ET.Element("{eu.siacs.conversations.axolotl}encrypted")
+    ET.SubElement(message_elt, "{eu.siacs.conversations.axolotl}payload").text = "cGF5bG9hZA=="
+
+    expected = copy(stanza)
+    expected.clear()
+    expected.append(copy(message_elt))
+    expected["body"] = client.omemo.fallback_message
+    expected.enable("store")
+
+    encrypted = _make_encrypted_stanza(stanza, copy(message_elt), client.omemo.fallback_message)
+
+    assert encrypted.__class__ is expected.__class__
+    assert encrypted.stream is client
+    assert encrypted.stream is expected.stream
+    assert str(encrypted) == str(expected)
+    assert ET.tostring(encrypted.xml) == ET.tostring(expected.xml)
+    assert dict(encrypted.xml.attrib) == dict(expected.xml.attrib) == dict(stanza.xml.attrib)
+    assert encrypted.xml.get("{urn:example:attributes}custom") == "value"
+    assert encrypted["lang"] == "en"
+    assert encrypted["body"] == expected["body"] == client.omemo.fallback_message
+    assert encrypted.get_plugin("store", check=True) is not None
+    assert [ child.tag for child in encrypted.xml ] == [
+        "{eu.siacs.conversations.axolotl}encrypted",
+        "{jabber:client}body",
+        "{urn:xmpp:hints}store"
+    ]
+
+    # The source stanza is left as-is
+    assert isinstance(encrypted, Message)
+    assert stanza["body"] == "Hello"
+    assert len(stanza.xml) == 3
+
+
+async def test_is_encrypted_after_mutation() -> None:
+    """
+    Test that the encrypted elements are looked up on the current state of a stanza, including after its
+    encrypted element was swapped for another one without changing the number of children.
+    """
+
+    client = LoopbackClient("alice@example.org/test", LoopbackServer())
+    plugin = client.omemo
+
+    stanza = client.make_message(mto=JID("bob@example.org"), mbody="Hello", mtype="chat")
+    assert plugin.is_encrypted(stanza) is None
+
+    oldmemo_elt = ET.Element(f"{{{oldmemo.oldmemo.NAMESPACE}}}encrypted")
+    stanza.xml.append(oldmemo_elt)
+    assert plugin.is_encrypted(stanza) == oldmemo.oldmemo.NAMESPACE
+    assert plugin.find_encrypted_elements(stanza) == ((oldmemo.oldmemo.NAMESPACE, oldmemo_elt),)
+
+    stanza.xml.remove(oldmemo_elt)
+    stanza.xml.append(ET.Element(f"{{{twomemo.twomemo.NAMESPACE}}}encrypted"))
+    assert plugin.is_encrypted(stanza) == twomemo.twomemo.NAMESPACE
+
+    stanza.xml.clear()
+    assert plugin.is_encrypted(stanza) is None
+
+
+def key_recipients(message: Message) -> FrozenSet[int]:
+    """
+    Args:
+        message: An oldmemo-encrypted message stanza.
+
+    Returns:
+        The ids of the devices the message is encrypted for.
+    """
+
+    return frozenset(
+        int(key_elt.get("rid", ""))
+        for key_elt
+        in message.xml.iter(f"{{{oldmemo.oldmemo.NAMESPACE}}}key")
+    )
+
+
+async def test_inactive_devices() -> None:
+    """
+    Test that inactive devices are left out of the encryption, except for the devices of the own account, that
+    encrypting for a device does not count as its activity, and that decrypting a message from it does.
+    """
+
+    server = LoopbackServer()
+    alice = LoopbackClient("alice@example.org/one", server, { "inactive_device_max_age": 100 })
+    clients = [
+        LoopbackClient("alice@example.org/two", server),
+        LoopbackClient("bob@example.org/one", server),
+        LoopbackClient("bob@example.org/two", server),
+        alice
+    ]
+
+    # Alice connects last to learn about her other device from her own device list
+    device_ids = []
+    for client in clients:
+        client.connect()
+        device, _ = await (await client.omemo.get_session_manager()).get_own_device_information()
+        device_ids.append(device.device_id)
+    alice_other = device_ids[0]
+    bob_inactive = device_ids[1]
+    bob_active = device_ids[2]
+
+    storage = alice.omemo.memory_storage
+    bob_activity = { str(bob_inactive): 0.0, str(bob_active): time.time() - 50 }
+    await storage.store("/slixmpp/device_activity/alice@example.org", { str(alice_other): 0.0 })
+    await storage.store("/slixmpp/device_activity/bob@example.org", bob_activity)
+
+    stanza = alice.make_message(mto=JID("bob@example.org"), mbody="Hello", mtype="chat")
+    messages, _ = await alice.omemo.encrypt_message(stanza, JID("bob@example.org"))
+    assert key_recipients(messages[oldmemo.oldmemo.NAMESPACE]) == { alice_other, bob_active }
+    assert alice.omemo.stats["inactive_devices_skipped"] == 1
+
+    # The key exchange initiated by alice is not activity of the devices of bob
+    assert storage.data["/slixmpp/device_activity/bob@example.org"] == bob_activity
+
+    # The inactive device sends a message, which makes it active again once decrypted
+    bob = clients[1]
+    stanza = bob.make_message(mto=JID("alice@example.org"), mbody="Hi", mtype="chat")
+    messages, _ = await bob.omemo.encrypt_message(stanza, JID("alice@example.org"))
+    messages[oldmemo.oldmemo.NAMESPACE].send()
+
+    async def receive() -> Tuple[Message, EncryptedElements]:
+        while True:
+            for received in alice.received:
+                encrypted_elements = alice.omemo.find_encrypted_elements(received)
+                if len(encrypted_elements) > 0:
+                    return received, encrypted_elements
+            await asyncio.sleep(0.01)
+
+    message, device = await alice.omemo.decrypt_message(*await asyncio.wait_for(receive(), 30))
+    assert message["body"] == "Hi"
+    assert device.device_id == bob_inactive
+
+    stanza = alice.make_message(mto=JID("bob@example.org"), mbody="Hello again", mtype="chat")
+    messages, _ = await alice.omemo.encrypt_message(stanza, JID("bob@example.org"))
+    assert key_recipients(messages[oldmemo.oldmemo.NAMESPACE]) == { alice_other, bob_inactive, bob_active }
+
+    for client in clients:
+        client.disconnect()
+
+
+async def test_expired_deadline() -> None:
+    """
+    Test that an encryption whose deadline expired before the pubsub requests were sent reports the devices
+    whose bundle downloads were skipped instead of failing.
+    """
+
+    server = LoopbackServer()
+    alice, bob = await connect(server, "alice@example.org", "bob@example.org")
+
+    bob_device, _ = await (await bob.omemo.get_session_manager()).get_own_device_information()
+
+    # The device list is cached, the bundle is not
+    await alice.omemo.refresh_device_lists({ JID("bob@example.org") })
+
+    stanza = alice.make_message(mto=JID("bob@example.org"), mbody="Hello", mtype="chat")
+    messages, errors = await alice.omemo.encrypt_message(stanza, JID("bob@example.org"), timeout=0)
+
+    assert len(messages) == 0
+    assert { (error.bare_jid, error.device_id) for error in errors } == {
+        ("bob@example.org", bob_device.device_id)
+    }
+    assert all(isinstance(error.exception, BundleDownloadFailed) for error in errors)
+    assert alice.omemo.stats["deadline_skipped_devices"] == 1
+
+    for client in [ alice, bob ]:
+        client.disconnect()
+
+
+async def test_circuit_open_subscription() -> None:
+    """
+    Test that encrypting for a JID of an unhealthy domain doesn't attempt the manual device list subscriptions
+    and continues with the cached device lists and sessions.
+    """
+
+    server = LoopbackServer()
+    alice, bob = await connect(server, "alice@example.org", "bob@remote.example")
+
+    bob_device, _ = await (await bob.omemo.get_session_manager()).get_own_device_information()
+
+    stanza = alice.make_message(mto=JID("bob@remote.example"), mbody="Hello", mtype="chat")
+    await alice.omemo.encrypt_message(stanza, JID("bob@remote.example"))
+
+    # The manual subscriptions are lost, e.g. because they were removed while PEP was enabled
+    storage = alice.omemo.memory_storage
+    for namespace in NAMESPACES:
+        await storage.store(f"/slixmpp/subscribed/bob@remote.example/{namespace}", False)
+
+    circuit_breaker = getattr(alice.omemo, "_XEP_0384__get_circuit_breaker")()
+    for _ in range(alice.omemo.pubsub_failure_threshold):
+        circuit_breaker.record_failure("remote.example")
+
+    server.requests.clear()
+
+    stanza = alice.make_message(mto=JID("bob@remote.example"), mbody="Hello again", mtype="chat")
+    messages, _ = await alice.omemo.encrypt_message(stanza, JID("bob@remote.example"))
+
+    assert bob_device.device_id in key_recipients(messages[oldmemo.oldmemo.NAMESPACE])
+    assert not any(request[1] == "subscribe" for request in server.requests)
+    # The subscriptions and the device list downloads that follow them are refused
+    assert alice.omemo.stats["pubsub_requests_refused"] == 2 * len(NAMESPACES)
+    for namespace in NAMESPACES:
+        assert storage.data[f"/slixmpp/subscribed/bob@remote.example/{namespace}"] is False
+
+    for client in [ alice, bob ]:
+        client.disconnect()
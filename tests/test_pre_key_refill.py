@@ -0,0 +1,84 @@
+import asyncio
+from typing import List
+
+import omemo
+import pytest
+import twomemo
+
+from slixmpp_omemo.pre_key_refill import PreKeyRefill
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_failure",
+    "test_refill"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_refill() -> None:
+    """
+    Test that requests are coalesced into a single refill and bundle upload after the delay.
+    """
+
+    backend = twomemo.Twomemo(MemoryStorage())
+    await backend.generate_pre_keys(60)
+
+    uploaded: List[omemo.Bundle] = []
+
+    async def upload_bundle(bundle: omemo.Bundle) -> None:
+        uploaded.append(bundle)
+
+    pre_key_refill = PreKeyRefill([ backend ], "alice@example.org", 1, upload_bundle, delay=0.05)
+
+    pre_key_refill.request(twomemo.twomemo.NAMESPACE)
+    pre_key_refill.request(twomemo.twomemo.NAMESPACE)
+    assert pre_key_refill.pending == frozenset({ twomemo.twomemo.NAMESPACE })
+    assert len(uploaded) == 0
+
+    await asyncio.sleep(0.2)
+
+    assert pre_key_refill.pending == frozenset()
+    assert await backend.get_num_visible_pre_keys() == 100
+    assert len(uploaded) == 1
+    assert isinstance(uploaded[0], twomemo.twomemo.BundleImpl)
+    assert len(uploaded[0].pre_key_ids) == 100
+    assert pre_key_refill.stats == {
+        "bundle_uploads_deferred": 2,
+        "pre_key_refills": 1,
+        "pre_keys_generated": 40
+    }
+
+    # Nothing to generate, the bundle is published anyway since consumed pre keys have to be removed from it
+    pre_key_refill.request(twomemo.twomemo.NAMESPACE)
+    await pre_key_refill.run_pending()
+    assert len(uploaded) == 2
+    assert pre_key_refill.stats["pre_keys_generated"] == 40
+
+    pre_key_refill.close()
+
+
+async def test_failure() -> None:
+    """
+    Test that failed uploads are counted and don't stop later refills.
+    """
+
+    backend = twomemo.Twomemo(MemoryStorage())
+
+    async def upload_bundle(bundle: omemo.Bundle) -> None:
+        raise omemo.BundleUploadFailed(f"Bundle upload failed: {bundle}")
+
+    pre_key_refill = PreKeyRefill([ backend ], "alice@example.org", 1, upload_bundle, delay=0)
+
+    pre_key_refill.request(twomemo.twomemo.NAMESPACE)
+    pre_key_refill.request("urn:example:unknown")
+    await pre_key_refill.run_pending()
+
+    assert pre_key_refill.stats["pre_key_refill_failures"] == 1
+    assert "pre_key_refills" not in pre_key_refill.stats
+    assert await backend.get_num_visible_pre_keys() == 100
+
+    pre_key_refill.close()
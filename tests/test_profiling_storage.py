@@ -0,0 +1,72 @@
+import logging
+
+import pytest
+
+from slixmpp_omemo.profiling_storage import ProfilingStorage, key_prefix
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_key_prefix",
+    "test_periodic_report",
+    "test_stats"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_key_prefix() -> None:
+    """
+    Test the grouping of the keys used by the library and the plugin.
+    """
+
+    assert key_prefix("/urn:xmpp:omemo:2/bob@example.org/123/double_ratchet") \
+        == "/urn:xmpp:omemo:2/*/*/double_ratchet"
+    assert key_prefix("/devices/bob@example.org/list") == "/devices/*/list"
+    assert key_prefix("/trust/bob@example.org/aWs=") == "/trust/*/*"
+    assert key_prefix("/slixmpp/subscribed/bob@example.org/urn:xmpp:omemo:2") \
+        == "/slixmpp/subscribed/*/urn:xmpp:omemo:2"
+    assert key_prefix("/slixmpp/deferred_delivery/0123abcd") == "/slixmpp/deferred_delivery/*"
+    assert key_prefix("/slixmpp/deferred_delivery/list") == "/slixmpp/deferred_delivery/list"
+    assert key_prefix("/own_device_id") == "/own_device_id"
+
+
+async def test_stats() -> None:
+    """
+    Test that operations are forwarded to the wrapped storage and recorded per operation and prefix.
+    """
+
+    wrapped = MemoryStorage()
+    storage = ProfilingStorage(wrapped)
+
+    await storage.store("/devices/alice@example.org/list", { "1": "twomemo" })
+    await storage.store("/devices/bob@example.org/list", { "2": "twomemo" })
+    assert (await storage.load("/devices/alice@example.org/list")).from_just() == { "1": "twomemo" }
+    assert (await storage.load("/devices/alice@example.org/list")).from_just() == { "1": "twomemo" }
+    await storage.delete("/devices/bob@example.org/list")
+    assert (await wrapped.load("/devices/bob@example.org/list")).is_nothing
+
+    stats = storage.stats
+    assert stats[("store", "/devices/*/list")].calls == 2
+    assert stats[("store", "/devices/*/list")].total_size == 2 * len('{"1": "twomemo"}')
+    assert stats[("load", "/devices/*/list")].calls == 2
+    assert stats[("delete", "/devices/*/list")].calls == 1
+    assert "load /devices/*/list: 2 ops" in storage.report()
+
+    storage.reset()
+    assert len(storage.stats) == 0
+
+
+async def test_periodic_report(caplog: pytest.LogCaptureFixture) -> None:
+    """
+    Test that reports are logged once the interval passed.
+    """
+
+    storage = ProfilingStorage(MemoryStorage(), report_interval=0)
+
+    with caplog.at_level(logging.INFO, logger="slixmpp_omemo.profiling_storage"):
+        await storage.store("/own_device_id", 123)
+
+    assert "store /own_device_id: 1 ops" in caplog.text
@@ -0,0 +1,67 @@
+from typing import List
+from xml.etree import ElementTree as ET
+
+from omemo.identity_key_pair import IdentityKeyPair
+import pytest
+import twomemo
+import twomemo.etree
+
+from slixmpp_omemo.provisioning import ProvisionedIdentity, provision
+from slixmpp_omemo.session_manager_pool import SessionManagerPool
+from slixmpp_omemo.xep_0384 import OLDMEMO_DEVICE_LIST_NODE, TWOMEMO_DEVICE_LIST_NODE
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "test_provision"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_provision() -> None:
+    """
+    Test that identities are generated in worker processes and written to the storages of the accounts, that
+    the publish items match the written identities, and that provisioned accounts are skipped.
+    """
+
+    storage = MemoryStorage()
+    pool = SessionManagerPool(storage)
+    bare_jids = [ f"user{i}@example.org" for i in range(3) ]
+
+    identities: List[ProvisionedIdentity] = []
+    async for identity in provision(bare_jids, pool.storage_for, processes=2):
+        identities.append(identity)
+
+    assert sorted(identity.bare_jid for identity in identities) == bare_jids
+
+    for identity in identities:
+        account_storage = pool.storage_for(identity.bare_jid)
+        assert (await account_storage.load_primitive("/own_device_id", int)).from_just() == identity.device_id
+        assert all(f"/{identity.bare_jid}{key}" in storage.data for key, _ in identity.entries)
+
+        assert { item.node for item in identity.items } == {
+            "urn:xmpp:omemo:2:bundles",
+            f"eu.siacs.conversations.axolotl.bundles:{identity.device_id}",
+            TWOMEMO_DEVICE_LIST_NODE,
+            OLDMEMO_DEVICE_LIST_NODE
+        }
+
+        items = { item.node: item for item in identity.items }
+        bundle = twomemo.etree.parse_bundle(
+            ET.fromstring(items["urn:xmpp:omemo:2:bundles"].item),
+            identity.bare_jid,
+            identity.device_id
+        )
+        identity_key_pair = await IdentityKeyPair.get(account_storage)
+        assert bundle.identity_key == identity_key_pair.identity_key
+
+        device_list = twomemo.etree.parse_device_list(ET.fromstring(items[TWOMEMO_DEVICE_LIST_NODE].item))
+        assert device_list == { identity.device_id: None }
+
+    data = dict(storage.data)
+    async for identity in provision(bare_jids, pool.storage_for, processes=2):
+        assert False, f"Provisioned again: {identity.bare_jid}"
+    assert storage.data == data
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from slixmpp_omemo.sealing import Sealer
+
+
+__all__ = [
+    "test_encryption",
+    "test_plain"
+]
+
+
+def test_plain() -> None:
+    """
+    Test that values are sealed as-is without a key.
+    """
+
+    sealer = Sealer()
+
+    assert sealer.seal({ "a": [ 1, None ] }, "key") == { "a": [ 1, None ] }
+    assert sealer.unseal({ "a": [ 1, None ] }, "key") == { "a": [ 1, None ] }
+
+
+def test_encryption() -> None:
+    """
+    Test that sealed values are encrypted, and can only be unsealed using the same key and associated data.
+    """
+
+    key = os.urandom(32)
+    sealer = Sealer(key)
+
+    sealed = sealer.seal({ "secret": "value" }, "key")
+    assert isinstance(sealed, str)
+    assert "value" not in sealed
+
+    assert Sealer(key).unseal(sealed, "key") == { "secret": "value" }
+
+    with pytest.raises(Exception):
+        sealer.unseal(sealed, "other key")
+
+    with pytest.raises(Exception):
+        Sealer(os.urandom(32)).unseal(sealed, "key")
+
+    with pytest.raises(ValueError):
+        Sealer(b"short")
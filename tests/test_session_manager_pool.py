@@ -0,0 +1,123 @@
+import asyncio
+import time
+from typing import Dict, List
+
+import pytest
+
+from slixmpp_omemo.circuit_breaker import CircuitBreaker
+from slixmpp_omemo.session_manager_pool import SessionManagerPool
+
+from .memory_storage import MemoryStorage
+
+
+__all__ = [
+    "Account",
+    "test_initialization_staggering",
+    "test_shared_storage",
+    "test_stats"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class Account:
+    """
+    Stand-in for a plugin instance registered with the pool.
+    """
+
+    def __init__(self, stats: Dict[str, int]) -> None:
+        self.stats = stats
+
+
+async def test_initialization_staggering() -> None:
+    """
+    Test that initializations are limited in concurrency and start apart by the configured interval, and that
+    failures are forwarded.
+    """
+
+    pool = SessionManagerPool(max_concurrent_initializations=2, initialization_interval=0.02)
+
+    running = 0
+    max_running = 0
+    starts: List[float] = []
+
+    async def initialization() -> int:
+        nonlocal running, max_running
+
+        starts.append(time.monotonic())
+        index = len(starts)
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+        return index
+
+    results = await asyncio.gather(*(pool.initialize(initialization) for _ in range(5)))
+
+    assert sorted(results) == [ 1, 2, 3, 4, 5 ]
+    assert max_running == 2
+    assert all(b - a >= 0.015 for a, b in zip(starts, starts[1:]))
+
+    async def failing_initialization() -> int:
+        raise ValueError("Initialization failed.")
+
+    with pytest.raises(ValueError):
+        await pool.initialize(failing_initialization)
+
+    assert pool.stats["pool_initializations"] == 5
+    assert pool.stats["pool_initializations_failed"] == 1
+    assert "pool_initializations_running" not in pool.stats
+
+
+async def test_shared_storage() -> None:
+    """
+    Test that accounts get separate views of the shared storage.
+    """
+
+    storage = MemoryStorage()
+    pool = SessionManagerPool(storage)
+
+    alice = pool.storage_for("alice@example.org")
+    bob = pool.storage_for("bob@example.org")
+    assert pool.storage_for("alice@example.org") is alice
+
+    await alice.store("/own_device_id", 1)
+    await bob.store("/own_device_id", 2)
+    assert (await alice.load_primitive("/own_device_id", int)).from_just() == 1
+    assert storage.data == { "/alice@example.org/own_device_id": 1, "/bob@example.org/own_device_id": 2 }
+
+    await bob.delete("/own_device_id")
+    assert (await bob.load("/own_device_id")).is_nothing
+
+    with pytest.raises(ValueError):
+        SessionManagerPool().storage_for("alice@example.org")
+
+
+async def test_stats() -> None:
+    """
+    Test that the stats of the accounts are summed up and the shared health tracking is reported once.
+    """
+
+    circuit_breaker = CircuitBreaker(1, 60, 600)
+    pool = SessionManagerPool(circuit_breaker=circuit_breaker)
+
+    alice = Account({ "messages_encrypted": 2, "pubsub_timeouts": 1 })
+    bob = Account({ "messages_encrypted": 3 })
+    pool.register(alice)
+    pool.register(bob)
+    assert pool.accounts == 2
+
+    assert circuit_breaker.allow("example.org")
+    circuit_breaker.record_failure("example.org")
+
+    assert pool.stats == {
+        "messages_encrypted": 5,
+        "pubsub_timeouts": 1,
+        "pubsub_open_circuits": 1,
+        "pool_accounts": 2
+    }
+
+    pool.unregister(bob)
+    assert pool.stats["messages_encrypted"] == 2
@@ -0,0 +1,105 @@
+import asyncio
+from typing import Dict, List
+
+from omemo.storage import Just, Maybe, Nothing, Storage
+from omemo.types import JSONType
+import pytest
+
+from slixmpp_omemo.sharded_storage import ShardedStorage, shard_key
+
+
+__all__ = [
+    "SlowStorage",
+    "test_concurrency",
+    "test_routing"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class SlowStorage(Storage):
+    """
+    Storage implementation that keeps all data in a dictionary, takes a while for every write and records the
+    maximum number of concurrent operations.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(True)
+
+        self.data: Dict[str, JSONType] = {}
+        self.active = 0
+        self.max_active = 0
+        self.flushes = 0
+
+    async def _load(self, key: str) -> Maybe[JSONType]:
+        return Just(self.data[key]) if key in self.data else Nothing()
+
+    async def _store(self, key: str, value: JSONType) -> None:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.data[key] = value
+        self.active -= 1
+
+    async def _delete(self, key: str) -> None:
+        self.data.pop(key, None)
+
+
+async def test_routing() -> None:
+    """
+    Test that all keys of a contact end up in the same shard.
+    """
+
+    assert shard_key("/urn:xmpp:omemo:2/bob@example.org/1/double_ratchet") == "bob@example.org"
+    assert shard_key("/trust/bob@example.org/aWs=") == "bob@example.org"
+    assert shard_key("/own_device_id") == "/own_device_id"
+
+    # Domain-only bare JIDs and keys prefixed by a session manager pool
+    assert shard_key("/devices/example.org/1/active") == "example.org"
+    assert shard_key("/trust/example.org/aWs=") == "example.org"
+    assert shard_key("/urn:xmpp:omemo:2/example.org/device_ids") == "example.org"
+    assert shard_key("/eu.siacs.conversations.axolotl/example.org/1/double_ratchet") == "example.org"
+    assert shard_key("/queue/urn:xmpp:omemo:2/example.org") == "example.org"
+    assert shard_key("/slixmpp/subscribed/example.org/urn:xmpp:omemo:2") == "example.org"
+    assert shard_key("/alice@example.org/trust/example.org/aWs=") == "example.org"
+    assert shard_key("/urn:xmpp:omemo:2/bare_jids") == "/urn:xmpp:omemo:2/bare_jids"
+    assert shard_key("/slixmpp/decryption_cache/list/3") == "/slixmpp/decryption_cache/list/3"
+
+    shards = [ SlowStorage() for _ in range(4) ]
+    storage = ShardedStorage(shards)
+
+    await storage.store("/devices/bob@example.org/list", { "1": None })
+    await storage.store("/trust/bob@example.org/aWs=", "trusted")
+    await storage.store("/own_device_id", 1)
+    await storage.delete("/own_device_id")
+
+    shard = shards[storage.shard_index("/devices/bob@example.org/list")]
+    assert set(shard.data) >= { "/devices/bob@example.org/list", "/trust/bob@example.org/aWs=" }
+    assert (await storage.load("/trust/bob@example.org/aWs=")).from_just() == "trusted"
+    assert (await storage.load("/own_device_id")).is_nothing
+
+
+async def test_concurrency() -> None:
+    """
+    Test that operations are serialized per shard but run concurrently across shards, and that shards are
+    flushed in parallel.
+    """
+
+    shards = [ SlowStorage() for _ in range(2) ]
+
+    async def flush(shard: Storage) -> None:
+        assert isinstance(shard, SlowStorage)
+        await asyncio.sleep(0.01)
+        shard.flushes += 1
+
+    storage = ShardedStorage(shards, flush)
+
+    jids: List[str] = [ f"contact{i}@example.org" for i in range(20) ]
+    assert { storage.shard_index(f"/trust/{jid}/aWs=") for jid in jids } == { 0, 1 }
+
+    await asyncio.gather(*(storage.store(f"/trust/{jid}/aWs=", "trusted") for jid in jids))
+    assert all(shard.max_active == 1 for shard in shards)
+
+    await storage.flush()
+    assert all(shard.flushes == 1 for shard in shards)
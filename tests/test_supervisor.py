@@ -0,0 +1,250 @@
+import asyncio
+from functools import partial
+import multiprocessing
+from typing import Any, Counter, Dict, List
+
+import pytest
+
+from slixmpp.jid import JID
+from slixmpp.stanza import Message
+
+from slixmpp_omemo.session_manager_pool import SessionManagerPool
+from slixmpp_omemo.supervisor import HashRing, Supervisor, XMPPAccount
+from slixmpp_omemo.xep_0384 import OLDMEMO_DEVICE_LIST_NODE
+
+from .loopback import LoopbackClient, LoopbackServer
+
+
+__all__ = [
+    "ChatClient",
+    "create_account",
+    "test_hash_ring",
+    "test_supervisor",
+    "test_xmpp_account"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class ChatClient(LoopbackClient):
+    """
+    Client that sends an encrypted message to a peer once OMEMO is initialized and the peer's device list is
+    published, and decrypts the messages it receives.
+    """
+
+    def __init__(self, bare_jid: str, peer: str, server: LoopbackServer, pool: SessionManagerPool) -> None:
+        """
+        Args:
+            bare_jid: The bare JID of the client.
+            peer: The bare JID to send the message to.
+            server: The loopback server.
+            pool: The session manager pool to register the plugin and the client with.
+        """
+
+        super().__init__(f"{bare_jid}/chat", server, { "session_manager_pool": pool })
+
+        self.__peer = peer
+        self.__server = server
+        self.__counters: Counter[str] = Counter()
+
+        pool.register(self)
+
+        self.add_event_handler("omemo_initialized", self.__send_greeting)
+        self.add_event_handler("message", self.__decrypt)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            The numbers of messages sent, decrypted and failed to decrypt.
+        """
+
+        return dict(self.__counters)
+
+    async def __send_greeting(self, _event: Any) -> None:
+        """
+        Send an encrypted message to the peer once its device list is published.
+        """
+
+        while self.__server.get_item(self.__peer, OLDMEMO_DEVICE_LIST_NODE, "current") is None:
+            await asyncio.sleep(0.05)
+
+        stanza = self.make_message(
+            mto=JID(self.__peer),
+            mbody=f"Hello from {self.boundjid.bare}",
+            mtype="chat"
+        )
+        messages, _ = await self.omemo.encrypt_message(stanza, JID(self.__peer))
+        for message in messages.values():
+            message.send()
+            self.__counters["messages_sent"] += 1
+
+    async def __decrypt(self, stanza: Message) -> None:
+        """
+        Decrypt a received message.
+        """
+
+        if self.omemo.is_encrypted(stanza) is None:
+            return
+
+        try:
+            message, _ = await self.omemo.decrypt_message(stanza)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Messages for identities of this account on previous workers
+            self.__counters["messages_undecryptable"] += 1
+        else:
+            assert message["body"].startswith("Hello from ")
+            self.__counters["messages_decrypted"] += 1
+
+
+def create_account(
+    server: LoopbackServer,
+    bare_jids: int,
+    bare_jid: str,
+    pool: SessionManagerPool
+) -> XMPPAccount:
+    """
+    Args:
+        server: The loopback server shared by all workers.
+        bare_jids: The number of accounts, each account sends a message to the account with the next number.
+        bare_jid: The bare JID of the account, ``user<number>@example.org``.
+        pool: The session manager pool of the worker.
+
+    Returns:
+        The account.
+    """
+
+    number = int(bare_jid.split("@")[0][len("user"):])
+
+    return XMPPAccount(ChatClient(bare_jid, f"user{(number + 1) % bare_jids}@example.org", server, pool))
+
+
+async def test_hash_ring() -> None:
+    """
+    Test that adding a node only moves keys to the new node, and removing it moves them back.
+    """
+
+    keys = [ f"user{i}@example.org" for i in range(1000) ]
+
+    ring = HashRing([ "0", "1", "2" ])
+    before = { key: ring.node_for(key) for key in keys }
+    assert set(before.values()) == { "0", "1", "2" }
+
+    ring.add("3")
+    after = { key: ring.node_for(key) for key in keys }
+    moved = [ key for key in keys if before[key] != after[key] ]
+    assert all(after[key] == "3" for key in moved)
+    assert 100 < len(moved) < 400
+
+    ring.remove("3")
+    assert { key: ring.node_for(key) for key in keys } == before
+
+    with pytest.raises(LookupError):
+        HashRing().node_for("alice@example.org")
+
+
+async def wait_for(condition: Any, timeout: float = 30) -> None:
+    """
+    Wait until a condition holds.
+
+    Args:
+        condition: Returns whether the condition holds.
+        timeout: The time to wait at most, in seconds.
+    """
+
+    async def poll() -> None:
+        while not condition():
+            await asyncio.sleep(0.05)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def test_xmpp_account() -> None:
+    """
+    Test that accounts hosted by the XMPP adapter connect, exchange encrypted messages via the stand-in server
+    and disconnect.
+    """
+
+    server = LoopbackServer()
+    pool = SessionManagerPool()
+
+    alice = ChatClient("alice@example.org", "bob@example.org", server, pool)
+    bob = ChatClient("bob@example.org", "alice@example.org", server, pool)
+    disconnected: List[Any] = []
+    bob.add_event_handler("disconnected", disconnected.append)
+
+    accounts = [ XMPPAccount(alice), XMPPAccount(bob) ]
+    for account in accounts:
+        await account.start()
+
+    await wait_for(lambda: pool.stats.get("messages_decrypted") == 2)
+    assert alice.stats == { "messages_sent": 1, "messages_decrypted": 1 }
+    assert bob.stats == { "messages_sent": 1, "messages_decrypted": 1 }
+    assert pool.stats["pool_initializations"] == 2
+
+    for account in accounts:
+        await account.stop()
+    assert len(disconnected) == 1
+
+
+async def test_supervisor() -> None:
+    """
+    Test that accounts are distributed and exchange encrypted messages across workers, rebalanced when
+    workers are added and removed or die, and that metrics are collected from all workers.
+    """
+
+    bare_jids = [ f"user{i}@example.org" for i in range(6) ]
+
+    with multiprocessing.get_context("spawn").Manager() as manager:
+        server = LoopbackServer(manager.dict(), manager.list())
+        supervisor = Supervisor(partial(create_account, server, len(bare_jids)), metrics_interval=0.1)
+
+        def stats_match(expected: Dict[str, int]) -> bool:
+            return all(supervisor.stats.get(key) == value for key, value in expected.items())
+
+        try:
+            await supervisor.start(2)
+            for bare_jid in bare_jids:
+                await supervisor.add_account(bare_jid)
+
+            await asyncio.wait_for(supervisor.wait_settled(), 30)
+            assert set(supervisor.assignments) == set(bare_jids)
+            assert set(supervisor.assignments.values()) == { 0, 1 }
+
+            # Each account sends a message to the next one, some of them hosted by the other worker
+            await wait_for(lambda: stats_match({ "messages_sent": 6, "messages_decrypted": 6 }))
+            assert stats_match({ "worker_accounts": 6, "pool_accounts": 12 })
+
+            ring = HashRing([ "0", "1", "2" ])
+            worker_id = await supervisor.add_worker()
+            await asyncio.wait_for(supervisor.wait_settled(), 30)
+            assert supervisor.assignments == {
+                bare_jid: int(ring.node_for(bare_jid)) for bare_jid in bare_jids
+            }
+            await wait_for(lambda: stats_match({ "worker_accounts": 6, "supervisor_workers": 3 }))
+
+            await supervisor.remove_account(bare_jids[0])
+            await supervisor.remove_worker(worker_id)
+            await asyncio.wait_for(supervisor.wait_settled(), 30)
+            assert set(supervisor.assignments.values()) <= { 0, 1 }
+            await wait_for(lambda: stats_match({ "worker_accounts": 5, "supervisor_workers": 2 }))
+
+            # A worker dies, its accounts are taken over by the remaining worker
+            survivors = [ bare_jid for bare_jid, host in supervisor.assignments.items() if host == 1 ]
+            dying = [ bare_jid for bare_jid, host in supervisor.assignments.items() if host == 0 ]
+            metrics = supervisor.metrics
+            assert metrics[0]["worker_accounts"] == len(dying)
+            assert metrics[1]["worker_accounts"] == len(survivors)
+
+            for process in multiprocessing.active_children():
+                if process.name == "slixmpp-omemo-worker-0":
+                    process.kill()
+            await wait_for(lambda: stats_match({ "supervisor_worker_failures": 1, "worker_accounts": 5 }))
+            await asyncio.wait_for(supervisor.wait_settled(), 30)
+            assert supervisor.workers == frozenset({ 1 })
+            assert set(supervisor.assignments) == set(bare_jids[1:])
+        finally:
+            await supervisor.stop()
+
+    assert supervisor.workers == frozenset()
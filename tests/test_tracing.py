@@ -0,0 +1,126 @@
+import json
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from slixmpp.jid import JID
+
+from slixmpp_omemo.circuit_breaker import CircuitOpen
+from slixmpp_omemo.tracing import JSONLinesSpanExporter, Span, SpanExporter, trace
+
+
+__all__ = [
+    "test_disabled",
+    "test_failing_exporter",
+    "test_json_lines",
+    "test_outcomes"
+]
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class ListSpanExporter(SpanExporter):
+    """
+    Collects exported spans in a list.
+    """
+
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+async def succeed() -> str:
+    """
+    Returns:
+        A constant.
+    """
+
+    return "result"
+
+
+async def refuse() -> str:
+    """
+    Raises:
+        CircuitOpen: always.
+    """
+
+    raise CircuitOpen("refused")
+
+
+async def test_outcomes() -> None:
+    """
+    Test that results and exceptions are forwarded and that a span is exported for each request.
+    """
+
+    exporter = ListSpanExporter()
+    jid = JID("example.org")
+
+    result = await trace(exporter, "download_bundle", "get_items", jid, "node", "max_items", succeed())
+    assert result == "result"
+
+    with pytest.raises(CircuitOpen):
+        await trace(exporter, "download_device_list", "get_items", jid, "node", "full", refuse())
+
+    assert [ (span.operation, span.path, span.outcome) for span in exporter.spans ] == [
+        ("download_bundle", "max_items", "success"),
+        ("download_device_list", "full", "refused")
+    ]
+    assert all(span.jid == "example.org" and span.duration >= 0 for span in exporter.spans)
+
+
+async def test_disabled() -> None:
+    """
+    Test that requests are awaited as-is without an exporter.
+    """
+
+    assert await trace(None, "subscribe", "subscribe", JID("example.org"), "node", "default", succeed()) \
+        == "result"
+
+
+async def test_json_lines(tmp_path: Path) -> None:
+    """
+    Test that the JSON lines exporter appends one JSON object per span, also after reopening the file.
+    """
+
+    path = tmp_path / "spans.jsonl"
+    exporter = JSONLinesSpanExporter(str(path))
+    jid = JID("example.org")
+
+    await trace(exporter, "upload_bundle", "publish", jid, "node", "max_items", succeed())
+    exporter.close()
+    await trace(exporter, "upload_bundle", "publish", jid, "node", "max_items/reconfigure", succeed())
+    exporter.close()
+
+    lines = [ json.loads(line) for line in path.read_text(encoding="utf-8").splitlines() ]
+
+    assert [ line["path"] for line in lines ] == [ "max_items", "max_items/reconfigure" ]
+    assert lines[0]["request"] == "publish"
+    assert lines[0]["outcome"] == "success"
+
+
+class FailingSpanExporter(SpanExporter):
+    """
+    Fails to export any span, e.g. like a file exporter on a full disk.
+    """
+
+    def export(self, span: Span) -> None:
+        raise OSError("No space left on device")
+
+
+async def test_failing_exporter() -> None:
+    """
+    Test that a failing exporter doesn't affect the result or exception of the request.
+    """
+
+    exporter = FailingSpanExporter()
+    jid = JID("example.org")
+
+    result = await trace(exporter, "download_bundle", "get_items", jid, "node", "default", succeed())
+    assert result == "result"
+
+    with pytest.raises(CircuitOpen):
+        await trace(exporter, "download_bundle", "get_items", jid, "node", "default", refuse())